@@ -26,6 +26,7 @@ setup(
     url='https://github.com/juju/theblues',
     packages=[
         'theblues',
+        'theblues.aio',
     ],
     package_dir={'theblues': 'theblues'},
     include_package_data=True,
@@ -33,6 +34,9 @@ setup(
         'requests>=2.1.1',
         'jujubundlelib>=0.4.1',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+    },
     tests_requires=[
         'httmock==1.2.3',
     ],
@@ -48,5 +52,6 @@ setup(
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
     ],
 )
@@ -0,0 +1,5 @@
+"""Asynchronous clients built on asyncio and aiohttp.
+
+These modules require Python 3.5 or later and the aiohttp package, which can
+be installed with the "async" extra (e.g. pip install theblues[async]).
+"""
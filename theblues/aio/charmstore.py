@@ -0,0 +1,904 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import ssl
+
+import aiohttp
+
+from theblues.cache import cache_key
+from theblues.charmstore import (
+    CharmStore,
+    DEFAULT_BULK_MAX_IDS,
+    DEFAULT_BULK_MAX_URL_LENGTH,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_REVISIONED_CACHE_TTL,
+    JSON_CHUNK_SIZE,
+    _entity_includes,
+    _merge_bulk_responses,
+    _page_ids,
+    _related_ids,
+    _RELATED_INCLUDES,
+)
+from theblues.deadline import request_timeout
+from theblues.errors import (
+    DeadlineExceeded,
+    EntityNotFound,
+    ServerError,
+)
+from theblues.instrumentation import (
+    counted,
+    finish_request,
+    instrumented,
+    start_request,
+)
+from theblues.jsonstream import StreamDecoder
+from theblues.aio.utils import (
+    AsyncSingleFlight,
+    bulk_fetch,
+    client_timeout,
+    guard,
+    PooledSessionMixin,
+    record_response,
+    send_request,
+)
+from theblues.utils import DEFAULT_TIMEOUT
+
+
+# The default maximum number of simultaneous connections to the charmstore.
+DEFAULT_LIMIT = 100
+
+
+class AsyncCharmStore(PooledSessionMixin, CharmStore):
+    """An asyncio connection to the charmstore.
+
+    The methods performing requests are coroutines with the same arguments
+    and errors as their CharmStore counterparts. Methods only generating URLs
+    (e.g. archive_url) are inherited unchanged. The stream_archive,
+    stream_file and stream_resource methods return asynchronous iterators
+    over chunks of bytes, and the download methods return awaitables.
+    """
+
+    def __init__(self, url, macaroons=None, timeout=DEFAULT_TIMEOUT,
+                 verify=True, session=None, limit=DEFAULT_LIMIT,
+                 limit_per_host=0, keep_alive=True, cache=None,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 revisioned_cache_ttl=DEFAULT_REVISIONED_CACHE_TTL,
+                 bulk_max_ids=DEFAULT_BULK_MAX_IDS,
+                 bulk_max_url_length=DEFAULT_BULK_MAX_URL_LENGTH,
+                 coalesce=True, retry=None, circuit_breaker=None,
+                 timeouts=None, instrument=None):
+        """Initializer.
+
+        @param url The url to the charmstore API.
+        @param macaroons The optional discharged macaroon allowing access to
+            authenticated queries against the charmstore.
+        @param timeout How long to wait in seconds before timing out a request;
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param verify Whether to verify the certificate for the charmstore API
+            host, or the path to a CA bundle used to verify it.
+        @param session An optional aiohttp client session to use for all
+            requests. If not provided, a pooled session is created on first
+            use and owned by this instance.
+        @param limit The maximum number of simultaneous connections, or 0 for
+            no limit.
+        @param limit_per_host The maximum number of simultaneous connections
+            to a single host, or 0 for no limit.
+        @param keep_alive Whether connections are reused across requests.
+        @param cache An optional cache (see theblues.cache.MemoryCache, or
+            theblues.cache.DiskCache to share it across processes) used
+            to store entity metadata and config responses.
+        @param cache_ttl How long in seconds cached responses are valid for
+            ids without a revision or when a channel is specified.
+        @param revisioned_cache_ttl How long in seconds cached responses are
+            valid for ids including a revision; a value of None means until
+            evicted.
+        @param bulk_max_ids The maximum number of ids included in a single
+            bulk metadata request.
+        @param bulk_max_url_length The maximum length of the URL of a bulk
+            metadata request.
+        @param coalesce Whether identical requests made concurrently share a
+            single request to the charmstore.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the charmstore is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, see CharmStore.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        """
+        self.url = url
+        self.verify = verify
+        self._init_timeouts(timeout, timeouts)
+        self.macaroons = macaroons
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.revisioned_cache_ttl = revisioned_cache_ttl
+        self.bulk_max_ids = bulk_max_ids
+        self.bulk_max_url_length = bulk_max_url_length
+        self.single_flight = AsyncSingleFlight() if coalesce else None
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self._init_session(
+            session, limit=limit, limit_per_host=limit_per_host,
+            force_close=not keep_alive)
+
+    async def _get(self, url, deadline=None, operation=None):
+        """Make a get request against the charmstore.
+
+        This method is used by other API methods to standardize querying.
+
+        @param url The full url to query
+            (e.g. https://api.jujucharms.com/charmstore/v4/macaroon)
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request (see
+            CharmStore.timeout_operations), used to choose its timeout.
+        @return The response body as bytes.
+        """
+        if self.single_flight is None or deadline is not None:
+            # A call in flight may be bound by another deadline.
+            return await self._send_get(
+                url, deadline=deadline, operation=operation)
+        # Identical requests in flight share the same response.
+        return await self.single_flight.do(
+            cache_key(url, self.macaroons), self._send_get, url,
+            operation=operation)
+
+    async def _send_get(self, url, deadline=None, operation=None):
+        """Send a get request to the charmstore, see _get."""
+        with instrumented(self.instrument, self.client_name, 'GET', url,
+                          self._url_template(url, operation)) as record:
+            response = await self._open(
+                url, deadline=deadline, operation=operation, record=record)
+            try:
+                content = await response.read()
+            except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                raise self._request_error(url, exc, operation)
+            finally:
+                response.release()
+            record_response(record, response, len(content))
+            return content
+
+    async def _open(self, url, deadline=None, operation=None, record=None):
+        """Send a get request and return the response to be read.
+
+        The caller is responsible for releasing the response.
+
+        @param url The full url to query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        @param record The theblues.instrumentation.RequestRecord of the
+            request, if instrumented.
+        @return The aiohttp response, once its headers have been received.
+        """
+        if self.macaroons is None or len(self.macaroons) == 0:
+            cookies = {}
+        else:
+            cookies = dict([('macaroon-storefront', self.macaroons)])
+        session = self._get_session()
+        timeout = self._timeout(operation)
+        attempt = {}
+        get = guard(self.circuit_breaker, url, counted(
+            record, lambda: session.get(
+                url, cookies=cookies, ssl=_ssl_option(self.verify),
+                trace_request_ctx=record, timeout=attempt['timeout'])))
+
+        def send():
+            # An expired deadline is raised before reaching the breaker.
+            attempt['timeout'] = client_timeout(
+                request_timeout(timeout, deadline, url), deadline)
+            return get()
+        try:
+            response = await send_request(
+                self.retry, 'GET', send, deadline=deadline)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+            raise self._request_error(url, exc, operation)
+        record_response(record, response)
+        status = response.status
+        if status in (404, 407):
+            response.release()
+            raise EntityNotFound(url)
+        if status >= 400:
+            try:
+                content = await response.read()
+            except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                raise self._request_error(url, exc, operation)
+            finally:
+                response.release()
+            text = content.decode('utf-8', 'replace')
+            message = ('Error during request: {url} '
+                       'status code:({code}) '
+                       'message: {message}').format(
+                           url=url, code=status, message=text)
+            logging.error(message)
+            raise ServerError(status, text, message)
+        return response
+
+    def _stream(self, url, chunk_size=DEFAULT_CHUNK_SIZE, deadline=None,
+                operation=None):
+        """Make a get request and iterate over the response body in chunks.
+
+        See CharmStore._stream for a description of the parameters.
+
+        @return An asynchronous iterator over chunks of bytes.
+        """
+        return _ChunkIterator(self, url, chunk_size, deadline, operation)
+
+    async def _download(self, url, destination, chunk_size=DEFAULT_CHUNK_SIZE,
+                        hash_name=None, deadline=None, operation=None):
+        """Download the response body of a get request.
+
+        See CharmStore._download for a description of the parameters.
+
+        @return The hex digest of the body if hash_name is provided, or None.
+        """
+        hasher = None if hash_name is None else hashlib.new(hash_name)
+        if hasattr(destination, 'write'):
+            out = destination
+        else:
+            out = open(destination, 'wb')
+        chunks = self._stream(url, chunk_size=chunk_size, deadline=deadline,
+                              operation=operation)
+        try:
+            async for chunk in chunks:
+                out.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        except BaseException:
+            # Cancelled downloads are cleaned up too.
+            await chunks.aclose()
+            if out is not destination:
+                out.close()
+                os.remove(destination)
+            raise
+        if out is not destination:
+            out.close()
+        return None if hasher is None else hasher.hexdigest()
+
+    def _request_error(self, url, exc, operation=None):
+        """Log and return the ServerError for a failed request.
+
+        @param url The full url queried.
+        @param exc The asyncio.TimeoutError or aiohttp.ClientError raised.
+        @param operation The name of the operation which made the request.
+        """
+        if isinstance(exc, asyncio.TimeoutError):
+            message = 'Request timed out: {url} timeout: {timeout}'
+            message = message.format(
+                url=url, timeout=self._timeout(operation))
+        else:
+            message = ('Error during request: {url} '
+                       'message: {message}').format(url=url, message=exc)
+        logging.error(message)
+        return ServerError(message)
+
+    async def _get_json(self, url, deadline=None, operation=None):
+        """Make a get request and return the JSON decoded response body.
+
+        @param url The full url to query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        """
+        content = await self._get(
+            url, deadline=deadline, operation=operation)
+        return json.loads(content.decode('utf-8'))
+
+    async def _get_cached_json(self, url, entity_id, channel=None,
+                               deadline=None):
+        """Make a get request and return the JSON decoded response.
+
+        See CharmStore._get_cached_json.
+        """
+        if self.cache is None:
+            return await self._get_json(
+                url, deadline=deadline, operation='meta')
+        key = cache_key(url, self.macaroons)
+        content = self.cache.get(key)
+        if content is None:
+            content = await self._get(
+                url, deadline=deadline, operation='meta')
+            self.cache.set(
+                key, content, ttl=self._cache_ttl(entity_id, channel))
+        return json.loads(content.decode('utf-8'))
+
+    async def _meta(self, entity_id, includes, channel=None, deadline=None):
+        '''Retrieve metadata about an entity in the charmstore.
+
+        @param entity_id The ID either a reference or a string of the entity
+               to get.
+        @param includes Which metadata fields to include in the response.
+        @param channel Optional channel name, e.g. `stable`.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._meta_url(entity_id, includes, channel=channel)
+        return await self._get_cached_json(
+            url, entity_id, channel=channel, deadline=deadline)
+
+    async def entity(self, entity_id, get_files=False, channel=None,
+                     deadline=None):
+        '''Get the default data for any entity (e.g. bundle or charm).
+
+        @param entity_id The entity's id either as a reference or a string
+        @param get_files Whether to fetch the files for the charm or not.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self._meta(entity_id, _entity_includes(get_files),
+                                channel=channel, deadline=deadline)
+
+    async def _bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Retrieve metadata about many entities.
+
+        See CharmStore._bulk_meta. All the chunked requests are sent
+        concurrently, within the limits of the connection pool.
+        '''
+        chunks = self._bulk_meta_urls(entity_ids, includes)
+        responses = await bulk_fetch(
+            [url for _, url in chunks],
+            lambda url: self._get_json(
+                url, deadline=deadline, operation='meta'))
+        return _merge_bulk_responses(chunks, responses)
+
+    async def bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Get metadata about many entities.
+
+        See CharmStore.bulk_meta.
+        '''
+        if not includes:
+            raise ValueError('at least one include is required')
+        return await self._bulk_meta(entity_ids, includes, deadline=deadline)
+
+    async def entities(self, entity_ids, deadline=None):
+        '''Get the default data for entities.
+
+        See CharmStore.entities.
+        '''
+        return await self._bulk_meta(entity_ids, ['id'], deadline=deadline)
+
+    async def bundle(self, bundle_id, channel=None, deadline=None):
+        '''Get the default data for a bundle.
+
+        @param bundle_id The bundle's id.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self.entity(
+            bundle_id, get_files=True, channel=channel, deadline=deadline)
+
+    async def charm(self, charm_id, channel=None, deadline=None):
+        '''Get the default data for a charm.
+
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self.entity(
+            charm_id, get_files=True, channel=channel, deadline=deadline)
+
+    async def charm_icon(self, charm_id, channel=None, deadline=None):
+        '''Get the charm icon.
+
+        @param charm_id The ID of the charm.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self._get(
+            self.charm_icon_url(charm_id, channel=channel), deadline=deadline,
+            operation='icon')
+
+    async def bundle_visualization(self, bundle_id, channel=None,
+                                   deadline=None):
+        '''Get the bundle visualization.
+
+        @param bundle_id The ID of the bundle.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self._get(
+            self.bundle_visualization_url(bundle_id, channel=channel),
+            deadline=deadline, operation='diagram')
+
+    async def entity_readme_content(self, entity_id, channel=None,
+                                    deadline=None):
+        '''Get the readme for an entity.
+
+        @entity_id The id of the entity (i.e. charm, bundle).
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        content = await self._get(
+            self.entity_readme_url(entity_id, channel=channel),
+            deadline=deadline, operation='readme')
+        return content.decode('utf-8')
+
+    async def files(self, entity_id, manifest=None, filename=None,
+                    read_file=False, channel=None, deadline=None):
+        '''
+        Get the files or file contents of a file for an entity.
+
+        See CharmStore.files for a description of the parameters and of the
+        returned value.
+        '''
+        if manifest is None:
+            manifest = await self._get_json(
+                self._manifest_url(entity_id, channel), deadline=deadline,
+                operation='meta')
+        files = self._manifest_files(entity_id, manifest, channel)
+
+        if filename:
+            file_url = files.get(filename, None)
+            if file_url is None:
+                raise EntityNotFound(entity_id, filename)
+            if read_file:
+                content = await self._get(
+                    file_url, deadline=deadline, operation='file')
+                return content.decode('utf-8')
+            else:
+                return file_url
+        else:
+            return files
+
+    async def config(self, charm_id, channel=None, deadline=None):
+        '''Get the config data for a charm.
+
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._config_url(charm_id, channel=channel)
+        return await self._get_cached_json(
+            url, charm_id, channel=channel, deadline=deadline)
+
+    async def entityId(self, partial, channel=None, deadline=None):
+        '''Get an entity's full id provided a partial one.
+
+        Raises EntityNotFound if partial cannot be resolved.
+        @param partial The partial id (e.g. mysql, precise/mysql).
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._entity_id_url(partial, channel=channel)
+        data = await self._get_cached_json(
+            url, partial, channel=channel, deadline=deadline)
+        return data['Id']
+
+    async def search(self, text, includes=None, doc_type=None, limit=None,
+                     autocomplete=False, promulgated_only=False, tags=None,
+                     sort=None, owner=None, series=None, deadline=None):
+        '''
+        Search for entities in the charmstore.
+
+        See CharmStore.search for a description of the parameters.
+        '''
+        url = self._search_url(
+            text, includes=includes, doc_type=doc_type, limit=limit,
+            autocomplete=autocomplete, promulgated_only=promulgated_only,
+            tags=tags, sort=sort, owner=owner, series=series)
+        data = await self._get_json(
+            url, deadline=deadline, operation='search')
+        return data['Results']
+
+    async def list(self, includes=None, doc_type=None, promulgated_only=False,
+                   sort=None, owner=None, series=None, deadline=None):
+        '''
+        List entities in the charmstore.
+
+        See CharmStore.list for a description of the parameters.
+        '''
+        url = self._list_url(
+            includes=includes, doc_type=doc_type,
+            promulgated_only=promulgated_only, sort=sort, owner=owner,
+            series=series)
+        data = await self._get_json(url, deadline=deadline, operation='list')
+        return data['Results']
+
+    def iter_search(self, text, includes=None, doc_type=None,
+                    autocomplete=False, promulgated_only=False, tags=None,
+                    sort=None, owner=None, series=None,
+                    page_size=DEFAULT_PAGE_SIZE, deadline=None):
+        '''Lazily iterate over the entities matching a search.
+
+        See CharmStore.iter_search for a description of the parameters.
+
+        @return An asynchronous iterator over the entities.
+        '''
+        def page_url(skip):
+            return self._search_url(
+                text, includes=includes, doc_type=doc_type, limit=page_size,
+                autocomplete=autocomplete, promulgated_only=promulgated_only,
+                tags=tags, sort=sort, owner=owner, series=series, skip=skip)
+        return self._iter_pages(
+            page_url, page_size, deadline=deadline, operation='search')
+
+    def iter_list(self, includes=None, doc_type=None, promulgated_only=False,
+                  sort=None, owner=None, series=None,
+                  page_size=DEFAULT_PAGE_SIZE, deadline=None):
+        '''Lazily iterate over the entities in the charmstore.
+
+        See CharmStore.iter_list for a description of the parameters.
+
+        @return An asynchronous iterator over the entities.
+        '''
+        def page_url(skip):
+            return self._list_url(
+                includes=includes, doc_type=doc_type,
+                promulgated_only=promulgated_only, sort=sort, owner=owner,
+                series=series, limit=page_size, skip=skip)
+        return self._iter_pages(
+            page_url, page_size, deadline=deadline, operation='list')
+
+    def _iter_pages(self, page_url, page_size, deadline=None,
+                    operation=None):
+        '''Return an asynchronous iterator over the results of a paged query.
+
+        @param page_url A callable returning the URL of the page starting
+            at the given offset.
+        @param page_size The number of entities requested per page.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @param operation The name of the operation making the requests.
+        '''
+        if page_size < 1:
+            raise ValueError('page size must be positive')
+        return _PageIterator(self, page_url, page_size, deadline, operation)
+
+    def stream_search(self, text, includes=None, doc_type=None, limit=None,
+                      autocomplete=False, promulgated_only=False, tags=None,
+                      sort=None, owner=None, series=None, deadline=None):
+        '''Search for entities, decoding the response as it is received.
+
+        See CharmStore.stream_search for a description of the parameters.
+
+        @return An asynchronous iterator over the entities.
+        '''
+        url = self._search_url(
+            text, includes=includes, doc_type=doc_type, limit=limit,
+            autocomplete=autocomplete, promulgated_only=promulgated_only,
+            tags=tags, sort=sort, owner=owner, series=series)
+        return _JSONStreamIterator(
+            self, [url], key='Results', deadline=deadline, operation='search')
+
+    def stream_list(self, includes=None, doc_type=None,
+                    promulgated_only=False, sort=None, owner=None,
+                    series=None, deadline=None):
+        '''List entities, decoding the response as it is received.
+
+        See CharmStore.stream_list for a description of the parameters.
+
+        @return An asynchronous iterator over the entities.
+        '''
+        url = self._list_url(
+            includes=includes, doc_type=doc_type,
+            promulgated_only=promulgated_only, sort=sort, owner=owner,
+            series=series)
+        return _JSONStreamIterator(
+            self, [url], key='Results', deadline=deadline, operation='list')
+
+    def stream_bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Get metadata about many entities, decoding responses as they come.
+
+        See CharmStore.stream_bulk_meta for a description of the parameters.
+
+        @return An asynchronous iterator over (entity id, metadata) tuples.
+        '''
+        if not includes:
+            raise ValueError('at least one include is required')
+        urls = [url for _, url in self._bulk_meta_urls(entity_ids, includes)]
+        return _JSONStreamIterator(
+            self, urls, skip_missing=True, deadline=deadline, operation='meta')
+
+    async def _get_results(self, url, deadline=None, operation=None):
+        '''Return the results of the search or list query at the given URL.
+
+        @param url The URL of the query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        '''
+        data = await self._get_json(
+            url, deadline=deadline, operation=operation)
+        return data['Results'] or []
+
+    async def fetch_related(self, ids, deadline=None):
+        """Fetch related entity information.
+
+        See CharmStore.fetch_related.
+        """
+        if not ids:
+            return []
+        results = await self._bulk_meta(
+            _related_ids(ids), _RELATED_INCLUDES, deadline=deadline)
+        return results.values()
+
+    async def fetch_interfaces(self, interface, way, deadline=None):
+        """Get the list of charms that provides or requires this interface.
+
+        @param interface The interface for the charm relation.
+        @param way The type of relation, either "provides" or "requires".
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return List of charms
+        """
+        if not interface:
+            return []
+        data = await self._get_json(
+            self._fetch_interfaces_url(interface, way), deadline=deadline,
+            operation='search')
+        return data.values()
+
+    async def debug(self, deadline=None):
+        '''Retrieve the debug information from the charmstore.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return await self._get_json(
+            '{}/debug/status'.format(self.url), deadline=deadline,
+            operation='debug')
+
+    async def fetch_macaroon(self, deadline=None):
+        '''Fetch a macaroon from charmstore.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        content = await self._get(
+            '{}/macaroon'.format(self.url), deadline=deadline,
+            operation='macaroon')
+        return content.decode('utf-8')
+
+
+class _PageIterator(object):
+    '''Asynchronously iterate over the results of a paged query.
+
+    The next page is requested in the background while the results of the
+    current one are consumed, and the iteration stops as described in
+    CharmStore._iter_pages.
+    '''
+
+    def __init__(self, cs, page_url, page_size, deadline=None,
+                 operation=None):
+        self._cs = cs
+        self._page_url = page_url
+        self._page_size = page_size
+        self._deadline = deadline
+        self._operation = operation
+        self._skip = 0
+        self._results = collections.deque()
+        self._pending = None
+        self._previous = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._results:
+            if self._done:
+                raise StopAsyncIteration
+            if self._pending is None:
+                self._pending = self._fetch()
+            results = await self._pending
+            self._pending = None
+            ids = _page_ids(results)
+            if ids == self._previous:
+                self._done = True
+                continue
+            self._previous = ids
+            if len(results) != self._page_size:
+                self._done = True
+            else:
+                self._skip += self._page_size
+                self._pending = self._fetch()
+            self._results.extend(results)
+        return self._results.popleft()
+
+    async def aclose(self):
+        '''Stop the iteration, cancelling any page request in flight.'''
+        self._done = True
+        self._results.clear()
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    def _fetch(self):
+        '''Start requesting the page at the current offset.'''
+        return asyncio.ensure_future(
+            self._cs._get_results(
+                self._page_url(self._skip), deadline=self._deadline,
+                operation=self._operation))
+
+
+class _JSONStreamIterator(object):
+    '''Asynchronously iterate over incrementally decoded JSON responses.
+
+    The URLs are queried in turn, and the members of each response (see
+    theblues.jsonstream.StreamDecoder) are returned as soon as they have
+    been decoded.
+    '''
+
+    def __init__(self, cs, urls, key=None, skip_missing=False,
+                 deadline=None, operation=None):
+        self._cs = cs
+        self._urls = collections.deque(urls)
+        self._key = key
+        self._skip_missing = skip_missing
+        self._deadline = deadline
+        self._operation = operation
+        self._items = collections.deque()
+        self._response = None
+        self._decoder = None
+        self._url = None
+        self._record = None
+        self._size = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._response is None:
+                if not self._urls:
+                    raise StopAsyncIteration
+                self._url = self._urls.popleft()
+                cs = self._cs
+                self._record = start_request(
+                    cs.instrument, cs.client_name, 'GET', self._url,
+                    cs._url_template(self._url, self._operation))
+                try:
+                    self._response = await cs._open(
+                        self._url, deadline=self._deadline,
+                        operation=self._operation, record=self._record)
+                except EntityNotFound as err:
+                    self._finish(err)
+                    if self._skip_missing:
+                        continue
+                    raise
+                except Exception as err:
+                    self._finish(err)
+                    raise
+                self._decoder = StreamDecoder(self._key)
+                self._size = 0
+            try:
+                if self._deadline is not None:
+                    self._deadline.check(self._url)
+                chunk = await self._response.content.read(JSON_CHUNK_SIZE)
+            except DeadlineExceeded as err:
+                await self.aclose(err)
+                raise
+            except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                error = self._cs._request_error(
+                    self._url, exc, self._operation)
+                await self.aclose(error)
+                raise error
+            self._size += len(chunk)
+            try:
+                if chunk:
+                    self._items.extend(self._decoder.feed(chunk))
+                else:
+                    self._items.extend(self._decoder.close())
+                    self._release()
+            except ValueError as err:
+                await self.aclose(err)
+                raise
+        return self._items.popleft()
+
+    async def aclose(self, error=None):
+        '''Stop the iteration, releasing the response being read.'''
+        self._urls.clear()
+        self._items.clear()
+        self._release(error)
+
+    def _release(self, error=None):
+        if self._response is not None:
+            self._response.release()
+            self._response = None
+            if self._record is not None:
+                self._record.size = self._size
+            self._finish(error)
+
+    def _finish(self, error=None):
+        '''Report the request of the response being read, if any.'''
+        finish_request(self._cs.instrument, self._record, error)
+        self._record = None
+
+
+class _ChunkIterator(object):
+    '''Asynchronously iterate over the body of a response in chunks of bytes.
+
+    The request is sent on the first iteration, and the response is released
+    once its body has been read or the iteration is closed.
+    '''
+
+    def __init__(self, cs, url, chunk_size, deadline=None, operation=None):
+        self._cs = cs
+        self._url = url
+        self._chunk_size = chunk_size
+        self._deadline = deadline
+        self._operation = operation
+        self._response = None
+        self._chunks = None
+        self._record = None
+        self._size = 0
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+        if self._response is None:
+            cs = self._cs
+            self._record = start_request(
+                cs.instrument, cs.client_name, 'GET', self._url,
+                cs._url_template(self._url, self._operation))
+            try:
+                self._response = await cs._open(
+                    self._url, deadline=self._deadline,
+                    operation=self._operation, record=self._record)
+            except Exception as err:
+                self._done = True
+                finish_request(cs.instrument, self._record, err)
+                self._record = None
+                raise
+            self._chunks = self._response.content.iter_chunked(
+                self._chunk_size).__aiter__()
+        try:
+            if self._deadline is not None:
+                self._deadline.check(self._url)
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+        except DeadlineExceeded as err:
+            await self.aclose(err)
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+            message = ('Error during download: {url} '
+                       'message: {message}').format(url=self._url, message=exc)
+            logging.error(message)
+            error = ServerError(message)
+            await self.aclose(error)
+            raise error
+        self._size += len(chunk)
+        return chunk
+
+    async def aclose(self, error=None):
+        '''Stop the iteration, releasing the response being read.'''
+        self._done = True
+        if self._response is not None:
+            self._response.release()
+            self._response = None
+            if self._record is not None:
+                self._record.size = self._size
+            finish_request(self._cs.instrument, self._record, error)
+            self._record = None
+
+
+def _ssl_option(verify):
+    '''Return the aiohttp ssl option matching a requests verify value.
+
+    @param verify Whether to verify certificates, or a path to a CA bundle.
+    '''
+    if isinstance(verify, bool):
+        return verify
+    return ssl.create_default_context(cafile=verify)
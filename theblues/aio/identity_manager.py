@@ -0,0 +1,219 @@
+from theblues.aio.utils import (
+    make_request,
+    PooledSessionMixin,
+)
+from theblues.cache import DEFAULT_MAX_ENTRIES
+from theblues.errors import ServerError
+from theblues.identity_manager import (
+    DEFAULT_DISCHARGE_REFRESH,
+    IdentityManager,
+)
+from theblues.utils import (
+    ensure_trailing_slash,
+    DEFAULT_TIMEOUT,
+)
+
+
+class AsyncIdentityManager(PooledSessionMixin, IdentityManager):
+    """Asynchronous Identity Manager API.
+
+    The methods performing requests are coroutines with the same arguments
+    and errors as their IdentityManager counterparts.
+    """
+
+    def __init__(self, url, idm_user, idm_password, timeout=DEFAULT_TIMEOUT,
+                 session=None, retry=None, circuit_breaker=None,
+                 timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES,
+                 discharge_refresh=DEFAULT_DISCHARGE_REFRESH,
+                 user_cache_ttl=0, cache_discharges=False):
+        """Initializer.
+
+        @param url The url to the identity manager (IdM) API.
+        @param idm_user The user name for the IdM.
+        @param idm_password The password for the IdM.
+        @param timeout How long to wait before timing out a request in seconds;
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session An optional aiohttp session, e.g. to share a connection
+            pool between clients. If not provided, a pooled session is created
+            on first use and owned by this instance.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g.
+            {'get_user': 1, 'login': (3.05, 10)}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many discharged macaroons and users are
+            cached, or 0 to disable caching.
+        @param discharge_refresh How many seconds before the expiry of their
+            time-before caveat cached discharged macaroons are refreshed.
+        @param user_cache_ttl How long in seconds the data and extra info of
+            users are cached, or 0 not to cache them. Entries are invalidated
+            when the user is updated with login or set_extra_info.
+        @param cache_discharges Whether discharged macaroons and tokens are
+            cached until shortly before their time-before caveat expires.
+        """
+        self.url = ensure_trailing_slash(url)
+        self.auth = (idm_user, idm_password)
+        self._init_timeouts(timeout, timeouts)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.discharge_refresh = discharge_refresh
+        self.user_cache_ttl = user_cache_ttl
+        self.cache_discharges = cache_discharges
+        self._init_result_cache(cache_size)
+        self._init_session(session)
+
+    async def get_user(self, username, deadline=None):
+        """Fetch user data.
+
+        Raise a ServerError if an error occurs in the request process.
+
+        @param username the user's name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = self._user_url(username)
+        user = self._cached_user_data(url)
+        if user is not None:
+            return user
+        return self._cache_user_data(url, await make_request(
+            url, auth=self.auth, timeout=self._timeout('get_user'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/u/{username}'))
+
+    async def debug(self, deadline=None):
+        """Retrieve the debug information from the identity manager.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = '{}debug/status'.format(self.url)
+        try:
+            return await make_request(
+                url, timeout=self._timeout('debug'),
+                session=self._get_session(),
+                retry=self.retry, circuit_breaker=self.circuit_breaker,
+                deadline=deadline, instrument=self.instrument,
+                client=self.client_name, template='/debug/status')
+        except ServerError as err:
+            return {"error": str(err)}
+
+    async def login(self, username, json_document, deadline=None):
+        """Send user identity information to the identity manager.
+
+        Raise a ServerError if an error occurs in the request process.
+
+        @param username The logged in user.
+        @param json_document The JSON payload for login.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = self._user_url(username)
+        try:
+            await make_request(
+                url, method='PUT', body=json_document, auth=self.auth,
+                timeout=self._timeout('login'), session=self._get_session(),
+                retry=self.retry, circuit_breaker=self.circuit_breaker,
+                deadline=deadline, instrument=self.instrument,
+                client=self.client_name, template='/u/{username}')
+        finally:
+            # Even a failed request may have updated the user.
+            self.invalidate_user(username)
+
+    async def discharge(self, username, macaroon, deadline=None):
+        """Discharge the macarooon for the identity.
+
+        @param username The logged in user.
+        @param macaroon The macaroon returned from the charm store.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The resulting base64 encoded macaroon.
+        @raises ServerError when making request to the discharge endpoint
+        InvalidMacaroon when the macaroon passedin or discharged is invalid
+        """
+        url = self._discharge_url(username, macaroon)
+        discharged = self._cached_discharge(url)
+        if discharged is not None:
+            return discharged
+        response = await make_request(
+            url, method='POST', auth=self.auth,
+            timeout=self._timeout('discharge'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/discharger/discharge')
+        return self._discharged(url, response)
+
+    async def discharge_token(self, username, deadline=None):
+        """Discharge token for a user.
+
+        Raise a ServerError if an error occurs in the request process.
+
+        @param username The logged in user.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The resulting base64 encoded discharged token.
+        """
+        url = self._discharge_token_url(username)
+        discharged = self._cached_discharge(url)
+        if discharged is not None:
+            return discharged
+        response = await make_request(
+            url, method='GET', auth=self.auth,
+            timeout=self._timeout('discharge_token'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/discharge-token-for-user')
+        return self._discharged_token(url, response)
+
+    async def set_extra_info(self, username, extra_info, deadline=None):
+        """Set extra info for the given user.
+
+        Raise a ServerError if an error occurs in the request process.
+
+        @param username The username for the user to update.
+        @param info The extra info as a JSON encoded string, or as a Python
+            dictionary like object.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = self._get_extra_info_url(username)
+        try:
+            await make_request(
+                url, method='PUT', body=extra_info, auth=self.auth,
+                timeout=self._timeout('set_extra_info'),
+                session=self._get_session(),
+                retry=self.retry, circuit_breaker=self.circuit_breaker,
+                deadline=deadline, instrument=self.instrument,
+                client=self.client_name, template='/u/{username}/extra-info')
+        finally:
+            # Even a failed request may have updated the user.
+            self.invalidate_user(username)
+
+    async def get_extra_info(self, username, deadline=None):
+        """Get extra info for the given user.
+
+        Raise a ServerError if an error occurs in the request process.
+
+        @param username The username for the user who's info is being accessed.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = self._get_extra_info_url(username)
+        extra_info = self._cached_user_data(url)
+        if extra_info is not None:
+            return extra_info
+        return self._cache_user_data(url, await make_request(
+            url, auth=self.auth, timeout=self._timeout('get_extra_info'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/u/{username}/extra-info'))
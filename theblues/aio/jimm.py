@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+from theblues.aio.utils import (
+    client_timeout,
+    guard,
+    make_request,
+    PooledSessionMixin,
+    record_response,
+    send_request,
+)
+from theblues.deadline import request_timeout
+from theblues.errors import log
+from theblues.instrumentation import (
+    counted,
+    instrumented,
+)
+from theblues.jimm import (
+    _get_macaroon,
+    JIMM,
+)
+from theblues.utils import (
+    ensure_trailing_slash,
+    DEFAULT_TIMEOUT,
+)
+
+
+class AsyncJIMM(PooledSessionMixin, JIMM):
+    """Asynchronous JIMM API.
+
+    The methods performing requests are coroutines with the same arguments
+    and errors as their JIMM counterparts.
+    """
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None):
+        """Initializer.
+
+        @param url The url to the JIMM API.
+        @param timeout How long to wait before timing out a request in seconds;
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session An optional aiohttp session, e.g. to share a connection
+            pool between clients. If not provided, a pooled session is created
+            on first use and owned by this instance.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'list_models': (3.05, 30)}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        """
+        self.url = ensure_trailing_slash(url)
+        self._init_timeouts(timeout, timeouts)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self._init_session(session)
+
+    async def fetch_macaroon(self, deadline=None):
+        """ Fetches the macaroon from the JIMM controller.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The base64 encoded macaroon.
+        """
+        url = "{}model".format(self.url)
+        timeout = self._timeout('fetch_macaroon')
+        try:
+            session = self._get_session()
+            attempt = {}
+            with instrumented(self.instrument, self.client_name, 'GET', url,
+                              '/model') as record:
+                get = guard(self.circuit_breaker, url, counted(
+                    record, lambda: session.get(
+                        url, trace_request_ctx=record,
+                        timeout=attempt['timeout'])))
+
+                def send():
+                    # An expired deadline is raised before reaching the
+                    # breaker.
+                    attempt['timeout'] = client_timeout(request_timeout(
+                        timeout, deadline, url), deadline)
+                    return get()
+                response = await send_request(
+                    self.retry, 'GET', send, deadline=deadline)
+                async with response:
+                    content = await response.read()
+                    record_response(record, response, len(content))
+        except asyncio.TimeoutError:
+            message = 'Request timed out: {url} timeout: {timeout}'
+            message = message.format(url=url, timeout=timeout)
+            log.error(message)
+            return None
+        except Exception as e:
+            log.info('Unable to contact JIMM due to: {}'.format(e))
+            return None
+
+        try:
+            json_response = json.loads(content.decode('utf-8'))
+        except ValueError:
+            log.info(
+                'cannot process macaroon: '
+                'cannot unmarshal response: {!r}'.format(content))
+            return None
+        return _get_macaroon(json_response)
+
+    async def list_models(self, macaroons, deadline=None):
+        """ Get the logged in user's models from the JIMM controller.
+
+        @param macaroons The discharged JIMM macaroons.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The json decoded list of environments.
+        """
+        return await make_request(
+            "{}model".format(self.url), macaroons=macaroons,
+            timeout=self._timeout('list_models'), session=self._get_session(),
+            retry=self.retry, circuit_breaker=self.circuit_breaker,
+            deadline=deadline, instrument=self.instrument,
+            client=self.client_name, template='/model')
@@ -0,0 +1,105 @@
+from theblues.aio.utils import (
+    bulk_fetch,
+    make_request,
+    PooledSessionMixin,
+)
+from theblues.cache import DEFAULT_MAX_ENTRIES
+from theblues.plans import (
+    _parse_plans,
+    DEFAULT_BULK_WORKERS,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_NEGATIVE_CACHE_TTL,
+    Plans,
+    PLAN_VERSION,
+)
+from theblues.utils import (
+    bulk_results,
+    ensure_trailing_slash,
+    DEFAULT_TIMEOUT,
+)
+
+
+class AsyncPlans(PooledSessionMixin, Plans):
+    """Asynchronous Plans API.
+
+    The methods performing requests are coroutines with the same arguments
+    and errors as their Plans counterparts.
+    """
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL,
+                 negative_cache_ttl=DEFAULT_NEGATIVE_CACHE_TTL,
+                 bulk_workers=DEFAULT_BULK_WORKERS):
+        """Initializer.
+
+        @param url The url to the Plan API.
+        @param timeout How long to wait before timing out a request in seconds;
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session An optional aiohttp session, e.g. to share a connection
+            pool between clients. If not provided, a pooled session is created
+            on first use and owned by this instance.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'get_plans': 1}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many charms' plans are cached, or 0 to disable
+            caching.
+        @param cache_ttl How long in seconds the plans of a charm are cached.
+        @param negative_cache_ttl How long in seconds the absence of plans
+            for a charm is cached.
+        @param bulk_workers How many charms' plans can be requested
+            concurrently by bulk_plans.
+        """
+        self.url = ensure_trailing_slash(url) + PLAN_VERSION + '/'
+        self._init_timeouts(timeout, timeouts)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.bulk_workers = bulk_workers
+        self._init_result_cache(cache_size)
+        self._init_session(session)
+
+    async def get_plans(self, reference, deadline=None):
+        """Get the plans for a given charm.
+
+        @param the Reference to a charm.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return a tuple of plans or an empty tuple if no plans.
+        @raise ServerError
+        """
+        url = self._plans_url(reference)
+        plans = self._cached_result(url)
+        if plans is None:
+            plans = await self._request_plans(url, reference, deadline)
+        return plans
+
+    async def _request_plans(self, url, reference, deadline=None):
+        """Request, cache and return the plans of a charm, see get_plans."""
+        json = await make_request(
+            url, timeout=self._timeout('get_plans'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/charm')
+        return self._cache_plans(url, _parse_plans(reference, json))
+
+    async def bulk_plans(self, references, deadline=None):
+        """Get the plans of many charms, e.g. all the charms of a bundle.
+
+        See Plans.bulk_plans.
+        """
+        responses, missing = self._cached_plans(references)
+        responses.extend(await bulk_fetch(
+            list(missing),
+            lambda path: self._request_plans(
+                *missing[path], deadline=deadline),
+            self.bulk_workers))
+        return bulk_results(responses)
@@ -0,0 +1,107 @@
+from theblues.aio.utils import (
+    bulk_fetch,
+    make_request,
+    PooledSessionMixin,
+)
+from theblues.cache import DEFAULT_MAX_ENTRIES
+from theblues.terms import (
+    _parse_terms,
+    DEFAULT_BULK_WORKERS,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_REVISIONED_CACHE_TTL,
+    Terms,
+    TERMS_VERSION,
+)
+from theblues.utils import (
+    bulk_results,
+    ensure_trailing_slash,
+    DEFAULT_TIMEOUT,
+)
+
+
+class AsyncTerms(PooledSessionMixin, Terms):
+    """Asynchronous Terms Service API.
+
+    The methods performing requests are coroutines with the same arguments
+    and errors as their Terms counterparts.
+    """
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL,
+                 revisioned_cache_ttl=DEFAULT_REVISIONED_CACHE_TTL,
+                 bulk_workers=DEFAULT_BULK_WORKERS):
+        """Initializer.
+
+        @param url The url to the Terms Service API.
+        @param timeout How long to wait in seconds before timing out a request;
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session An optional aiohttp session, e.g. to share a connection
+            pool between clients. If not provided, a pooled session is created
+            on first use and owned by this instance.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'get_terms': 1}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many terms are cached, or 0 to disable caching.
+        @param cache_ttl How long in seconds the latest revision of terms is
+            cached.
+        @param revisioned_cache_ttl How long in seconds terms requested at a
+            given revision are cached; a value of None means until evicted.
+        @param bulk_workers How many terms can be requested concurrently by
+            bulk_terms.
+        """
+        self.url = ensure_trailing_slash(url) + TERMS_VERSION + '/'
+        self._init_timeouts(timeout, timeouts)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.cache_ttl = cache_ttl
+        self.revisioned_cache_ttl = revisioned_cache_ttl
+        self.bulk_workers = bulk_workers
+        self._init_result_cache(cache_size)
+        self._init_session(session)
+
+    async def get_terms(self, name, revision=None, deadline=None):
+        """ Retrieve a specific term and condition.
+
+        @param name of the terms.
+        @param revision of the terms,
+               if none provided it will return the latest.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The list of terms.
+        @raise ServerError
+        """
+        url = self._terms_url(name, revision)
+        term = self._cached_result(url)
+        if term is None:
+            term = await self._request_terms(url, name, revision, deadline)
+        return term
+
+    async def _request_terms(self, url, name, revision, deadline=None):
+        """Request, cache and return the given terms, see get_terms."""
+        json = await make_request(
+            url, timeout=self._timeout('get_terms'),
+            session=self._get_session(), retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/terms/{name}')
+        return self._cache_term(url, revision, _parse_terms(name, json))
+
+    async def bulk_terms(self, terms, deadline=None):
+        """Retrieve many terms and conditions.
+
+        See Terms.bulk_terms.
+        """
+        responses, missing = self._cached_terms(terms)
+        responses.extend(await bulk_fetch(
+            list(missing),
+            lambda key: self._request_terms(missing[key], *key,
+                                            deadline=deadline),
+            self.bulk_workers))
+        return bulk_results(responses)
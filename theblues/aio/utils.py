@@ -0,0 +1,405 @@
+import asyncio
+import base64
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import json
+from urllib.parse import urlencode
+
+import aiohttp
+
+from theblues.errors import (
+    CircuitOpenError,
+    DeadlineExceeded,
+    EntityNotFound,
+    log,
+    ServerError,
+    timeout_error,
+)
+from theblues.deadline import (
+    remaining,
+    request_timeout,
+)
+from theblues.instrumentation import (
+    counted,
+    instrumented,
+    RequestRecord,
+)
+from theblues.retry import _now
+from theblues.utils import _server_error_message
+
+
+class PooledSessionMixin(object):
+    """Manage the pooled aiohttp session used by an asynchronous client.
+
+    Classes using this mixin call _init_session from their initializer. The
+    session is created on first use, since aiohttp sessions must be created
+    from within a running event loop. If the client has an instrument, the
+    session reports the timings of its requests (see trace_config).
+    """
+
+    def _init_session(self, session=None, **connector_options):
+        """Set up the session handling.
+
+        @param session An optional aiohttp client session, which is then
+            shared with the caller and left open by close().
+        @param connector_options The aiohttp.TCPConnector options used when
+            creating a new session.
+        """
+        self._owns_session = session is None
+        self.session = session
+        self._connector_options = connector_options
+
+    def _get_session(self):
+        """Return the aiohttp session, creating it if required."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(**self._connector_options)
+            self.session = aiohttp.ClientSession(
+                connector=connector, trace_configs=trace_configs(
+                    getattr(self, 'instrument', None)))
+        return self.session
+
+    async def close(self):
+        """Close the pooled connections held by this client.
+
+        A session provided by the caller is left open.
+        """
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        raise TypeError('use "async with" with asynchronous clients')
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncSingleFlight(object):
+    """Coalesce concurrent coroutine calls sharing the same key.
+
+    This is the asyncio counterpart of theblues.utils.SingleFlight: while a
+    call for a key is in flight, other callers with the same key await its
+    result instead of making the call themselves.
+    """
+
+    def __init__(self):
+        # The number of calls served by another call in flight.
+        self.shared = 0
+        self._calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        """Await func(*args, **kwargs) unless a call is in flight.
+
+        @param key The hashable key identifying identical calls.
+        @param func The coroutine function to call.
+        @return The result of the call.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # Cancelling one of the callers does not cancel the shared call.
+        return await asyncio.shield(future)
+
+
+async def send_request(retry, method, send, deadline=None):
+    """Send a request, retrying it if a retry policy is provided.
+
+    This is the asynchronous counterpart of theblues.retry.send_request.
+
+    @param retry The theblues.retry.RetryPolicy to follow, or None.
+    @param method The HTTP method of the request.
+    @param send A callable returning an awaitable aiohttp response.
+    @param deadline The optional theblues.deadline.Deadline of the operation.
+    @return The last response received, to be released by the caller.
+    @raise The asyncio.TimeoutError or aiohttp.ClientConnectionError raised
+        by the last attempt.
+    """
+    if retry is None:
+        return await send()
+    started = _now()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = await send()
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            delay = retry.retry_delay(
+                method, attempt, _now() - started,
+                remaining=remaining(deadline))
+            if delay is None:
+                raise
+        else:
+            delay = retry.retry_delay(
+                method, attempt, _now() - started, status=response.status,
+                retry_after=response.headers.get('Retry-After'),
+                remaining=remaining(deadline))
+            if delay is None:
+                return response
+            response.release()
+        await asyncio.sleep(delay)
+
+
+async def bulk_fetch(keys, fetch, workers=None):
+    """Retrieve the values of many keys concurrently.
+
+    This is the asynchronous counterpart of theblues.utils.bulk_fetch.
+
+    @param keys A list of the keys to retrieve.
+    @param fetch A coroutine function returning the value of a key, and
+        raising EntityNotFound or ServerError if it cannot be retrieved.
+    @param workers The maximum number of concurrent calls to fetch, or None
+        for no limit.
+    @return A list of (key, value, error) tuples, see
+        theblues.utils.bulk_results.
+    """
+    semaphore = None
+    if workers is not None:
+        semaphore = asyncio.Semaphore(max(workers, 1))
+
+    async def call(key):
+        try:
+            if semaphore is None:
+                value = await fetch(key)
+            else:
+                async with semaphore:
+                    value = await fetch(key)
+        except (EntityNotFound, ServerError) as err:
+            return key, None, err
+        return key, value, None
+    return await asyncio.gather(*[call(key) for key in keys])
+
+
+def guard(breaker, url, send):
+    """Return send guarded by the given circuit breaker, if any.
+
+    This is the asynchronous counterpart of theblues.circuit.guard.
+
+    @param breaker The theblues.circuit.CircuitBreaker protecting the host,
+        or None.
+    @param url The URL of the request.
+    @param send A callable returning an awaitable aiohttp response.
+    """
+    if breaker is None:
+        return send
+
+    async def guarded():
+        trial = breaker.before_request(url)
+        try:
+            response = await send()
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancellations and other errors say nothing about the host.
+            if trial:
+                breaker.release_trial()
+            raise
+        breaker.record_status(response.status)
+        return response
+    return guarded
+
+
+def trace_config():
+    """Return an aiohttp.TraceConfig timing the phases of requests.
+
+    The timings are stored in the theblues.instrumentation.RequestRecord
+    passed as trace_request_ctx to the request, if any.
+    """
+    config = aiohttp.TraceConfig()
+    config.on_dns_resolvehost_start.append(_phase_tracer('dns', True))
+    config.on_dns_resolvehost_end.append(_phase_tracer('dns', False))
+    config.on_connection_create_start.append(_phase_tracer('connect', True))
+    config.on_connection_create_end.append(_phase_tracer('connect', False))
+    # The request ends once the response headers have been received.
+    config.on_request_start.append(_phase_tracer('ttfb', True))
+    config.on_request_end.append(_phase_tracer('ttfb', False))
+    return config
+
+
+def trace_configs(instrument):
+    """Return the trace configs of a session used with the given instrument.
+
+    @param instrument The theblues.instrumentation.Instrument, or None.
+    """
+    return [] if instrument is None else [trace_config()]
+
+
+def _phase_tracer(phase, start):
+    """Return a trace callback starting or ending a phase of the request."""
+    async def trace(session, context, params):
+        record = context.trace_request_ctx
+        if isinstance(record, RequestRecord):
+            if start:
+                record.start_phase(phase)
+            else:
+                record.end_phase(phase)
+    return trace
+
+
+def record_response(record, response, size=None):
+    """Store the status and size of an aiohttp response.
+
+    @param record The theblues.instrumentation.RequestRecord of the request,
+        or None if the request is not instrumented.
+    @param response The aiohttp response.
+    @param size The size of the response body, defaulting to its
+        Content-Length.
+    """
+    if record is not None:
+        record.status = response.status
+        record.size = response.content_length if size is None else size
+
+
+def client_timeout(timeout, deadline=None):
+    """Return the aiohttp.ClientTimeout matching a request timeout.
+
+    @param timeout The timeout in seconds, a (connect, read) tuple of
+        timeouts in seconds, or None for no timeout. A tuple limits the time
+        spent connecting and waiting for each read, as done by requests.
+    @param deadline The optional theblues.deadline.Deadline of the
+        operation, also limiting the overall time of a request whose timeout
+        is a tuple.
+    """
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(
+            total=remaining(deadline), sock_connect=connect, sock_read=read)
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def make_request(
+        url, method='GET', query=None, body=None, auth=None, macaroons=None,
+        timeout=10, session=None, retry=None, circuit_breaker=None,
+        deadline=None, instrument=None, client=None, template=None):
+    """Make a request with the provided data.
+
+    This is the asynchronous counterpart of theblues.utils.make_request, and
+    errors are reported in the same way.
+
+    @param url The url to make the request to.
+    @param method The HTTP request method (defaulting to "GET").
+    @param query A dict of the query key and values.
+    @param body The optional body as a string or as a JSON decoded dict.
+    @param auth The optional username and password as a tuple.
+    @param timeout The request timeout in seconds, or a (connect, read)
+        tuple of timeouts, defaulting to 10 seconds.
+    @param session The aiohttp session used to send the request. If not
+        provided, a session is created for this request only.
+    @param retry An optional theblues.retry.RetryPolicy used to retry the
+        request if it is idempotent and fails with a transient error.
+    @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+        rejecting the request while the host is unavailable.
+    @param deadline An optional theblues.deadline.Deadline limiting the
+        overall time spent on the request, including retries.
+    @param instrument An optional theblues.instrumentation.Instrument
+        notified before and after the request.
+    @param client The name of the client making the request, reported to
+        the instrument.
+    @param template The URL template of the request, reported to the
+        instrument.
+
+    POST/PUT request bodies are assumed to be in JSON format.
+    Return the response content as a JSON decoded object, or an empty dict.
+    Raise a ServerError if a problem occurs in the request/response process.
+    Raise a ValueError if invalid parameters are provided.
+    """
+    kwargs = {'headers': {}}
+    # Handle the request body.
+    if body is not None:
+        if isinstance(body, Mapping):
+            body = json.dumps(body)
+        kwargs['data'] = body
+    # Handle request methods.
+    if method in ('GET', 'HEAD'):
+        if query:
+            url = '{}?{}'.format(url, urlencode(query, True))
+    elif method in ('POST', 'PUT'):
+        kwargs['headers'] = {'Content-Type': 'application/json'}
+    else:
+        raise ValueError('invalid method {}'.format(method))
+    if macaroons is not None:
+        kwargs['headers']['Bakery-Protocol-Version'] = '1'
+        kwargs['headers']['Macaroons'] = macaroons
+    if auth is not None:
+        credentials = '{}:{}'.format(*auth).encode('utf-8')
+        kwargs['headers']['Authorization'] = 'Basic {}'.format(
+            base64.b64encode(credentials).decode('ascii'))
+    options = {
+        'retry': retry,
+        'circuit_breaker': circuit_breaker,
+        'deadline': deadline,
+    }
+    with instrumented(instrument, client, method, url, template) as record:
+        if session is None:
+            async with aiohttp.ClientSession(
+                    trace_configs=trace_configs(instrument)) as session:
+                return await _send(
+                    session, method, url, timeout, kwargs, options, record)
+        return await _send(
+            session, method, url, timeout, kwargs, options, record)
+
+
+async def _send(session, method, url, timeout, kwargs, options, record):
+    """Send the request and return the JSON decoded response.
+
+    See make_request for the errors raised.
+
+    @param options The retry, circuit_breaker and deadline make_request
+        options.
+    @param record The theblues.instrumentation.RequestRecord of the request,
+        or None.
+    """
+    deadline = options['deadline']
+    attempt = {'timeout': timeout}
+    request = guard(options['circuit_breaker'], url, counted(
+        record, lambda: session.request(
+            method, url, trace_request_ctx=record, **kwargs)))
+
+    def send():
+        # Every attempt only gets the time left before the deadline, and an
+        # expired deadline is raised before reaching the breaker.
+        attempt['timeout'] = request_timeout(timeout, deadline, url)
+        kwargs['timeout'] = client_timeout(attempt['timeout'], deadline)
+        return request()
+
+    # Perform the request.
+    try:
+        response = await send_request(
+            options['retry'], method, send, deadline=deadline)
+        async with response:
+            status = response.status
+            content = await response.read()
+            record_response(record, response, len(content))
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
+    except asyncio.TimeoutError:
+        raise timeout_error(url, attempt['timeout'])
+    except Exception as err:
+        msg = _server_error_message(url, err)
+        raise ServerError(msg)
+    # Handle error responses.
+    if status >= 400:
+        msg = _server_error_message(url, content.decode('utf-8', 'replace'))
+        raise ServerError(status, msg)
+    # Some requests just result in a status with no response body.
+    if not content:
+        return {}
+    # Assume the response body is a JSON encoded string.
+    try:
+        return json.loads(content.decode('utf-8'))
+    except Exception as err:
+        msg = 'Error decoding JSON response: {} message: {}'.format(url, err)
+        log.error(msg)
+        raise ServerError(msg)
@@ -0,0 +1,462 @@
+"""Response caches used by the clients.
+
+A cache is any object implementing the get, set and delete methods of
+MemoryCache. Keys are strings; values are opaque to the in-memory cache,
+while the disk cache stores bytes and CachedResponse values.
+"""
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 500 * 1024 * 1024
+# Entries are marked as used when they are read, by updating their
+# modification time, at most once per this many seconds.
+_TOUCH_INTERVAL = 60
+# Temporary files older than this many seconds were left by a writer which
+# died before renaming them, and are removed when evicting.
+_STALE_TEMPORARY_AGE = 3600
+_TEMPORARY_PREFIX = '.tmp-'
+
+_now = getattr(time, 'monotonic', time.time)
+
+# A response body stored with the validators used to revalidate it. Fresh
+# responses (e.g. stored when prefetching) are used without revalidation
+# for as long as they are cached.
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['content', 'encoding', 'etag', 'last_modified', 'fresh'])
+CachedResponse.__new__.__defaults__ = (False,)
+
+
+class MemoryCache(object):
+    """A thread safe in-memory cache with LRU eviction and per entry TTL.
+
+    The cache is bounded both by the number of entries and by the total size
+    of the stored values. Hits, misses and evictions are counted.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        """Initializer.
+
+        @param max_entries The maximum number of entries kept in the cache.
+        @param max_bytes The maximum total size in bytes of the cached values.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Map keys to (value, size, expiry time) tuples, least recently used
+        # first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored for the given key, or None.
+
+        @param key The cache key.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None \
+                    and entry[2] <= _now():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Move the entry to the most recently used end.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None, size=None):
+        """Store a value in the cache.
+
+        @param key The cache key.
+        @param value The value to store.
+        @param ttl The number of seconds the value is valid for, or None for
+            no expiry.
+        @param size The size of the value in bytes, defaulting to its length.
+        """
+        if size is None:
+            size = len(value)
+        expires = None if ttl is None else _now() + ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.evictions += 1
+
+    def delete(self, key):
+        """Remove the value stored for the given key, if any.
+
+        @param key The cache key.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def delete_prefix(self, prefix):
+        """Remove the values stored for all the keys with the given prefix.
+
+        @param prefix The prefix of the string keys to remove.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """Remove all the cached values."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return a dict of cache statistics."""
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class DiskCache(object):
+    """A cache storing responses in files, shared by several processes.
+
+    Entries are stored in the given directory under the SHA-256 digest of
+    their key, so that every process using the same directory shares them,
+    and a restarted process finds the cache already warm. Entries are
+    written to a temporary file which is then atomically renamed, so that
+    readers, which take no lock, never see a partially written entry.
+
+    The total size of the entries is bounded: once a process has written
+    about a tenth of max_bytes, it scans the directory and removes the least
+    recently used entries until the cache fits again. Reading an entry
+    updates its modification time, which records its last use, unless it
+    was updated less than a minute before, so that hot entries do not cost
+    a metadata write on every hit. Expiry times are
+    wall clock times, so that they are shared by all processes.
+
+    Values must be bytes or CachedResponse instances. Files are read and
+    written synchronously, including when used by the asyncio clients.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_DISK_MAX_BYTES):
+        """Initializer.
+
+        @param directory The directory where entries are stored, created if
+            it does not exist.
+        @param max_bytes The maximum total size in bytes of the entries.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The number of bytes written since the last eviction scan, forcing
+        # a scan on the first write.
+        self._written = max_bytes
+        self._lock = threading.Lock()
+        _makedirs(directory)
+
+    def __len__(self):
+        return len(self._scan())
+
+    def _path(self, key):
+        """Return the path of the file storing the entry for key."""
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        """Return the value stored for the given key, or None.
+
+        @param key The cache key.
+        """
+        path = self._path(key)
+        value, modified = self._read(path, key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is not None and time.time() - modified >= _TOUCH_INTERVAL:
+            # Record the access for the LRU eviction.
+            _ignore_missing(os.utime, path, None)
+        return value
+
+    def _read(self, path, key):
+        """Return the value stored in the given file and its modification
+        time, or None and None.
+
+        Expired, corrupted and colliding entries are treated as missing.
+        """
+        try:
+            with open(path, 'rb') as f:
+                modified = os.fstat(f.fileno()).st_mtime
+                line = f.readline()
+                try:
+                    header = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    header = None
+                if header is None or header.get('key') != key:
+                    return None, None
+                expires = header.get('expires')
+                if expires is not None and expires <= time.time():
+                    _ignore_missing(os.remove, path)
+                    return None, None
+                size = header['size']
+                content = f.read(size)
+        except EnvironmentError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None, None
+        if len(content) != size:
+            _ignore_missing(os.remove, path)
+            return None, None
+        if header.get('response'):
+            content = CachedResponse(
+                content=content, encoding=header.get('encoding'),
+                etag=header.get('etag'),
+                last_modified=header.get('last_modified'),
+                fresh=header.get('fresh', False))
+        return content, modified
+
+    def set(self, key, value, ttl=None, size=None):
+        """Store a value in the cache.
+
+        @param key The cache key.
+        @param value The value to store, either bytes or a CachedResponse.
+        @param ttl The number of seconds the value is valid for, or None for
+            no expiry.
+        @param size Ignored: the size of the stored file is used instead.
+        @raise TypeError if the value cannot be stored.
+        """
+        header = {'key': key}
+        if isinstance(value, CachedResponse):
+            header.update(
+                response=True, encoding=value.encoding, etag=value.etag,
+                last_modified=value.last_modified, fresh=value.fresh)
+            content = value.content
+        elif isinstance(value, bytes):
+            content = value
+        else:
+            raise TypeError(
+                'cannot cache values of type {}'.format(type(value)))
+        header['size'] = len(content)
+        if ttl is not None:
+            header['expires'] = time.time() + ttl
+        data = json.dumps(header).encode('utf-8') + b'\n' + content
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        _makedirs(os.path.dirname(path))
+        fd, temporary = tempfile.mkstemp(
+            prefix=_TEMPORARY_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            _replace(temporary, path)
+        except Exception:
+            _ignore_missing(os.remove, temporary)
+            raise
+        with self._lock:
+            self._written += len(data)
+            evict = self._written >= self.max_bytes // 10
+            if evict:
+                self._written = 0
+        if evict:
+            self.evict()
+
+    def delete(self, key):
+        """Remove the value stored for the given key, if any.
+
+        @param key The cache key.
+        """
+        _ignore_missing(os.remove, self._path(key))
+
+    def clear(self):
+        """Remove all the cached values."""
+        for path, _, _ in self._scan():
+            _ignore_missing(os.remove, path)
+
+    def evict(self):
+        """Remove the least recently used entries exceeding max_bytes."""
+        entries = self._scan(remove_stale=True)
+        total = sum(size for _, size, _ in entries)
+        # Sort by access time, least recently used first.
+        entries.sort(key=lambda entry: entry[2])
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            _ignore_missing(os.remove, path)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.evictions += evicted
+
+    def _scan(self, remove_stale=False):
+        """Return the (path, size, last access time) of all the entries.
+
+        @param remove_stale Whether to remove the temporary files left by
+            dead writers.
+        """
+        entries = []
+        now = time.time()
+        for name in _listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(_TEMPORARY_PREFIX):
+                if remove_stale:
+                    stat = _ignore_missing(os.stat, path)
+                    if stat is not None and (
+                            now - stat.st_mtime > _STALE_TEMPORARY_AGE):
+                        _ignore_missing(os.remove, path)
+                continue
+            for entry in _listdir(path):
+                entry_path = os.path.join(path, entry)
+                stat = _ignore_missing(os.stat, entry_path)
+                if stat is not None:
+                    entries.append((entry_path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def stats(self):
+        """Return a dict of cache statistics.
+
+        The entries and bytes are those of the whole cache directory, while
+        hits, misses and evictions are those of this process.
+        """
+        entries = self._scan()
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _makedirs(path):
+    """Create the given directory and its parents, if they do not exist."""
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def _listdir(path):
+    """Return the names of the files in a directory, which may be missing.
+    """
+    try:
+        return os.listdir(path)
+    except OSError as err:
+        if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return []
+
+
+def _ignore_missing(func, path, *args):
+    """Call func(path, *args), ignoring errors due to a missing file.
+
+    Files may be removed at any time by other processes.
+
+    @return The result of the call, or None if the file is missing.
+    """
+    try:
+        return func(path, *args)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+# Atomically replace a file, including on Windows with Python 3.
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ResultCacheMixin(object):
+    """Memoize the parsed results of the requests made by a client.
+
+    Results are kept in a bounded MemoryCache keyed by request URL, so that
+    repeated calls skip both the request and the parsing of its response.
+    Classes using this mixin call _init_result_cache from their initializer.
+    """
+
+    def _init_result_cache(self, cache_size):
+        """Set up the cache.
+
+        @param cache_size The maximum number of results kept, or 0 to
+            disable caching.
+        """
+        self.cache = None
+        if cache_size:
+            self.cache = MemoryCache(max_entries=cache_size)
+
+    def _cached_result(self, url):
+        """Return the result cached for the given URL, or None.
+
+        @param url The URL of the request.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(url)
+
+    def _cache_result(self, url, result, ttl, size=1):
+        """Store the result of a request and return it.
+
+        @param url The URL of the request.
+        @param result The parsed result, which must not be None.
+        @param ttl The number of seconds the result is valid for, or None for
+            no expiry.
+        @param size The approximate size of the result in bytes.
+        """
+        if self.cache is not None:
+            self.cache.set(url, result, ttl=ttl, size=size)
+        return result
+
+
+def cache_key(url, macaroons=None):
+    """Return the cache key for a response.
+
+    The query parameters are sorted, so that requests including the same
+    set of metadata or ids in a different order share the same key.
+    Responses depend on the credentials used to query them, so a digest of
+    the macaroons, if any, is part of the key.
+
+    @param url The full url of the request.
+    @param macaroons The macaroons sent with the request.
+    """
+    if '?' in url:
+        path, query = url.split('?', 1)
+        url = '{}?{}'.format(path, '&'.join(sorted(query.split('&'))))
+    if not macaroons:
+        return url
+    digest = hashlib.sha1(macaroons.encode('utf-8')).hexdigest()
+    return '{} {}'.format(url, digest)
@@ -1,92 +1,384 @@
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import re
 try:
     from urllib import urlencode
 except:
     from urllib.parse import urlencode
 
-import requests
 from requests.exceptions import (
     HTTPError,
     RequestException,
     Timeout,
     )
 
+from .cache import (
+    cache_key,
+    CachedResponse,
+)
 from .errors import (
     EntityNotFound,
     ServerError,
     )
-from theblues.utils import DEFAULT_TIMEOUT
+from .jsonstream import iter_decode
+from .circuit import guard
+from .deadline import request_timeout
+from .instrumentation import (
+    counted,
+    instrumented,
+)
+from .retry import send_request
+from theblues.utils import (
+    bulk_fetch,
+    bulk_results,
+    BulkResults,
+    DEFAULT_POOL_CONNECTIONS,
+    DEFAULT_POOL_MAXSIZE,
+    DEFAULT_TIMEOUT,
+    make_session,
+    OperationTimeoutsMixin,
+    record_response,
+    SingleFlight,
+)
+
+
+# How long in seconds cached metadata is kept, for ids which may refer to a
+# different revision over time (e.g. "mysql" or "precise/mysql").
+DEFAULT_CACHE_TTL = 60
+# Ids with a revision (e.g. "precise/mysql-1") always refer to the same
+# entity, so their metadata is kept until evicted.
+DEFAULT_REVISIONED_CACHE_TTL = None
+_REVISION_RE = re.compile(r'-\d+$')
+# The default size in bytes of the chunks read when streaming downloads.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# The size in bytes of the chunks read when incrementally decoding JSON
+# responses: smaller chunks deliver the first results sooner.
+JSON_CHUNK_SIZE = 8 * 1024
+# Bulk metadata requests are split so that each request includes at most
+# DEFAULT_BULK_MAX_IDS ids and its URL stays below DEFAULT_BULK_MAX_URL_LENGTH
+# characters. Up to DEFAULT_BULK_WORKERS requests are sent concurrently.
+DEFAULT_BULK_MAX_IDS = 100
+DEFAULT_BULK_MAX_URL_LENGTH = 4000
+DEFAULT_BULK_WORKERS = 4
+# The number of entities requested per page by iter_list and iter_search.
+DEFAULT_PAGE_SIZE = 100
+# The URL templates of the requests reported to instruments, by operation.
+# Metadata requests are handled separately, see CharmStore._url_template.
+_URL_TEMPLATES = {
+    'search': '/search',
+    'list': '/list',
+    'archive': '/{id}/archive',
+    'file': '/{id}/archive/{path}',
+    'resource': '/{id}/resource/{name}/{revision}',
+    'icon': '/{id}/icon.svg',
+    'diagram': '/{id}/diagram.svg',
+    'readme': '/{id}/readme',
+    'debug': '/debug/status',
+    'macaroon': '/macaroon',
+}
+_META_RE = re.compile(r'/meta/([^/?]+)')
+
+
+class CharmStore(OperationTimeoutsMixin):
+    """A connection to the charmstore."""
 
+    # The operations whose timeout can be overridden, named after the
+    # charmstore endpoints they query.
+    timeout_operations = (
+        'meta', 'search', 'list', 'archive', 'file', 'resource', 'icon',
+        'diagram', 'readme', 'debug', 'macaroon')
 
-class CharmStore(object):
-    """A connection to the charmstore."""
+    # The client name reported to instruments.
+    client_name = 'charmstore'
 
     def __init__(self, url, macaroons=None, timeout=DEFAULT_TIMEOUT,
-                 verify=True):
+                 verify=True, session=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True,
+                 cache=None, cache_ttl=DEFAULT_CACHE_TTL,
+                 revisioned_cache_ttl=DEFAULT_REVISIONED_CACHE_TTL,
+                 bulk_max_ids=DEFAULT_BULK_MAX_IDS,
+                 bulk_max_url_length=DEFAULT_BULK_MAX_URL_LENGTH,
+                 bulk_workers=DEFAULT_BULK_WORKERS, coalesce=True,
+                 retry=None, circuit_breaker=None, timeouts=None,
+                 instrument=None):
         """Initializer.
 
         @param url The url to the charmstore API.
         @param macaroons The optional discharged macaroon allowing access to
             authenticated queries against the charmstore.
         @param timeout How long to wait in seconds before timing out a request;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
         @param verify Whether to verify the certificate for the charmstore API
             host.
+        @param session An optional requests session to use for all requests.
+            If not provided, a pooled session is created and owned by this
+            instance, and the pool parameters below are used to configure it.
+        @param pool_connections The number of per-host connection pools.
+        @param pool_maxsize The maximum number of connections kept open to a
+            single host.
+        @param keep_alive Whether connections are reused across requests.
+        @param cache An optional cache (see theblues.cache.MemoryCache, or
+            theblues.cache.DiskCache to share it across processes) used
+            to store entity metadata and config responses.
+        @param cache_ttl How long in seconds cached responses are valid for
+            ids without a revision or when a channel is specified.
+        @param revisioned_cache_ttl How long in seconds cached responses are
+            valid for ids including a revision; a value of None means until
+            evicted. Note that mutable metadata like stats is then not
+            refreshed.
+        @param bulk_max_ids The maximum number of ids included in a single
+            bulk metadata request.
+        @param bulk_max_url_length The maximum length of the URL of a bulk
+            metadata request.
+        @param bulk_workers How many bulk metadata requests can be sent
+            concurrently.
+        @param coalesce Whether identical requests made concurrently by
+            several threads share a single request to the charmstore.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the charmstore is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations (see timeout_operations), e.g. {'meta': 1,
+            'archive': (3.05, 60)} so that metadata lookups fail fast while
+            downloads are given more time.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
         """
         super(CharmStore, self).__init__()
         self.url = url
         self.verify = verify
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
         self.macaroons = macaroons
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.revisioned_cache_ttl = revisioned_cache_ttl
+        self.bulk_max_ids = bulk_max_ids
+        self.bulk_max_url_length = bulk_max_url_length
+        self.bulk_workers = bulk_workers
+        self.single_flight = SingleFlight() if coalesce else None
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self._owns_session = session is None
+        if session is None:
+            session = make_session(
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                keep_alive=keep_alive)
+        self.session = session
+
+    def close(self):
+        """Close the pooled connections held by this charmstore client.
+
+        A session provided by the caller is left open.
+        """
+        if self._owns_session:
+            self.session.close()
 
-    def _get(self, url):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get(self, url, headers=None, stream=False, deadline=None,
+             operation=None):
         """Make a get request against the charmstore.
 
         This method is used by other API methods to standardize querying.
 
         @param url The full url to query
             (e.g. https://api.jujucharms.com/charmstore/v4/macaroon)
+        @param headers Optional additional request headers.
+        @param stream Whether to defer downloading the response body; the
+            caller is then responsible for closing the response.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request (see
+            timeout_operations), used to choose its timeout.
         """
+        if self.single_flight is None or stream or deadline is not None:
+            # A call in flight may be bound by another deadline.
+            return self._send_get(url, headers=headers, stream=stream,
+                                  deadline=deadline, operation=operation)
+        # Identical requests in flight share the same response.
+        key = (cache_key(url, self.macaroons),
+               tuple(sorted((headers or {}).items())))
+        return self.single_flight.do(
+            key, self._send_get, url, headers=headers, operation=operation)
+
+    def _send_get(self, url, headers=None, stream=False, deadline=None,
+                  operation=None):
+        """Send a get request to the charmstore, see _get."""
         if self.macaroons is None or len(self.macaroons) == 0:
             cookies = {}
         else:
             cookies = dict([('macaroon-storefront', self.macaroons)])
-        try:
-            response = requests.get(url, verify=self.verify, cookies=cookies,
-                                    timeout=self.timeout)
-            response.raise_for_status()
-            return response
-        except HTTPError as exc:
-            if exc.response.status_code in (404, 407):
-                raise EntityNotFound(url)
-            else:
+        timeout = self._timeout(operation)
+        attempt = {'timeout': timeout}
+        with instrumented(self.instrument, self.client_name, 'GET', url,
+                          self._url_template(url, operation)) as record:
+            get = guard(self.circuit_breaker, url, counted(
+                record, lambda: self.session.get(
+                    url, verify=self.verify, cookies=cookies,
+                    timeout=attempt['timeout'], headers=headers,
+                    stream=stream)))
+
+            def send():
+                # An expired deadline is raised before reaching the breaker.
+                attempt['timeout'] = request_timeout(timeout, deadline, url)
+                return get()
+            try:
+                response = send_request(
+                    self.retry, 'GET', send, deadline=deadline)
+                record_response(record, response, stream=stream)
+                response.raise_for_status()
+                return response
+            except HTTPError as exc:
+                if exc.response.status_code in (404, 407):
+                    raise EntityNotFound(url)
+                else:
+                    message = ('Error during request: {url} '
+                               'status code:({code}) '
+                               'message: {message}').format(
+                                   url=url,
+                                   code=exc.response.status_code,
+                                   message=exc.response.text)
+                    logging.error(message)
+                    raise ServerError(exc.response.status_code,
+                                      exc.response.text,
+                                      message)
+            except Timeout:
+                message = 'Request timed out: {url} timeout: {timeout}'
+                message = message.format(
+                    url=url, timeout=attempt['timeout'])
+                logging.error(message)
+                raise ServerError(message)
+            except RequestException as exc:
                 message = ('Error during request: {url} '
-                           'status code:({code}) '
                            'message: {message}').format(
                                url=url,
-                               code=exc.response.status_code,
-                               message=exc.response.text)
+                               message=exc.message)
                 logging.error(message)
-                raise ServerError(exc.response.status_code,
-                                  exc.response.text,
-                                  message)
-        except Timeout:
-            message = 'Request timed out: {url} timeout: {timeout}'
-            message = message.format(url=url, timeout=self.timeout)
-            logging.error(message)
-            raise ServerError(message)
-        except RequestException as exc:
-            message = ('Error during request: {url} '
-                       'message: {message}').format(
-                           url=url,
-                           message=exc.message)
-            logging.error(message)
-            raise ServerError(exc.args[0][1].errno,
-                              exc.args[0][1].strerror,
-                              exc.message)
+                raise ServerError(exc.args[0][1].errno,
+                                  exc.args[0][1].strerror,
+                                  exc.message)
 
-    def _meta(self, entity_id, includes, channel=None):
-        '''Retrieve metadata about an entity in the charmstore.
+    def _url_template(self, url, operation):
+        """Return the template of a URL, as reported to the instrument.
+
+        @param url The full url queried.
+        @param operation The name of the operation making the request.
+        @return The template relative to the API root, e.g.
+            "/{id}/meta/any", or None if the operation is unknown.
+        """
+        if operation != 'meta':
+            return _URL_TEMPLATES.get(operation)
+        path = url[len(self.url):]
+        match = _META_RE.search(path)
+        if match is None:
+            return None
+        # Bulk requests are sent to /meta/..., others to /{id}/meta/...
+        prefix = '' if match.start() == 0 else '/{id}'
+        return '{}/meta/{}'.format(prefix, match.group(1))
+
+    def _get_cached_json(self, url, entity_id, channel=None, deadline=None):
+        """Make a get request and return the JSON decoded response.
+
+        If a cache is configured, the response is looked up in the cache
+        first, and stored there otherwise.
+
+        @param url The full url to query.
+        @param entity_id The id of the entity the url refers to, used to
+            decide how long the response is cached for.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        if self.cache is None:
+            return self._get(url, deadline=deadline, operation='meta').json()
+        key = cache_key(url, self.macaroons)
+        content = self.cache.get(key)
+        if content is None:
+            content = self._get(
+                url, deadline=deadline, operation='meta').content
+            self.cache.set(
+                key, content, ttl=self._cache_ttl(entity_id, channel))
+        return json.loads(content.decode('utf-8'))
+
+    def _get_revalidated(self, url, deadline=None, operation=None):
+        """Make a get request, revalidating the cached response if any.
+
+        If a cache is configured, response bodies are stored along with their
+        ETag and Last-Modified validators. Later requests for the same url
+        are then conditional, and the stored body is reused when the
+        charmstore replies 304 Not Modified. Fresh cached responses, as
+        stored by theblues.prefetch, are returned without any request.
+
+        @param url The full url to query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        @return A (content, encoding) tuple, where encoding is the charset of
+            the response or None if not specified.
+        """
+        if self.cache is None:
+            response = self._get(
+                url, deadline=deadline, operation=operation)
+            return response.content, response.encoding
+        key = cache_key(url, self.macaroons)
+        cached = self.cache.get(key)
+        if cached is not None and cached.fresh:
+            return cached.content, cached.encoding
+        headers = {}
+        if cached is not None:
+            if cached.etag is not None:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified is not None:
+                headers['If-Modified-Since'] = cached.last_modified
+        response = self._get(
+            url, headers=headers, deadline=deadline, operation=operation)
+        if response.status_code == 304 and cached is not None:
+            return cached.content, cached.encoding
+        cached = CachedResponse(
+            content=response.content,
+            encoding=response.encoding,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'))
+        if cached.etag is not None or cached.last_modified is not None:
+            self.cache.set(key, cached, size=len(cached.content))
+        return cached.content, cached.encoding
+
+    def _get_revalidated_text(self, url, deadline=None, operation=None):
+        """Make a get request and return the decoded response body.
+
+        See _get_revalidated.
+
+        @param url The full url to query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        """
+        content, encoding = self._get_revalidated(
+            url, deadline=deadline, operation=operation)
+        return content.decode(encoding or 'utf-8', 'replace')
+
+    def _cache_ttl(self, entity_id, channel=None):
+        """Return how long the metadata for the given entity is cached for.
+
+        @param entity_id The entity's id either as a reference or a string.
+        @param channel Optional channel name.
+        """
+        if channel is None and _REVISION_RE.search(_get_path(entity_id)):
+            return self.revisioned_cache_ttl
+        return self.cache_ttl
+
+    def _meta_url(self, entity_id, includes, channel=None):
+        '''Generate the URL retrieving metadata about an entity.
 
         @param entity_id The ID either a reference or a string of the entity
                to get.
@@ -103,65 +395,188 @@ class CharmStore(object):
                                              urlencode(queries))
         else:
             url = '{}/{}/meta/any'.format(self.url, _get_path(entity_id))
-        data = self._get(url)
-        return data.json()
+        return url
+
+    def _meta(self, entity_id, includes, channel=None, deadline=None):
+        '''Retrieve metadata about an entity in the charmstore.
+
+        @param entity_id The ID either a reference or a string of the entity
+               to get.
+        @param includes Which metadata fields to include in the response.
+        @param channel Optional channel name, e.g. `stable`.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._meta_url(entity_id, includes, channel=channel)
+        return self._get_cached_json(
+            url, entity_id, channel=channel, deadline=deadline)
 
-    def entity(self, entity_id, get_files=False, channel=None):
+    def entity(self, entity_id, get_files=False, channel=None, deadline=None):
         '''Get the default data for any entity (e.g. bundle or charm).
 
         @param entity_id The entity's id either as a reference or a string
         @param get_files Whether to fetch the files for the charm or not.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return self._meta(entity_id, _entity_includes(get_files),
+                          channel=channel, deadline=deadline)
+
+    def _bulk_meta_urls(self, entity_ids, includes):
+        '''Generate the URLs retrieving metadata about many entities.
+
+        The ids are split into chunks so that each URL includes at most
+        bulk_max_ids ids and is at most bulk_max_url_length characters long.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param includes Which metadata fields to include in the response.
+        @return A list of (ids, url) tuples, ids being a list of strings.
+        '''
+        base = '{}/meta/any?{}'.format(
+            self.url, ''.join('include={}&'.format(i) for i in includes))
+        chunks = []
+        ids, url = [], base
+        for path in map(_get_path, entity_ids):
+            query = 'id={}&'.format(path)
+            # The trailing '&' is not part of the final URL.
+            length = len(url) + len(query) - 1
+            if ids and (len(ids) >= self.bulk_max_ids or
+                        length > self.bulk_max_url_length):
+                chunks.append((ids, url[:-1]))
+                ids, url = [], base
+            ids.append(path)
+            url += query
+        if ids:
+            chunks.append((ids, url[:-1]))
+        return chunks
+
+    def _bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Retrieve metadata about many entities.
+
+        Requests are split into chunks (see _bulk_meta_urls) which are sent
+        concurrently, up to bulk_workers at a time.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param includes Which metadata fields to include in the response.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A BulkResults instance.
+        @raise EntityNotFound or ServerError if every request failed.
+        '''
+        chunks = self._bulk_meta_urls(entity_ids, includes)
+        responses = bulk_fetch(
+            [url for _, url in chunks],
+            lambda url: self._get(
+                url, deadline=deadline, operation='meta').json(),
+            self.bulk_workers)
+        return _merge_bulk_responses(chunks, responses)
+
+    def bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Get metadata about many entities.
+
+        Large lists of ids are split into several concurrent requests, see
+        _bulk_meta.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param includes Which metadata fields to include in the response
+            (e.g. ['charm-metadata', 'stats']).
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A BulkResults dict keyed by entity id, whose errors attribute
+            maps the ids which could not be retrieved to the error raised.
+        @raise EntityNotFound or ServerError if every request failed.
         '''
-        includes = [
-            'bundle-machine-count',
-            'bundle-metadata',
-            'bundle-unit-count',
-            'bundles-containing',
-            'charm-config',
-            'charm-metadata',
-            'common-info',
-            'extra-info',
-            'owner',
-            'revision-info',
-            'published',
-            'stats',
-            'resources',
-            'supported-series',
-            'terms'
-        ]
-        if get_files:
-            includes.append('manifest')
-        return self._meta(entity_id, includes, channel=channel)
-
-    def entities(self, entity_ids):
+        if not includes:
+            raise ValueError('at least one include is required')
+        return self._bulk_meta(entity_ids, includes, deadline=deadline)
+
+    def stream_bulk_meta(self, entity_ids, includes, deadline=None):
+        '''Get metadata about many entities, decoding responses as they come.
+
+        Unlike bulk_meta, the chunked requests (see _bulk_meta_urls) are sent
+        in turn and each entity is yielded as soon as it has been decoded.
+        Chunks whose entities are all missing are skipped.
+
+        @param entity_ids A list of entity ids either as strings or references.
+        @param includes Which metadata fields to include in the response
+            (e.g. ['charm-metadata', 'stats']).
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A generator yielding (entity id, metadata) tuples.
+        @raise ServerError if a request fails.
+        '''
+        if not includes:
+            raise ValueError('at least one include is required')
+        urls = [url for _, url in self._bulk_meta_urls(entity_ids, includes)]
+        return self._stream_json_chunks(urls, deadline=deadline)
+
+    def _stream_json_chunks(self, urls, deadline=None):
+        '''Yield the members of the JSON objects at the given URLs.
+
+        @param urls The URLs to query in turn, missing ones being skipped.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        '''
+        for url in urls:
+            try:
+                for item in self._stream_json(
+                        url, deadline=deadline, operation='meta'):
+                    yield item
+            except EntityNotFound:
+                continue
+
+    def _stream_json(self, url, key=None, deadline=None, operation=None):
+        '''Make a get request and incrementally decode the JSON response.
+
+        See theblues.jsonstream.StreamDecoder for a description of what is
+        yielded.
+
+        @param url The full url to query.
+        @param key The optional name of the array whose items are yielded.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        '''
+        return iter_decode(self._stream(
+            url, JSON_CHUNK_SIZE, deadline=deadline, operation=operation),
+            key=key)
+
+    def entities(self, entity_ids, deadline=None):
         '''Get the default data for entities.
 
+        Large lists of ids are split into several requests, see _bulk_meta.
+
         @param entity_ids A list of entity ids either as strings or references.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A BulkResults dict keyed by entity id, whose errors attribute
+            maps the ids which could not be retrieved to the error raised.
+        @raise EntityNotFound or ServerError if every request failed.
         '''
-        url = '%s/meta/any?include=id&' % self.url
-        for entity_id in entity_ids:
-            url += 'id=%s&' % _get_path(entity_id)
-        # Remove the trailing '&' from the URL.
-        url = url[:-1]
-        data = self._get(url)
-        return data.json()
+        return self._bulk_meta(entity_ids, ['id'], deadline=deadline)
 
-    def bundle(self, bundle_id, channel=None):
+    def bundle(self, bundle_id, channel=None, deadline=None):
         '''Get the default data for a bundle.
 
         @param bundle_id The bundle's id.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         '''
-        return self.entity(bundle_id, get_files=True, channel=channel)
+        return self.entity(bundle_id, get_files=True, channel=channel,
+                           deadline=deadline)
 
-    def charm(self, charm_id, channel=None):
+    def charm(self, charm_id, channel=None, deadline=None):
         '''Get the default data for a charm.
 
         @param charm_id The charm's id.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         '''
-        return self.entity(charm_id, get_files=True, channel=channel)
+        return self.entity(charm_id, get_files=True, channel=channel,
+                           deadline=deadline)
 
     def charm_icon_url(self, charm_id, channel=None):
         '''Generate the path to the icon for charms.
@@ -173,25 +588,29 @@ class CharmStore(object):
         url = '{}/{}/icon.svg'.format(self.url, _get_path(charm_id))
         return _add_channel(url, channel)
 
-    def charm_icon(self, charm_id, channel=None):
+    def charm_icon(self, charm_id, channel=None, deadline=None):
         '''Get the charm icon.
 
         @param charm_id The ID of the charm.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         '''
         url = self.charm_icon_url(charm_id, channel=channel)
-        response = self._get(url)
-        return response.content
+        return self._get_revalidated(
+            url, deadline=deadline, operation='icon')[0]
 
-    def bundle_visualization(self, bundle_id, channel=None):
+    def bundle_visualization(self, bundle_id, channel=None, deadline=None):
         '''Get the bundle visualization.
 
         @param bundle_id The ID of the bundle.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         '''
         url = self.bundle_visualization_url(bundle_id, channel=channel)
-        response = self._get(url)
-        return response.content
+        return self._get_revalidated(
+            url, deadline=deadline, operation='diagram')[0]
 
     def bundle_visualization_url(self, bundle_id, channel=None):
         '''Generate the path to the visualization for bundles.
@@ -212,15 +631,17 @@ class CharmStore(object):
         url = '{}/{}/readme'.format(self.url, _get_path(entity_id))
         return _add_channel(url, channel)
 
-    def entity_readme_content(self, entity_id, channel=None):
+    def entity_readme_content(self, entity_id, channel=None, deadline=None):
         '''Get the readme for an entity.
 
         @entity_id The id of the entity (i.e. charm, bundle).
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         '''
         readme_url = self.entity_readme_url(entity_id, channel=channel)
-        response = self._get(readme_url)
-        return response.text
+        return self._get_revalidated_text(
+            readme_url, deadline=deadline, operation='readme')
 
     def archive_url(self, entity_id, channel=None):
         '''Generate a URL for the archive of an entity..
@@ -243,8 +664,32 @@ class CharmStore(object):
                                         filename)
         return _add_channel(url, channel)
 
+    def _manifest_url(self, entity_id, channel=None):
+        '''Generate the URL of the manifest of files for an entity.
+
+        @param entity_id The id of the entity to get the manifest for.
+        @param channel Optional channel name.
+        '''
+        url = '{}/{}/meta/manifest'.format(self.url, _get_path(entity_id))
+        return _add_channel(url, channel)
+
+    def _manifest_files(self, entity_id, manifest, channel=None):
+        '''Return a dictionary of filenames and urls for a manifest.
+
+        @param entity_id The id of the entity the manifest belongs to.
+        @param manifest The manifest of files for the entity.
+        @param channel Optional channel name.
+        '''
+        files = {}
+        for f in manifest:
+            manifest_name = f['Name']
+            file_url = self.file_url(_get_path(entity_id), manifest_name,
+                                     channel=channel)
+            files[manifest_name] = file_url
+        return files
+
     def files(self, entity_id, manifest=None, filename=None,
-              read_file=False, channel=None):
+              read_file=False, channel=None, deadline=None):
         '''
         Get the files or file contents of a file for an entity.
 
@@ -265,27 +710,22 @@ class CharmStore(object):
         @param read_file Whether to get the url for the file or the file
             contents.
         @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
         '''
         if manifest is None:
-            manifest_url = '{}/{}/meta/manifest'.format(self.url,
-                                                        _get_path(entity_id))
-            manifest_url = _add_channel(manifest_url, channel)
-            manifest = self._get(manifest_url)
+            manifest = self._get(self._manifest_url(entity_id, channel),
+                                 deadline=deadline, operation='meta')
             manifest = manifest.json()
-        files = {}
-        for f in manifest:
-            manifest_name = f['Name']
-            file_url = self.file_url(_get_path(entity_id), manifest_name,
-                                     channel=channel)
-            files[manifest_name] = file_url
+        files = self._manifest_files(entity_id, manifest, channel)
 
         if filename:
             file_url = files.get(filename, None)
             if file_url is None:
                 raise EntityNotFound(entity_id, filename)
             if read_file:
-                data = self._get(file_url)
-                return data.text
+                return self._get_revalidated_text(
+                    file_url, deadline=deadline, operation='file')
             else:
                 return file_url
         else:
@@ -304,30 +744,216 @@ class CharmStore(object):
                                              name,
                                              revision)
 
-    def config(self, charm_id, channel=None):
+    def _stream(self, url, chunk_size=DEFAULT_CHUNK_SIZE, deadline=None,
+                operation=None):
+        """Make a get request and yield the response body in chunks.
+
+        @param url The full url to query.
+        @param chunk_size The maximum size in bytes of the yielded chunks.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        """
+        response = self._get(
+            url, stream=True, deadline=deadline, operation=operation)
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if deadline is not None:
+                    deadline.check(url)
+                yield chunk
+        except RequestException as exc:
+            message = ('Error during download: {url} '
+                       'message: {message}').format(url=url, message=exc)
+            logging.error(message)
+            raise ServerError(message)
+        finally:
+            response.close()
+
+    def _download(self, url, destination, chunk_size=DEFAULT_CHUNK_SIZE,
+                  hash_name=None, deadline=None, operation=None):
+        """Download the response body of a get request.
+
+        @param url The full url to query.
+        @param destination A path or a binary file like object the body is
+            written to. A partially written path is removed on failure.
+        @param chunk_size The size in bytes of the chunks read at a time.
+        @param hash_name Optionally, the name of a hashlib algorithm (e.g.
+            "sha384") used to hash the body as it is downloaded.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        @return The hex digest of the body if hash_name is provided, or None.
+        """
+        hasher = None if hash_name is None else hashlib.new(hash_name)
+        if hasattr(destination, 'write'):
+            out = destination
+        else:
+            out = open(destination, 'wb')
+        try:
+            for chunk in self._stream(url, chunk_size=chunk_size,
+                                      deadline=deadline, operation=operation):
+                out.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        except Exception:
+            if out is not destination:
+                out.close()
+                os.remove(destination)
+            raise
+        if out is not destination:
+            out.close()
+        return None if hasher is None else hasher.hexdigest()
+
+    def stream_archive(self, entity_id, channel=None,
+                       chunk_size=DEFAULT_CHUNK_SIZE, deadline=None):
+        '''Yield the archive of an entity in chunks of bytes.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param channel Optional channel name.
+        @param chunk_size The maximum size in bytes of the yielded chunks.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return self._stream(
+            self.archive_url(entity_id, channel=channel), chunk_size,
+            deadline=deadline, operation='archive')
+
+    def download_archive(self, entity_id, destination, channel=None,
+                         chunk_size=DEFAULT_CHUNK_SIZE, hash_name=None,
+                         deadline=None):
+        '''Download the archive of an entity without buffering it in memory.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param destination A path or a binary file like object.
+        @param channel Optional channel name.
+        @param chunk_size The size in bytes of the chunks read at a time.
+        @param hash_name Optional hashlib algorithm name, e.g. "sha384".
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The hex digest of the archive if hash_name is provided.
+        '''
+        return self._download(
+            self.archive_url(entity_id, channel=channel), destination,
+            chunk_size=chunk_size, hash_name=hash_name, deadline=deadline,
+            operation='archive')
+
+    def stream_file(self, entity_id, filename, channel=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, deadline=None):
+        '''Yield the contents of a file in an archive in chunks of bytes.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param filename The name of the file in the archive.
+        @param channel Optional channel name.
+        @param chunk_size The maximum size in bytes of the yielded chunks.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return self._stream(
+            self.file_url(entity_id, filename, channel=channel), chunk_size,
+            deadline=deadline, operation='file')
+
+    def download_file(self, entity_id, filename, destination, channel=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE, hash_name=None,
+                      deadline=None):
+        '''Download a file in an archive without buffering it in memory.
+
+        @param entity_id The ID of the entity as a string or reference.
+        @param filename The name of the file in the archive.
+        @param destination A path or a binary file like object.
+        @param channel Optional channel name.
+        @param chunk_size The size in bytes of the chunks read at a time.
+        @param hash_name Optional hashlib algorithm name, e.g. "sha384".
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The hex digest of the file if hash_name is provided.
+        '''
+        return self._download(
+            self.file_url(entity_id, filename, channel=channel), destination,
+            chunk_size=chunk_size, hash_name=hash_name, deadline=deadline,
+            operation='file')
+
+    def stream_resource(self, entity_id, name, revision,
+                        chunk_size=DEFAULT_CHUNK_SIZE, deadline=None):
+        '''Yield the contents of a resource in chunks of bytes.
+
+        @param entity_id The id of the entity the resource belongs to.
+        @param name The name of the resource.
+        @param revision The revision of the resource.
+        @param chunk_size The maximum size in bytes of the yielded chunks.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        return self._stream(
+            self.resource_url(entity_id, name, revision), chunk_size,
+            deadline=deadline, operation='resource')
+
+    def download_resource(self, entity_id, name, revision, destination,
+                          chunk_size=DEFAULT_CHUNK_SIZE, hash_name=None,
+                          deadline=None):
+        '''Download a resource without buffering it in memory.
+
+        @param entity_id The id of the entity the resource belongs to.
+        @param name The name of the resource.
+        @param revision The revision of the resource.
+        @param destination A path or a binary file like object.
+        @param chunk_size The size in bytes of the chunks read at a time.
+        @param hash_name Optional hashlib algorithm name, e.g. "sha384" as
+            used by the charmstore for resource fingerprints.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return The hex digest of the resource if hash_name is provided.
+        '''
+        return self._download(
+            self.resource_url(entity_id, name, revision), destination,
+            chunk_size=chunk_size, hash_name=hash_name, deadline=deadline,
+            operation='resource')
+
+    def config(self, charm_id, channel=None, deadline=None):
         '''Get the config data for a charm.
 
+        @param charm_id The charm's id.
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._config_url(charm_id, channel=channel)
+        return self._get_cached_json(
+            url, charm_id, channel=channel, deadline=deadline)
+
+    def _config_url(self, charm_id, channel=None):
+        '''Generate the URL of the config data for a charm.
+
         @param charm_id The charm's id.
         @param channel Optional channel name.
         '''
         url = '{}/{}/meta/charm-config'.format(self.url, _get_path(charm_id))
-        data = self._get(_add_channel(url, channel))
-        return data.json()
+        return _add_channel(url, channel)
 
-    def entityId(self, partial, channel=None):
+    def entityId(self, partial, channel=None, deadline=None):
         '''Get an entity's full id provided a partial one.
 
         Raises EntityNotFound if partial cannot be resolved.
+        @param partial The partial id (e.g. mysql, precise/mysql).
+        @param channel Optional channel name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._entity_id_url(partial, channel=channel)
+        return self._get_cached_json(
+            url, partial, channel=channel, deadline=deadline)['Id']
+
+    def _entity_id_url(self, partial, channel=None):
+        '''Generate the URL resolving a partial entity id.
+
         @param partial The partial id (e.g. mysql, precise/mysql).
         @param channel Optional channel name.
         '''
         url = '{}/{}/meta/any'.format(self.url, _get_path(partial))
-        data = self._get(_add_channel(url, channel))
-        return data.json()['Id']
+        return _add_channel(url, channel)
 
     def search(self, text, includes=None, doc_type=None, limit=None,
                autocomplete=False, promulgated_only=False, tags=None,
-               sort=None, owner=None, series=None):
+               sort=None, owner=None, series=None, deadline=None):
         '''
         Search for entities in the charmstore.
 
@@ -344,6 +970,67 @@ class CharmStore(object):
             include entities that owner can view.
         @param series The series to filter; can be a list of series or a
             single series.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._search_url(
+            text, includes=includes, doc_type=doc_type, limit=limit,
+            autocomplete=autocomplete, promulgated_only=promulgated_only,
+            tags=tags, sort=sort, owner=owner, series=series)
+        data = self._get(url, deadline=deadline, operation='search')
+        return data.json()['Results']
+
+    def iter_search(self, text, includes=None, doc_type=None,
+                    autocomplete=False, promulgated_only=False, tags=None,
+                    sort=None, owner=None, series=None,
+                    page_size=DEFAULT_PAGE_SIZE, deadline=None):
+        '''Lazily iterate over the entities matching a search.
+
+        Results are requested page_size entities at a time, the next page
+        being fetched in the background while the current one is consumed.
+        See the search method for a description of the other parameters.
+
+        @param page_size The number of entities requested per page.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A generator yielding the entities one at a time.
+        '''
+        def page_url(skip):
+            return self._search_url(
+                text, includes=includes, doc_type=doc_type, limit=page_size,
+                autocomplete=autocomplete, promulgated_only=promulgated_only,
+                tags=tags, sort=sort, owner=owner, series=series, skip=skip)
+        return self._iter_pages(
+            page_url, page_size, deadline=deadline, operation='search')
+
+    def stream_search(self, text, includes=None, doc_type=None, limit=None,
+                      autocomplete=False, promulgated_only=False, tags=None,
+                      sort=None, owner=None, series=None, deadline=None):
+        '''Search for entities, decoding the response as it is received.
+
+        Each result is yielded as soon as it has been decoded, without
+        holding the whole response in memory. See the search method for a
+        description of the parameters.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return A generator yielding the entities one at a time.
+        '''
+        url = self._search_url(
+            text, includes=includes, doc_type=doc_type, limit=limit,
+            autocomplete=autocomplete, promulgated_only=promulgated_only,
+            tags=tags, sort=sort, owner=owner, series=series)
+        return self._stream_json(
+            url, key='Results', deadline=deadline, operation='search')
+
+    def _search_url(self, text, includes=None, doc_type=None, limit=None,
+                    autocomplete=False, promulgated_only=False, tags=None,
+                    sort=None, owner=None, series=None, skip=None):
+        '''Generate the URL searching for entities in the charmstore.
+
+        See the search method for a description of the parameters.
+
+        @param skip The number of results to skip.
         '''
         queries = self._common_query_parameters(doc_type, includes, owner,
                                                 promulgated_only, series, sort)
@@ -351,6 +1038,8 @@ class CharmStore(object):
             queries.append(('text', text))
         if limit is not None:
             queries.append(('limit', limit))
+        if skip:
+            queries.append(('skip', skip))
         if autocomplete:
             queries.append(('autocomplete', 1))
         if tags is not None:
@@ -361,11 +1050,10 @@ class CharmStore(object):
             url = '{}/search?{}'.format(self.url, urlencode(queries))
         else:
             url = '{}/search'.format(self.url)
-        data = self._get(url)
-        return data.json()['Results']
+        return url
 
     def list(self, includes=None, doc_type=None, promulgated_only=False,
-             sort=None, owner=None, series=None):
+             sort=None, owner=None, series=None, deadline=None):
         '''
         List entities in the charmstore.
 
@@ -378,15 +1066,136 @@ class CharmStore(object):
             include entities that owner can view.
         @param series The series to filter; can be a list of series or a
             single series.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
+        url = self._list_url(
+            includes=includes, doc_type=doc_type,
+            promulgated_only=promulgated_only, sort=sort, owner=owner,
+            series=series)
+        data = self._get(url, deadline=deadline, operation='list')
+        return data.json()['Results']
+
+    def iter_list(self, includes=None, doc_type=None, promulgated_only=False,
+                  sort=None, owner=None, series=None,
+                  page_size=DEFAULT_PAGE_SIZE, deadline=None):
+        '''Lazily iterate over the entities in the charmstore.
+
+        Results are requested page_size entities at a time, the next page
+        being fetched in the background while the current one is consumed.
+        See the list method for a description of the other parameters.
+
+        @param page_size The number of entities requested per page.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A generator yielding the entities one at a time.
+        '''
+        def page_url(skip):
+            return self._list_url(
+                includes=includes, doc_type=doc_type,
+                promulgated_only=promulgated_only, sort=sort, owner=owner,
+                series=series, limit=page_size, skip=skip)
+        return self._iter_pages(
+            page_url, page_size, deadline=deadline, operation='list')
+
+    def stream_list(self, includes=None, doc_type=None,
+                    promulgated_only=False, sort=None, owner=None,
+                    series=None, deadline=None):
+        '''List entities, decoding the response as it is received.
+
+        Each result is yielded as soon as it has been decoded, without
+        holding the whole response in memory. See the list method for a
+        description of the parameters.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @return A generator yielding the entities one at a time.
+        '''
+        url = self._list_url(
+            includes=includes, doc_type=doc_type,
+            promulgated_only=promulgated_only, sort=sort, owner=owner,
+            series=series)
+        return self._stream_json(
+            url, key='Results', deadline=deadline, operation='list')
+
+    def _list_url(self, includes=None, doc_type=None, promulgated_only=False,
+                  sort=None, owner=None, series=None, limit=None, skip=None):
+        '''Generate the URL listing entities in the charmstore.
+
+        See the list method for a description of the parameters.
+
+        @param limit The maximum number of results to return.
+        @param skip The number of results to skip.
         '''
         queries = self._common_query_parameters(doc_type, includes, owner,
                                                 promulgated_only, series, sort)
+        if limit is not None:
+            queries.append(('limit', limit))
+        if skip:
+            queries.append(('skip', skip))
         if len(queries):
-            url = '{}/list?{}'.format(self.url, urlencode(queries))
-        else:
-            url = '{}/list'.format(self.url)
-        data = self._get(url)
-        return data.json()['Results']
+            return '{}/list?{}'.format(self.url, urlencode(queries))
+        return '{}/list'.format(self.url)
+
+    def _iter_pages(self, page_url, page_size, deadline=None,
+                    operation=None):
+        '''Yield the results of a paged search or list query.
+
+        The next page is requested in a background thread while the results
+        of the current one are yielded. The iteration stops at the first page
+        not holding exactly page_size results, so that a server ignoring the
+        limit does not cause endless requests, or at a page repeating the
+        previous one, as returned by a server ignoring skip.
+
+        @param page_url A callable returning the URL of the page starting
+            at the given offset.
+        @param page_size The number of entities requested per page.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @param operation The name of the operation making the requests.
+        '''
+        if page_size < 1:
+            raise ValueError('page size must be positive')
+        return self._generate_pages(page_url, page_size, deadline, operation)
+
+    def _generate_pages(self, page_url, page_size, deadline=None,
+                        operation=None):
+        '''Generate the results of a paged query, see _iter_pages.'''
+        pool = ThreadPool(1)
+        try:
+            skip = 0
+            previous = None
+            pending = pool.apply_async(
+                self._get_results, (page_url(skip), deadline, operation))
+            while pending is not None:
+                results = pending.get()
+                pending = None
+                ids = _page_ids(results)
+                if ids == previous:
+                    break
+                previous = ids
+                if len(results) == page_size:
+                    skip += page_size
+                    pending = pool.apply_async(
+                        self._get_results,
+                        (page_url(skip), deadline, operation))
+                for entity in results:
+                    yield entity
+                # Release the page before waiting for the next one.
+                results = None
+        finally:
+            pool.terminate()
+
+    def _get_results(self, url, deadline=None, operation=None):
+        '''Return the results of the search or list query at the given URL.
+
+        @param url The URL of the query.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        @param operation The name of the operation making the request.
+        '''
+        response = self._get(url, deadline=deadline, operation=operation)
+        return response.json()['Results'] or []
 
     def _common_query_parameters(self, doc_type, includes, owner,
                                  promulgated_only, series, sort):
@@ -420,61 +1229,154 @@ class CharmStore(object):
             queries.append(('sort', sort))
         return queries
 
-    # XXX j.c.sackett 2016-04-15 this should be updated to just accept a list
-    # of id strings, and client code should be updated to pass that.
-    def fetch_related(self, ids):
+    def fetch_related(self, ids, deadline=None):
         """Fetch related entity information.
 
         Fetches metadata, stats and extra-info for the supplied entities.
 
         @param ids The entity ids to fetch related information for. A list of
-            entity id dicts from the charmstore.
+            ids as strings or references; entity id dicts from the charmstore
+            (e.g. search results) are also accepted.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
         """
         if not ids:
             return []
-        meta = '&id='.join(id['Id'] for id in ids)
-        url = ('{url}/meta/any?id={meta}'
-               '&include=bundle-metadata&include=stats'
-               '&include=supported-series&include=extra-info'
-               '&include=bundle-unit-count&include=owner').format(
-                   url=self.url, meta=meta)
-        data = self._get(url)
-        return data.json().values()
+        return self._bulk_meta(
+            _related_ids(ids), _RELATED_INCLUDES, deadline=deadline).values()
 
-    def fetch_interfaces(self, interface, way):
+    def fetch_interfaces(self, interface, way, deadline=None):
         """Get the list of charms that provides or requires this interface.
 
         @param interface The interface for the charm relation.
         @param way The type of relation, either "provides" or "requires".
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return List of charms
         """
         if not interface:
             return []
+        data = self._get(self._fetch_interfaces_url(interface, way),
+                         deadline=deadline, operation='search')
+        return data.json().values()
+
+    def _fetch_interfaces_url(self, interface, way):
+        '''Generate the URL of the charms providing or requiring an interface.
+
+        @param interface The interface for the charm relation.
+        @param way The type of relation, either "provides" or "requires".
+        '''
         if way == 'requires':
             request = '&requires=' + interface
         else:
             request = '&provides=' + interface
-        url = (self.url + '/search?' +
-               'include=charm-metadata&include=stats&include=supported-series'
-               '&include=extra-info&include=bundle-unit-count'
-               '&limit=1000&include=owner' + request)
-        data = self._get(url)
-        return data.json().values()
+        return (self.url + '/search?' +
+                'include=charm-metadata&include=stats&include=supported-series'
+                '&include=extra-info&include=bundle-unit-count'
+                '&limit=1000&include=owner' + request)
+
+    def debug(self, deadline=None):
+        '''Retrieve the debug information from the charmstore.
 
-    def debug(self):
-        '''Retrieve the debug information from the charmstore.'''
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
         url = '{}/debug/status'.format(self.url)
-        data = self._get(url)
+        data = self._get(url, deadline=deadline, operation='debug')
         return data.json()
 
-    def fetch_macaroon(self):
-        '''Fetch a macaroon from charmstore.'''
+    def fetch_macaroon(self, deadline=None):
+        '''Fetch a macaroon from charmstore.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        '''
         url = '{charmstore_url}/macaroon'.format(
             charmstore_url=self.url)
-        response = self._get(url)
+        response = self._get(url, deadline=deadline, operation='macaroon')
         return response.text
 
 
+# The metadata fetched for related entities.
+_RELATED_INCLUDES = (
+    'bundle-metadata',
+    'stats',
+    'supported-series',
+    'extra-info',
+    'bundle-unit-count',
+    'owner',
+)
+
+
+def _related_ids(ids):
+    '''Return the given ids, converting charmstore entity id dicts to ids.
+
+    @param ids A list of ids or of entity id dicts from the charmstore.
+    '''
+    return [i['Id'] if isinstance(i, dict) else i for i in ids]
+
+
+def _page_ids(results):
+    '''Return the ids of a page of results, identifying repeated pages.'''
+    return [entity.get('Id') for entity in results]
+
+
+def _merge_bulk_responses(chunks, responses):
+    '''Merge the responses of chunked bulk metadata requests.
+
+    The charmstore omits the entities which do not exist from its responses,
+    so the requested ids missing from a successful response are reported
+    with an EntityNotFound error, and a lookup of only unknown ids returns
+    empty results rather than raising.
+
+    @param chunks The (ids, url) tuples of the requests, see _bulk_meta_urls.
+    @param responses The (url, data, error) tuples returned by bulk_fetch,
+        where data is the decoded response for the url, or None if the error
+        occurred.
+    @return A BulkResults instance.
+    @raise The first error if every request failed.
+    '''
+    # Raise if every request failed.
+    data = bulk_results(responses)
+    results = BulkResults()
+    for ids, url in chunks:
+        for entity_id in ids:
+            if url in data.errors:
+                results.errors[entity_id] = data.errors[url]
+            elif entity_id in data[url]:
+                results[entity_id] = data[url][entity_id]
+            else:
+                results.errors[entity_id] = EntityNotFound(entity_id)
+    return results
+
+
+def _entity_includes(get_files=False):
+    '''Return the metadata included when getting the data for an entity.
+
+    @param get_files Whether to include the manifest of files.
+    '''
+    includes = [
+        'bundle-machine-count',
+        'bundle-metadata',
+        'bundle-unit-count',
+        'bundles-containing',
+        'charm-config',
+        'charm-metadata',
+        'common-info',
+        'extra-info',
+        'owner',
+        'revision-info',
+        'published',
+        'stats',
+        'resources',
+        'supported-series',
+        'terms'
+    ]
+    if get_files:
+        includes.append('manifest')
+    return includes
+
+
 def _get_path(entity_id):
     '''Get the entity_id as a string if it is a Reference.
 
@@ -0,0 +1,218 @@
+"""Circuit breakers failing fast when a backend host is unavailable.
+
+A circuit starts closed and lets requests through. After failure_threshold
+consecutive failures (connection errors, timeouts or 5xx responses) it opens,
+and requests fail immediately with a CircuitOpenError instead of waiting for
+the host to time out. Once reset_timeout seconds have passed, the circuit is
+half-open and lets a limited number of trial requests through: a success
+closes it again, a failure opens it for another cool-down period.
+"""
+import threading
+import time
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+import requests
+
+from theblues.errors import (
+    CircuitOpenError,
+    log,
+)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_HALF_OPEN_MAX_CALLS = 1
+
+_now = getattr(time, 'monotonic', time.time)
+# Circuit breakers shared by all clients, keyed by (scheme, host).
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+    """A thread safe circuit breaker, see the module docstring."""
+
+    def __init__(self, name='', failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 half_open_max_calls=DEFAULT_HALF_OPEN_MAX_CALLS):
+        """Initializer.
+
+        @param name The name of the circuit, usually the host it protects.
+        @param failure_threshold How many consecutive failures open the
+            circuit.
+        @param reset_timeout How long in seconds the circuit stays open
+            before trial requests are let through.
+        @param half_open_max_calls How many trial requests can be in flight
+            while the circuit is half-open.
+        """
+        if failure_threshold < 1:
+            raise ValueError('the failure threshold must be positive')
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        # How many times the circuit opened, and how many requests were
+        # rejected while it was open.
+        self.opened = 0
+        self.rejected = 0
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """The current state: CLOSED, OPEN or HALF_OPEN."""
+        with self._lock:
+            return self._current_state()
+
+    def stats(self):
+        """Return the state and counters of the circuit as a dict."""
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+    def reset(self):
+        """Close the circuit and forget past failures."""
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trials = 0
+
+    def before_request(self, url):
+        """Check that a request can be sent.
+
+        @param url The URL of the request, used in the error message.
+        @return Whether the request is a trial of the half-open circuit, in
+            which case its outcome must be recorded or the trial released.
+        @raise CircuitOpenError if the circuit rejects the request.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN and self._trials < self.half_open_max_calls:
+                self._trials += 1
+                return True
+            if state == CLOSED:
+                return False
+            self.rejected += 1
+        raise CircuitOpenError(
+            'Circuit open for {}: request not sent: {}'.format(
+                self.name, url))
+
+    def release_trial(self):
+        """Release a trial slot without recording the outcome of the request.
+
+        This is used when a trial request fails for a reason unrelated to
+        the health of the host, for instance when it is cancelled.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record_success(self):
+        """Record a successful request, closing the circuit."""
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                log.info('circuit closed for {}'.format(self.name))
+                self._state = CLOSED
+                self._trials = 0
+
+    def record_failure(self):
+        """Record a failed request, opening the circuit if required."""
+        with self._lock:
+            if self._state == OPEN:
+                return
+            self._failures += 1
+            if (self._state == HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = _now()
+                self.opened += 1
+                log.warning('circuit opened for {} after {} failures'.format(
+                    self.name, self._failures))
+
+    def record_status(self, status):
+        """Record the response status code of a request.
+
+        @param status The HTTP status code; 5xx codes are failures.
+        """
+        if status >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def send(self, url, send):
+        """Send a request through the circuit.
+
+        @param url The URL of the request.
+        @param send A callable sending the request and returning the
+            requests response.
+        @return The response.
+        @raise CircuitOpenError if the circuit rejects the request.
+        """
+        trial = self.before_request(url)
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self.record_failure()
+            raise
+        except BaseException:
+            if trial:
+                self.release_trial()
+            raise
+        self.record_status(response.status_code)
+        return response
+
+    def _current_state(self):
+        """Return the state, half-opening the circuit after the cool-down.
+
+        Must be called with the lock held.
+        """
+        if self._state == OPEN and (
+                _now() - self._opened_at >= self.reset_timeout):
+            self._state = HALF_OPEN
+            self._trials = 0
+        return self._state
+
+
+def guard(breaker, url, send):
+    """Return send guarded by the given circuit breaker, if any.
+
+    @param breaker The CircuitBreaker protecting the host, or None.
+    @param url The URL of the request.
+    @param send A callable sending the request and returning the response.
+    """
+    if breaker is None:
+        return send
+    return lambda: breaker.send(url, send)
+
+
+def get_circuit_breaker(url, **kwargs):
+    """Return the circuit breaker shared by all requests to the url's host.
+
+    @param url The url, or base url, of the service being queried.
+    @param kwargs The CircuitBreaker options used if the breaker for the
+        host does not exist yet.
+    """
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(
+                name=parts.netloc, **kwargs)
+    return breaker
@@ -0,0 +1,95 @@
+"""Time budgets shared by all the requests made by an operation.
+
+A Deadline is created with the time an operation can take overall, and is
+passed to the client methods making up the operation. Every request made on
+its behalf only gets the time remaining before the deadline as its timeout,
+and no request is sent once the deadline has passed.
+"""
+import time
+
+from theblues.errors import DeadlineExceeded
+
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class Deadline(object):
+    """A point in time by which an operation must complete."""
+
+    def __init__(self, budget):
+        """Initializer.
+
+        @param budget The time in seconds the operation can take from now.
+        """
+        self.budget = budget
+        self.expires = _now() + budget
+
+    def __repr__(self):
+        return '<Deadline budget={} remaining={:.3f}>'.format(
+            self.budget, self.remaining())
+
+    def remaining(self):
+        """Return the time left before the deadline in seconds."""
+        return max(0, self.expires - _now())
+
+    @property
+    def expired(self):
+        """Whether the deadline has passed."""
+        return self.remaining() <= 0
+
+    def check(self, url):
+        """Raise a DeadlineExceeded if the deadline has passed.
+
+        @param url The URL of the request about to be made, used in the
+            error message.
+        """
+        if self.expired:
+            raise DeadlineExceeded(
+                'Deadline exceeded: {} budget: {}s'.format(url, self.budget))
+
+    def timeout(self, timeout, url):
+        """Return the timeout of a request made before the deadline.
+
+        @param timeout The timeout of the request in seconds, a (connect,
+            read) tuple of timeouts, or None for no timeout.
+        @param url The URL of the request.
+        @return The smallest of the timeout and the remaining time, applied
+            to both values of a tuple.
+        @raise DeadlineExceeded if the deadline has passed.
+        """
+        self.check(url)
+        remaining = self.remaining()
+        if isinstance(timeout, tuple):
+            return tuple(_cap(value, remaining) for value in timeout)
+        return _cap(timeout, remaining)
+
+
+def request_timeout(timeout, deadline, url):
+    """Return the timeout of a request, limited by the optional deadline.
+
+    @param timeout The timeout of the request in seconds, a (connect, read)
+        tuple of timeouts, or None.
+    @param deadline The Deadline of the operation, or None.
+    @param url The URL of the request.
+    @raise DeadlineExceeded if the deadline has passed.
+    """
+    if deadline is None:
+        return timeout
+    return deadline.timeout(timeout, url)
+
+
+def remaining(deadline):
+    """Return the time left before the optional deadline, or None.
+
+    @param deadline The Deadline of the operation, or None.
+    """
+    if deadline is None:
+        return None
+    return deadline.remaining()
+
+
+def _cap(timeout, remaining):
+    """Return the smallest of a timeout, possibly None, and remaining."""
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
@@ -16,8 +16,27 @@ class ServerError(Exception):
     pass
 
 
+class CircuitOpenError(ServerError):
+    """A request was not sent because the circuit of its host is open."""
+
+
+class DeadlineExceeded(ServerError):
+    """The time budget of an operation ran out before it completed."""
+
+
 def timeout_error(url, timeout):
     """Raise a server error indicating a request timeout to the given URL."""
-    msg = 'Request timed out: {} timeout: {}s'.format(url, timeout)
+    msg = 'Request timed out: {} timeout: {}'.format(
+        url, format_timeout(timeout))
     log.warning(msg)
     return ServerError(msg)
+
+
+def format_timeout(timeout):
+    """Return a human readable description of a request timeout.
+
+    @param timeout The timeout in seconds or a (connect, read) tuple.
+    """
+    if isinstance(timeout, tuple):
+        return '{}s connect, {}s read'.format(*timeout)
+    return '{}s'.format(timeout)
@@ -1,124 +1,360 @@
 import base64
+import calendar
 import json
 import logging
+import re
+import time
 try:
     from urllib import quote
 except ImportError:
     from urllib.parse import quote
 
+from theblues.cache import (
+    DEFAULT_MAX_ENTRIES,
+    ResultCacheMixin,
+)
 from theblues.errors import (
     InvalidMacaroon,
     ServerError,
 )
 from theblues.utils import (
     ensure_trailing_slash,
+    get_session,
     make_request,
     DEFAULT_TIMEOUT,
+    OperationTimeoutsMixin,
 )
 
 
-class IdentityManager(object):
+# Cached discharged macaroons are discarded this many seconds before their
+# time-before caveat expires, so that they are refreshed before expiry.
+DEFAULT_DISCHARGE_REFRESH = 60
+_TIME_BEFORE_PREFIX = 'time-before '
+_RFC3339_RE = re.compile(
+    r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?'
+    r'(Z|[+-]\d\d:\d\d)$', re.IGNORECASE)
+
+
+class IdentityManager(ResultCacheMixin, OperationTimeoutsMixin):
     """Identity Manager API."""
 
-    def __init__(self, url, idm_user, idm_password, timeout=DEFAULT_TIMEOUT):
+    # The operations whose timeout can be overridden.
+    timeout_operations = (
+        'get_user', 'debug', 'login', 'discharge', 'discharge_token',
+        'set_extra_info', 'get_extra_info')
+
+    # The client name reported to instruments.
+    client_name = 'identity'
+
+    def __init__(self, url, idm_user, idm_password, timeout=DEFAULT_TIMEOUT,
+                 session=None, retry=None, circuit_breaker=None,
+                 timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES,
+                 discharge_refresh=DEFAULT_DISCHARGE_REFRESH,
+                 user_cache_ttl=0, cache_discharges=False):
         """Initializer.
 
         @param url The url to the identity manager (IdM) API.
         @param idm_user The user name for the IdM.
         @param idm_password The password for the IdM.
         @param timeout How long to wait before timing out a request in seconds;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session The requests session used to send requests, defaulting
+            to the pooled session shared by all clients of the same host.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g.
+            {'get_user': 1, 'login': (3.05, 10)}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many discharged macaroons and users are
+            cached, or 0 to disable caching.
+        @param discharge_refresh How many seconds before the expiry of their
+            time-before caveat cached discharged macaroons are refreshed.
+        @param user_cache_ttl How long in seconds the data and extra info of
+            users are cached, or 0 not to cache them. Entries are invalidated
+            when the user is updated with login or set_extra_info.
+        @param cache_discharges Whether discharged macaroons and tokens are
+            cached until shortly before their time-before caveat expires.
         """
         self.url = ensure_trailing_slash(url)
         self.auth = (idm_user, idm_password)
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
+        self.session = session if session is not None else get_session(url)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.discharge_refresh = discharge_refresh
+        self.user_cache_ttl = user_cache_ttl
+        self.cache_discharges = cache_discharges
+        self._init_result_cache(cache_size)
 
-    def get_user(self, username):
+    def get_user(self, username, deadline=None):
         """Fetch user data.
 
         Raise a ServerError if an error occurs in the request process.
 
         @param username the user's name.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
+        url = self._user_url(username)
+        user = self._cached_user_data(url)
+        if user is not None:
+            return user
+        return self._cache_user_data(url, make_request(
+            url, auth=self.auth, timeout=self._timeout('get_user'),
+            session=self.session, retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/u/{username}'))
+
+    def _user_url(self, username):
+        """Return the URL of a user.
+
+        @param username The user name.
+        """
+        return '{}u/{}'.format(self.url, username)
+
+    def _cached_user_data(self, url):
+        """Return a copy of the user data cached for the given URL, or None.
+
+        @param url The URL of the user or of their extra info.
+        """
+        if not self.user_cache_ttl:
+            return None
+        content = self._cached_result(url)
+        if content is None:
+            return None
+        return json.loads(content)
+
+    def _cache_user_data(self, url, data):
+        """Cache and return user data retrieved from the given URL.
+
+        The data is stored JSON encoded so that callers cannot modify the
+        cached value.
+
+        @param url The URL of the user or of their extra info.
+        @param data The JSON decoded response.
+        """
+        if self.user_cache_ttl:
+            content = json.dumps(data)
+            self._cache_result(
+                url, content, self.user_cache_ttl, size=len(content))
+        return data
+
+    def invalidate_user(self, username):
+        """Forget the data and extra info cached for a user.
+
+        This is done automatically by login and set_extra_info.
+
+        @param username The user name.
         """
-        url = '{}u/{}'.format(self.url, username)
-        return make_request(url, auth=self.auth, timeout=self.timeout)
+        if self.cache is None:
+            return
+        self.cache.delete(self._user_url(username))
+        self.cache.delete(self._get_extra_info_url(username))
 
-    def debug(self):
-        """Retrieve the debug information from the identity manager."""
+    def debug(self, deadline=None):
+        """Retrieve the debug information from the identity manager.
+
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
+        """
         url = '{}debug/status'.format(self.url)
         try:
-            return make_request(url, timeout=self.timeout)
+            return make_request(
+                url, timeout=self._timeout('debug'), session=self.session,
+                retry=self.retry, circuit_breaker=self.circuit_breaker,
+                deadline=deadline, instrument=self.instrument,
+                client=self.client_name, template='/debug/status')
         except ServerError as err:
             return {"error": str(err)}
 
-    def login(self, username, json_document):
+    def login(self, username, json_document, deadline=None):
         """Send user identity information to the identity manager.
 
         Raise a ServerError if an error occurs in the request process.
 
         @param username The logged in user.
         @param json_document The JSON payload for login.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         """
-        url = '{}u/{}'.format(self.url, username)
-        make_request(
-            url,
-            method='PUT',
-            body=json_document,
-            auth=self.auth,
-            timeout=self.timeout)
+        url = self._user_url(username)
+        try:
+            make_request(
+                url,
+                method='PUT',
+                body=json_document,
+                auth=self.auth,
+                timeout=self._timeout('login'),
+                session=self.session,
+                retry=self.retry,
+                circuit_breaker=self.circuit_breaker,
+                deadline=deadline,
+                instrument=self.instrument,
+                client=self.client_name,
+                template='/u/{username}')
+        finally:
+            # Even a failed request may have updated the user.
+            self.invalidate_user(username)
 
-    def discharge(self, username, macaroon):
+    def discharge(self, username, macaroon, deadline=None):
         """Discharge the macarooon for the identity.
 
         Raise a ServerError if an error occurs in the request process.
+        If cache_discharges is enabled, discharged macaroons are cached by
+        user and third party caveat id until shortly before their
+        time-before caveat expires.
 
         @param username The logged in user.
         @param macaroon The macaroon returned from the charm store.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return The resulting base64 encoded macaroon.
         @raises ServerError when making request to the discharge endpoint
         InvalidMacaroon when the macaroon passedin or discharged is invalid
         """
+        url = self._discharge_url(username, macaroon)
+        discharged = self._cached_discharge(url)
+        if discharged is not None:
+            return discharged
+        response = make_request(
+            url, method='POST', auth=self.auth,
+            timeout=self._timeout('discharge'), session=self.session,
+            retry=self.retry, circuit_breaker=self.circuit_breaker,
+            deadline=deadline, instrument=self.instrument,
+            client=self.client_name, template='/discharger/discharge')
+        return self._discharged(url, response)
+
+    def _discharged(self, url, response):
+        """Cache and return the macaroon included in a discharge response.
+
+        @param url The URL of the discharge request.
+        @param response The JSON decoded response from the discharger.
+        @return The base64 encoded macaroon.
+        """
+        json_macaroon = _get_macaroon(response, 'Macaroon')
+        discharged = base64.urlsafe_b64encode(json_macaroon.encode('utf-8'))
+        return self._cache_discharged(url, response['Macaroon'], discharged)
+
+    def _cached_discharge(self, url):
+        """Return the macaroon or token cached for the given URL, or None.
+
+        @param url The URL of the discharge request.
+        """
+        if not self.cache_discharges:
+            return None
+        return self._cached_result(url)
+
+    def _cache_discharged(self, url, macaroon, discharged):
+        """Cache and return a discharged macaroon until it needs refreshing.
+
+        Macaroons without a time-before caveat are not cached.
+
+        @param url The URL of the discharge request.
+        @param macaroon The JSON decoded macaroon.
+        @param discharged The base64 encoded macaroon returned to callers.
+        """
+        if not self.cache_discharges:
+            return discharged
+        expires = _macaroon_expiry(macaroon)
+        if expires is not None:
+            ttl = expires - time.time() - self.discharge_refresh
+            if ttl > 0:
+                self._cache_result(
+                    url, discharged, ttl, size=len(discharged))
+        return discharged
+
+    def _discharge_url(self, username, macaroon):
+        """Return the URL used to discharge the macaroon for the identity.
+
+        @param username The logged in user.
+        @param macaroon The macaroon returned from the charm store.
+        @raises InvalidMacaroon when the macaroon does not have exactly one
+        third party caveat.
+        """
         caveats = macaroon.third_party_caveats()
         if len(caveats) != 1:
             raise InvalidMacaroon(
                 'Invalid number of third party caveats (1 != {})'
                 ''.format(len(caveats)))
-        url = '{}discharger/discharge?discharge-for-user={}&id={}'.format(
-            self.url, quote(username), caveats[0][1])
+        url = '{}id={}'.format(
+            self._discharge_url_prefix(username), caveats[0][1])
         logging.debug('Sending identity info to {}'.format(url))
         logging.debug('data is {}'.format(caveats[0][1]))
-        response = make_request(
-            url, method='POST', auth=self.auth, timeout=self.timeout)
-        try:
-            macaroon = response['Macaroon']
-            json_macaroon = json.dumps(macaroon)
-        except (KeyError, UnicodeDecodeError) as err:
-            raise InvalidMacaroon(
-                'Invalid macaroon from discharger: {}'.format(err.message))
+        return url
 
-        return base64.urlsafe_b64encode(json_macaroon.encode('utf-8'))
+    def _discharge_url_prefix(self, username):
+        """Return the prefix of the URLs discharging macaroons for a user.
+
+        @param username The logged in user.
+        """
+        return '{}discharger/discharge?discharge-for-user={}&'.format(
+            self.url, quote(username))
 
-    def discharge_token(self, username):
+    def discharge_token(self, username, deadline=None):
         """Discharge token for a user.
 
         Raise a ServerError if an error occurs in the request process.
+        If cache_discharges is enabled, discharge tokens are cached by user
+        until shortly before their time-before caveat expires.
 
         @param username The logged in user.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return The resulting base64 encoded discharged token.
         """
+        url = self._discharge_token_url(username)
+        discharged = self._cached_discharge(url)
+        if discharged is not None:
+            return discharged
+        response = make_request(
+            url, method='GET', auth=self.auth,
+            timeout=self._timeout('discharge_token'), session=self.session,
+            retry=self.retry, circuit_breaker=self.circuit_breaker,
+            deadline=deadline, instrument=self.instrument,
+            client=self.client_name, template='/discharge-token-for-user')
+        return self._discharged_token(url, response)
+
+    def _discharged_token(self, url, response):
+        """Cache and return the token included in a discharge response.
+
+        @param url The URL of the discharge token request.
+        @param response The JSON decoded response from the IdM.
+        @return The base64 encoded discharge token.
+        """
+        json_macaroon = _get_macaroon(response, 'DischargeToken')
+        discharged = base64.urlsafe_b64encode("[{}]".format(
+            json_macaroon).encode('utf-8'))
+        return self._cache_discharged(
+            url, response['DischargeToken'], discharged)
+
+    def invalidate_discharges(self, username):
+        """Forget the discharged macaroons and token cached for a user.
+
+        Call this when the user logs out.
+
+        @param username The user name.
+        """
+        if self.cache is None:
+            return
+        self.cache.delete(self._discharge_token_url(username))
+        self.cache.delete_prefix(self._discharge_url_prefix(username))
+
+    def _discharge_token_url(self, username):
+        """Return the URL used to discharge a token for a user.
+
+        @param username The logged in user.
+        """
         url = '{}discharge-token-for-user?username={}'.format(
             self.url, username)
         logging.debug('Sending identity info to {}'.format(url))
-        response = make_request(
-            url, method='GET', auth=self.auth, timeout=self.timeout)
-        try:
-            macaroon = response['DischargeToken']
-            json_macaroon = json.dumps(macaroon)
-        except (KeyError, UnicodeDecodeError) as err:
-            raise InvalidMacaroon(
-                'Invalid macaroon from discharger: {}'.format(err.message))
-        return base64.urlsafe_b64encode("[{}]".format(
-            json_macaroon).encode('utf-8'))
+        return url
 
     def _get_extra_info_url(self, username):
         """Return the base URL for extra-info requests.
@@ -127,7 +363,7 @@ class IdentityManager(object):
         """
         return '{}u/{}/extra-info'.format(self.url, username)
 
-    def set_extra_info(self, username, extra_info):
+    def set_extra_info(self, username, extra_info, deadline=None):
         """Set extra info for the given user.
 
         Raise a ServerError if an error occurs in the request process.
@@ -135,18 +371,113 @@ class IdentityManager(object):
         @param username The username for the user to update.
         @param info The extra info as a JSON encoded string, or as a Python
             dictionary like object.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         """
         url = self._get_extra_info_url(username)
-        make_request(
-            url, method='PUT', body=extra_info, auth=self.auth,
-            timeout=self.timeout)
+        try:
+            make_request(
+                url, method='PUT', body=extra_info, auth=self.auth,
+                timeout=self._timeout('set_extra_info'),
+                session=self.session, retry=self.retry,
+                circuit_breaker=self.circuit_breaker, deadline=deadline,
+                instrument=self.instrument, client=self.client_name,
+                template='/u/{username}/extra-info')
+        finally:
+            # Even a failed request may have updated the user.
+            self.invalidate_user(username)
 
-    def get_extra_info(self, username):
+    def get_extra_info(self, username, deadline=None):
         """Get extra info for the given user.
 
         Raise a ServerError if an error occurs in the request process.
 
         @param username The username for the user who's info is being accessed.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         """
         url = self._get_extra_info_url(username)
-        return make_request(url, auth=self.auth, timeout=self.timeout)
+        extra_info = self._cached_user_data(url)
+        if extra_info is not None:
+            return extra_info
+        return self._cache_user_data(url, make_request(
+            url, auth=self.auth, timeout=self._timeout('get_extra_info'),
+            session=self.session, retry=self.retry,
+            circuit_breaker=self.circuit_breaker, deadline=deadline,
+            instrument=self.instrument, client=self.client_name,
+            template='/u/{username}/extra-info'))
+
+
+def _get_macaroon(response, key):
+    """Return the JSON encoded macaroon included in a discharger response.
+
+    @param response The JSON decoded response from the discharger.
+    @param key The response key holding the macaroon.
+    @raises InvalidMacaroon when the response does not include a macaroon.
+    """
+    try:
+        return json.dumps(response[key])
+    except (KeyError, TypeError, UnicodeDecodeError) as err:
+        raise InvalidMacaroon(
+            'Invalid macaroon from discharger: {}'.format(err))
+
+
+def _macaroon_expiry(macaroon):
+    """Return when a macaroon expires, according to its time-before caveats.
+
+    Both the version 1 and version 2 JSON formats are supported.
+
+    @param macaroon The JSON decoded macaroon.
+    @return The expiry time in seconds since the epoch, or None if the
+        macaroon has no valid time-before caveat.
+    """
+    try:
+        caveats = macaroon.get('caveats') or macaroon.get('c') or []
+    except AttributeError:
+        return None
+    expires = None
+    for caveat in caveats:
+        try:
+            condition = _caveat_id(caveat)
+            if condition is None or not condition.startswith(
+                    _TIME_BEFORE_PREFIX):
+                continue
+            timestamp = _parse_time(condition[len(_TIME_BEFORE_PREFIX):])
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if timestamp is not None and (expires is None or timestamp < expires):
+            expires = timestamp
+    return expires
+
+
+def _caveat_id(caveat):
+    """Return the id of a first party caveat as a string, or None.
+
+    @param caveat The JSON decoded caveat.
+    """
+    if any(key in caveat for key in ('vid', 'v', 'v64')):
+        # Third party caveats are verified by the discharger.
+        return None
+    if 'i64' in caveat:
+        data = caveat['i64']
+        data += '=' * (-len(data) % 4)
+        return base64.urlsafe_b64decode(data.encode('ascii')).decode('utf-8')
+    return caveat.get('cid', caveat.get('i'))
+
+
+def _parse_time(value):
+    """Return the seconds since the epoch of an RFC 3339 timestamp, or None.
+
+    @param value The timestamp, e.g. "2017-05-04T12:00:00.123456789Z".
+    """
+    match = _RFC3339_RE.match(value.strip())
+    if match is None:
+        return None
+    seconds, fraction, zone = match.groups()
+    timestamp = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+    if fraction:
+        timestamp += float(fraction)
+    if zone.upper() != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        timestamp -= offset if zone[0] == '+' else -offset
+    return timestamp
@@ -0,0 +1,427 @@
+"""Instrumentation of the requests sent by the clients.
+
+All clients accept an optional instrument, whose before_request and
+after_request hooks are called for every outbound request with a
+RequestRecord describing it: the client name, the HTTP method, the URL and
+its template (e.g. "/{id}/meta/any"), the response status and size, the
+timings of the request and the number of retries.
+
+A HistogramCollector aggregates the records in memory, and its metrics can
+be exported in the Prometheus text format, or served locally so that they can
+be scraped.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+try:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+except ImportError:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+
+from theblues.errors import log
+
+
+# The upper bounds in seconds of the buckets of the duration histograms.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# The timings of a request which are recorded besides its total duration.
+PHASES = ('dns', 'connect', 'ttfb')
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class RequestRecord(object):
+    """The description of an outbound request, passed to the instruments.
+
+    Timings are in seconds, and are None when not measured: the time spent
+    resolving the host name (dns) and opening the connection (connect) is
+    only reported by the asyncio clients, and both are None when a pooled
+    connection is reused. The time to first byte (ttfb) is measured until
+    the response headers are received. The total duration includes retries
+    and, unless the response is streamed, reading the response body.
+    """
+
+    def __init__(self, client, method, url, template=None):
+        """Initializer.
+
+        @param client The name of the client sending the request.
+        @param method The HTTP method of the request.
+        @param url The URL of the request.
+        @param template The URL template of the request, relative to the
+            API root, e.g. "/{id}/meta/any".
+        """
+        self.client = client
+        self.method = method
+        self.url = url
+        self.template = template
+        # The response status, or None if no response was received.
+        self.status = None
+        # The size in bytes of the response body, if known.
+        self.size = None
+        # The exception raised by the request, if any.
+        self.error = None
+        # The number of attempts made to send the request.
+        self.attempts = 0
+        self.dns = None
+        self.connect = None
+        self.ttfb = None
+        self.total = None
+        self.started = _now()
+        self._marks = {}
+
+    @property
+    def retries(self):
+        """The number of times the request was retried."""
+        return max(0, self.attempts - 1)
+
+    def start_phase(self, phase):
+        """Mark the start of a phase of the request, e.g. "dns"."""
+        self._marks[phase] = _now()
+
+    def end_phase(self, phase):
+        """Record the duration of a phase started with start_phase."""
+        started = self._marks.pop(phase, None)
+        if started is not None:
+            setattr(self, phase, _now() - started)
+
+    def __repr__(self):
+        return '<RequestRecord {} {} {} status={} total={}>'.format(
+            self.client, self.method, self.url, self.status, self.total)
+
+
+class Instrument(object):
+    """The base class of request instruments.
+
+    Subclasses override the hooks they need. Hooks are called synchronously
+    from the thread or the event loop sending the request, so they must be
+    fast and thread safe. Exceptions raised by hooks are logged and ignored.
+    """
+
+    def before_request(self, record):
+        """Called before a request is sent.
+
+        Only the client, method, url and template of the record are set.
+
+        @param record The RequestRecord of the request.
+        """
+
+    def after_request(self, record):
+        """Called once a request is complete or has failed.
+
+        @param record The RequestRecord of the request.
+        """
+
+
+@contextmanager
+def instrumented(instrument, client, method, url, template=None):
+    """Call the instrument's hooks around the request sent in the block.
+
+    The context manager yields the RequestRecord of the request, to be
+    completed by the block, or None if the instrument is None.
+
+    @param instrument The Instrument to notify, or None.
+    @param client The name of the client sending the request.
+    @param method The HTTP method of the request.
+    @param url The URL of the request.
+    @param template The URL template of the request.
+    """
+    record = start_request(instrument, client, method, url, template)
+    error = None
+    try:
+        yield record
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        finish_request(instrument, record, error)
+
+
+def start_request(instrument, client, method, url, template=None):
+    """Return the RequestRecord of a new request, notifying the instrument.
+
+    The record must be passed to finish_request once the request completes.
+    See instrumented for a description of the arguments.
+
+    @return The record, or None if the instrument is None.
+    """
+    if instrument is None:
+        return None
+    record = RequestRecord(client, method, url, template=template)
+    _notify(instrument.before_request, record)
+    return record
+
+
+def finish_request(instrument, record, error=None):
+    """Complete a request started with start_request.
+
+    @param instrument The Instrument to notify, or None.
+    @param record The RequestRecord returned by start_request.
+    @param error The exception raised by the request, if it failed.
+    """
+    if record is None:
+        return
+    record.error = error
+    record.total = _now() - record.started
+    _notify(instrument.after_request, record)
+
+
+def counted(record, send):
+    """Return send counting the attempts made in the given record.
+
+    @param record The RequestRecord of the request, or None.
+    @param send A callable sending the request.
+    """
+    if record is None:
+        return send
+
+    def send_attempt():
+        record.attempts += 1
+        return send()
+    return send_attempt
+
+
+def _notify(hook, record):
+    """Call an instrument hook, logging its errors."""
+    try:
+        hook(record)
+    except Exception:
+        log.exception('instrument hook failed for {!r}'.format(record))
+
+
+class Histogram(object):
+    """A histogram of observed values, with fixed buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initializer.
+
+        @param buckets The sorted upper bounds of the buckets.
+        """
+        self.buckets = tuple(buckets)
+        # The number of values in each bucket, the last one being +Inf.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return the (upper bound, count of values below it) pairs.
+
+        The last upper bound is float('inf').
+        """
+        total = 0
+        pairs = []
+        bounds = self.buckets + (float('inf'),)
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class HistogramCollector(Instrument):
+    """A thread safe instrument aggregating request metrics in memory.
+
+    Requests are labelled by client, method, URL template and status, the
+    status being "error" for requests which failed without a response.
+    The collector keeps a histogram of the total duration of the requests
+    and of each of their measured phases, and counts the bytes received and
+    the retries made.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initializer.
+
+        @param buckets The upper bounds in seconds of the histogram buckets.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._durations = {}
+        self._phases = {}
+        self._bytes = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+
+    def after_request(self, record):
+        labels = (
+            record.client, record.method, record.template or '',
+            'error' if record.status is None else str(record.status))
+        with self._lock:
+            self._histogram(self._durations, labels).observe(record.total)
+            for phase in PHASES:
+                value = getattr(record, phase)
+                if value is not None:
+                    self._histogram(
+                        self._phases, labels[:3] + (phase,)).observe(value)
+            self._bytes[labels] = (
+                self._bytes.get(labels, 0) + (record.size or 0))
+            self._retries[labels] = (
+                self._retries.get(labels, 0) + record.retries)
+
+    def _histogram(self, histograms, labels):
+        """Return the histogram with the given labels, creating it if needed.
+        """
+        histogram = histograms.get(labels)
+        if histogram is None:
+            histogram = histograms[labels] = Histogram(self.buckets)
+        return histogram
+
+    def snapshot(self):
+        """Return a copy of the collected metrics.
+
+        @return A dict with the following keys: "durations" maps the
+            (client, method, template, status) labels to the duration
+            Histogram of the matching requests; "phases" maps the
+            (client, method, template, phase) labels to the histogram of
+            that phase; "bytes" and "retries" map the request labels to the
+            number of bytes received and to the number of retries made.
+        """
+        with self._lock:
+            return {
+                'durations': _copy_histograms(self._durations),
+                'phases': _copy_histograms(self._phases),
+                'bytes': dict(self._bytes),
+                'retries': dict(self._retries),
+            }
+
+    def reset(self):
+        """Discard the collected metrics."""
+        with self._lock:
+            self._durations.clear()
+            self._phases.clear()
+            self._bytes.clear()
+            self._retries.clear()
+
+
+def _copy_histograms(histograms):
+    """Return a copy of the given histograms, keyed by labels."""
+    copies = {}
+    for labels, histogram in histograms.items():
+        copy = Histogram(histogram.buckets)
+        copy.counts = list(histogram.counts)
+        copy.count = histogram.count
+        copy.sum = histogram.sum
+        copies[labels] = copy
+    return copies
+
+
+_REQUEST_LABELS = ('client', 'method', 'template', 'status')
+_PHASE_LABELS = ('client', 'method', 'template', 'phase')
+
+
+def to_prometheus(collector, prefix='theblues'):
+    """Return the metrics of a HistogramCollector in Prometheus text format.
+
+    @param collector The HistogramCollector.
+    @param prefix The prefix of the metric names.
+    """
+    metrics = collector.snapshot()
+    lines = []
+    _histogram_lines(
+        lines, '{}_request_duration_seconds'.format(prefix),
+        'Duration of the outbound requests.',
+        _REQUEST_LABELS, metrics['durations'])
+    _histogram_lines(
+        lines, '{}_request_phase_seconds'.format(prefix),
+        'Duration of the phases of the outbound requests.',
+        _PHASE_LABELS, metrics['phases'])
+    _counter_lines(
+        lines, '{}_response_bytes_total'.format(prefix),
+        'Bytes received in response bodies.',
+        _REQUEST_LABELS, metrics['bytes'])
+    _counter_lines(
+        lines, '{}_request_retries_total'.format(prefix),
+        'Retries of the outbound requests.',
+        _REQUEST_LABELS, metrics['retries'])
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(lines, name, description, names, histograms):
+    """Append the lines describing histograms to lines."""
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} histogram'.format(name))
+    for labels in sorted(histograms):
+        histogram = histograms[labels]
+        pairs = list(zip(names, labels))
+        for bound, count in histogram.cumulative():
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(pairs + [('le', _format_bound(bound))]),
+                count))
+        lines.append('{}_sum{} {}'.format(
+            name, _format_labels(pairs), _format_value(histogram.sum)))
+        lines.append('{}_count{} {}'.format(
+            name, _format_labels(pairs), histogram.count))
+
+
+def _counter_lines(lines, name, description, names, counters):
+    """Append the lines describing counters to lines."""
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} counter'.format(name))
+    for labels in sorted(counters):
+        lines.append('{}{} {}'.format(
+            name, _format_labels(zip(names, labels)), counters[labels]))
+
+
+def _format_labels(pairs):
+    """Return the Prometheus representation of (name, value) label pairs."""
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _escape(value):
+    """Escape a label value."""
+    return value.replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound):
+    """Return the Prometheus representation of a bucket upper bound."""
+    if bound == float('inf'):
+        return '+Inf'
+    return _format_value(bound)
+
+
+def _format_value(value):
+    """Return the Prometheus representation of a sample value."""
+    return repr(float(value))
+
+
+def serve_prometheus(collector, port=0, host='127.0.0.1'):
+    """Serve the metrics of a collector over HTTP in a background thread.
+
+    Metrics are returned in the Prometheus text format for any GET request.
+
+    @param collector The HistogramCollector.
+    @param port The port to listen on, 0 meaning any free port.
+    @param host The address to listen on, the loopback one by default.
+    @return The HTTP server: its server_port attribute is the port listened
+        on, and its shutdown method stops serving.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = to_prometheus(collector).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -3,28 +3,61 @@ import json
 import requests
 
 from theblues.errors import log
+from theblues.instrumentation import (
+    counted,
+    instrumented,
+)
 from theblues.utils import (
     ensure_trailing_slash,
+    get_session,
     make_request,
     DEFAULT_TIMEOUT,
+    OperationTimeoutsMixin,
+    record_response,
 )
+from theblues.circuit import guard
+from theblues.deadline import request_timeout
+from theblues.retry import send_request
+
 
+class JIMM(OperationTimeoutsMixin):
 
-class JIMM(object):
+    # The operations whose timeout can be overridden.
+    timeout_operations = ('fetch_macaroon', 'list_models')
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+    # The client name reported to instruments.
+    client_name = 'jimm'
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None):
         """Initializer.
 
         @param url The url to the JIMM API.
         @param timeout How long to wait before timing out a request in seconds;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session The requests session used to send requests, defaulting
+            to the pooled session shared by all clients of the same host.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'list_models': (3.05, 30)}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
         """
         self.url = ensure_trailing_slash(url)
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
+        self.session = session if session is not None else get_session(url)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
 
-    def fetch_macaroon(self):
+    def fetch_macaroon(self, deadline=None):
         """ Fetches the macaroon from the JIMM controller.
 
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return The base64 encoded macaroon.
         """
         try:
@@ -32,10 +65,26 @@ class JIMM(object):
             # fully handled. This lets us get the macaroon out of the request
             # and keep it.
             url = "{}model".format(self.url)
-            response = requests.get(url, timeout=self.timeout)
+            timeout = self._timeout('fetch_macaroon')
+            attempt = {'timeout': timeout}
+            with instrumented(self.instrument, self.client_name, 'GET', url,
+                              '/model') as record:
+                get = guard(self.circuit_breaker, url, counted(
+                    record, lambda: self.session.get(
+                        url, timeout=attempt['timeout'])))
+
+                def send():
+                    # An expired deadline is raised before reaching the
+                    # breaker.
+                    attempt['timeout'] = request_timeout(
+                        timeout, deadline, url)
+                    return get()
+                response = send_request(
+                    self.retry, 'GET', send, deadline=deadline)
+                record_response(record, response)
         except requests.exceptions.Timeout:
             message = 'Request timed out: {url} timeout: {timeout}'
-            message = message.format(url=url, timeout=self.timeout)
+            message = message.format(url=url, timeout=timeout)
             log.error(message)
             return None
         except Exception as e:
@@ -49,22 +98,36 @@ class JIMM(object):
                 'cannot process macaroon: '
                 'cannot unmarshal response: {!r}'.format(response.content))
             return None
+        return _get_macaroon(json_response)
 
-        try:
-            raw_macaroon = json_response['Info']['Macaroon']
-        except (KeyError, TypeError):
-            log.info(
-                'cannot process macaroon: invalid JSON response: {!r}'.format(
-                    json_response))
-            return None
-
-        return json.dumps(raw_macaroon)
-
-    def list_models(self, macaroons):
+    def list_models(self, macaroons, deadline=None):
         """ Get the logged in user's models from the JIMM controller.
 
         @param macaroons The discharged JIMM macaroons.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return The json decoded list of environments.
         """
         return make_request("{}model".format(self.url), macaroons=macaroons,
-                            timeout=self.timeout)
+                            timeout=self._timeout('list_models'),
+                            session=self.session, retry=self.retry,
+                            circuit_breaker=self.circuit_breaker,
+                            deadline=deadline, instrument=self.instrument,
+                            client=self.client_name, template='/model')
+
+
+def _get_macaroon(json_response):
+    """Return the JSON encoded macaroon included in a JIMM response.
+
+    @param json_response The JSON decoded response from JIMM.
+    @return The JSON encoded macaroon or None if the response is not valid.
+    """
+    try:
+        raw_macaroon = json_response['Info']['Macaroon']
+    except (KeyError, TypeError):
+        log.info(
+            'cannot process macaroon: invalid JSON response: {!r}'.format(
+                json_response))
+        return None
+
+    return json.dumps(raw_macaroon)
@@ -0,0 +1,185 @@
+import codecs
+import json
+import re
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# The states of the StreamDecoder.
+_START = 'start'
+_FIRST_KEY = 'first-key'
+_KEY = 'key'
+_COLON = 'colon'
+_VALUE = 'value'
+_COMMA = 'comma'
+_FIRST_ITEM = 'first-item'
+_ITEM = 'item'
+_ITEM_COMMA = 'item-comma'
+_DONE = 'done'
+
+
+class StreamDecoder(object):
+    """Incrementally decode the members of a JSON object.
+
+    The UTF-8 encoded document is fed in chunks as it is received, and its
+    members are returned as soon as they have been decoded, so that neither
+    the whole body nor the whole decoded document is held in memory.
+
+    Without a key, the (name, value) pairs of the top level object are
+    returned, e.g. the entities of a bulk metadata response. With a key, the
+    items of the array stored under that key are returned instead, e.g. the
+    "Results" of a list or search response; other members are discarded.
+    """
+
+    def __init__(self, key=None):
+        """Initializer.
+
+        @param key The optional name of the array whose items are returned.
+        """
+        self.key = key
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._state = _START
+        self._name = None
+        # How much text must be buffered before trying to decode a value
+        # again, so that large values are not decoded over and over.
+        self._needed = 0
+
+    def feed(self, data):
+        """Decode the given chunk of the document.
+
+        @param data The next chunk of the document as bytes.
+        @return The list of members decoded so far.
+        @raise ValueError if the document is not a valid JSON object.
+        """
+        self._buffer += self._text.decode(data)
+        if len(self._buffer) < self._needed:
+            return []
+        self._needed = 0
+        items = []
+        pos = self._parse(items)
+        self._buffer = self._buffer[pos:]
+        return items
+
+    def close(self):
+        """Decode the rest of the document and check that it is complete.
+
+        @return The list of members decoded from the remaining data.
+        @raise ValueError if the document is invalid or incomplete.
+        """
+        self._buffer += self._text.decode(b'', final=True)
+        items = []
+        pos = self._parse(items)
+        self._buffer = self._buffer[pos:]
+        if self._state != _DONE or self._buffer:
+            raise ValueError('incomplete JSON document')
+        return items
+
+    def _parse(self, items):
+        """Parse the buffered text, adding decoded members to items.
+
+        @return The position of the first text which could not be parsed
+            yet.
+        """
+        buf = self._buffer
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                return pos
+            char = buf[pos]
+            state = self._state
+            if state == _START:
+                self._expect(char, '{')
+                self._state = _FIRST_KEY
+                pos += 1
+            elif state == _FIRST_KEY and char == '}':
+                self._state = _DONE
+                pos += 1
+            elif state in (_FIRST_KEY, _KEY):
+                self._expect(char, '"')
+                end = self._decode(pos)
+                if end is None:
+                    return pos
+                self._name, pos = end
+                self._state = _COLON
+            elif state == _COLON:
+                self._expect(char, ':')
+                self._state = _VALUE
+                pos += 1
+            elif state == _VALUE:
+                if self.key is not None and self._name == self.key and (
+                        char == '['):
+                    self._state = _FIRST_ITEM
+                    pos += 1
+                    continue
+                end = self._decode(pos)
+                if end is None:
+                    return pos
+                value, pos = end
+                if self.key is None:
+                    items.append((self._name, value))
+                self._state = _COMMA
+            elif state == _COMMA:
+                self._expect(char, ',}')
+                self._state = _KEY if char == ',' else _DONE
+                pos += 1
+            elif state == _FIRST_ITEM and char == ']':
+                self._state = _COMMA
+                pos += 1
+            elif state in (_FIRST_ITEM, _ITEM):
+                end = self._decode(pos)
+                if end is None:
+                    return pos
+                value, pos = end
+                items.append(value)
+                self._state = _ITEM_COMMA
+            elif state == _ITEM_COMMA:
+                self._expect(char, ',]')
+                self._state = _ITEM if char == ',' else _COMMA
+                pos += 1
+            else:
+                raise ValueError(
+                    'unexpected data after JSON document: {!r}'.format(char))
+
+    def _decode(self, pos):
+        """Decode the JSON value starting at the given buffer position.
+
+        @return A (value, end position) tuple, or None if the value is not
+            entirely buffered yet.
+        """
+        buf = self._buffer
+        try:
+            value, end = self._decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Wait for at least as much text again before retrying.
+            self._needed = 2 * (len(buf) - pos)
+            return None
+        if end == len(buf):
+            # A number could be truncated: wait for the following character.
+            self._needed = len(buf) - pos + 1
+            return None
+        return value, end
+
+    def _expect(self, char, allowed):
+        """Raise a ValueError if char is not one of the allowed characters."""
+        if char not in allowed:
+            raise ValueError('invalid JSON document: expected {!r}, '
+                             'got {!r}'.format(allowed, char))
+
+
+def iter_decode(chunks, key=None):
+    """Yield the members of a JSON object decoded from chunks of bytes.
+
+    See StreamDecoder for a description of what is yielded.
+
+    @param chunks An iterable over the UTF-8 encoded document.
+    @param key The optional name of the array whose items are yielded.
+    """
+    decoder = StreamDecoder(key)
+    for chunk in chunks:
+        for item in decoder.feed(chunk):
+            yield item
+    for item in decoder.close():
+        yield item
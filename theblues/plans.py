@@ -1,64 +1,200 @@
-from collections import namedtuple
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
 import datetime
 
+from theblues.cache import (
+    DEFAULT_MAX_ENTRIES,
+    ResultCacheMixin,
+)
 from theblues.errors import (
     log,
     ServerError,
 )
 from theblues.utils import (
+    bulk_fetch,
+    bulk_results,
     ensure_trailing_slash,
+    get_session,
     make_request,
     DEFAULT_TIMEOUT,
+    OperationTimeoutsMixin,
 )
 
 Plan = namedtuple('Plan',
                   ['url', 'plan', 'created_on', 'description', 'price'])
 PLAN_VERSION = 'v2'
+# How long in seconds the plans of a charm are cached for.
+DEFAULT_CACHE_TTL = 300
+# Most charms have no plans: how long in seconds that is cached for.
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+# How many charms' plans are requested concurrently by bulk_plans.
+DEFAULT_BULK_WORKERS = 8
+
 
+class Plans(ResultCacheMixin, OperationTimeoutsMixin):
 
-class Plans(object):
+    # The operations whose timeout can be overridden.
+    timeout_operations = ('get_plans',)
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+    # The client name reported to instruments.
+    client_name = 'plans'
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL,
+                 negative_cache_ttl=DEFAULT_NEGATIVE_CACHE_TTL,
+                 bulk_workers=DEFAULT_BULK_WORKERS):
         """Initializer.
 
         @param url The url to the Plan API.
         @param timeout How long to wait before timing out a request in seconds;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session The requests session used to send requests, defaulting
+            to the pooled session shared by all clients of the same host.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'get_plans': 1}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many charms' plans are cached, or 0 to disable
+            caching.
+        @param cache_ttl How long in seconds the plans of a charm are cached.
+        @param negative_cache_ttl How long in seconds the absence of plans
+            for a charm is cached.
+        @param bulk_workers How many charms' plans can be requested
+            concurrently by bulk_plans.
         """
         self.url = ensure_trailing_slash(url) + PLAN_VERSION + '/'
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
+        self.session = session if session is not None else get_session(url)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.bulk_workers = bulk_workers
+        self._init_result_cache(cache_size)
 
-    def get_plans(self, reference):
+    def get_plans(self, reference, deadline=None):
         """Get the plans for a given charm.
 
         @param the Reference to a charm.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return a tuple of plans or an empty tuple if no plans.
         @raise ServerError
         """
+        url = self._plans_url(reference)
+        plans = self._cached_result(url)
+        if plans is None:
+            plans = self._request_plans(url, reference, deadline)
+        return plans
+
+    def _request_plans(self, url, reference, deadline=None):
+        """Request, cache and return the plans of a charm, see get_plans."""
         json = make_request(
-            '{}charm?charm-url={}'.format(self.url,
-                                          'cs:' + reference.path()),
-            timeout=self.timeout)
-        try:
-            return tuple(map(lambda plan: Plan(
-                url=plan['url'], plan=plan['plan'],
-                created_on=datetime.datetime.strptime(
-                    plan['created-on'],
-                    "%Y-%m-%dT%H:%M:%SZ"
-                ),
-                description=plan.get('description'),
-                price=plan.get('price')), json))
-        except (KeyError, TypeError, ValueError) as err:
-            log.info(
-                'cannot process plans: invalid JSON response: {!r}'.format(
-                    json))
-            raise ServerError(
-                'unable to get list of plans for {}: {}'.format(
-                    reference.path(), err))
-        except Exception as exc:
-            log.info(
-                'cannot process plans: invalid JSON response: {!r}'.format(
-                    json))
-            raise ServerError(
-                'unable to get list of plans for {}: {}'.format(
-                    reference.path(), exc))
+            url, timeout=self._timeout('get_plans'), session=self.session,
+            retry=self.retry, circuit_breaker=self.circuit_breaker,
+            deadline=deadline, instrument=self.instrument,
+            client=self.client_name, template='/charm')
+        return self._cache_plans(url, _parse_plans(reference, json))
+
+    def bulk_plans(self, references, deadline=None):
+        """Get the plans of many charms, e.g. all the charms of a bundle.
+
+        The plans service returns the plans of a single charm per request,
+        so the plans which are not cached are requested concurrently, up to
+        bulk_workers at a time, sharing the pooled session.
+
+        @param references An iterable of References to charms.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A BulkResults dict mapping reference paths (e.g.
+            "trusty/mysql-1") to tuples of plans. The errors attribute maps
+            the paths whose plans could not be retrieved to the error raised.
+        @raise ServerError if no plans could be retrieved.
+        """
+        responses, missing = self._cached_plans(references)
+        responses.extend(bulk_fetch(
+            list(missing),
+            lambda path: self._request_plans(
+                *missing[path], deadline=deadline),
+            self.bulk_workers))
+        return bulk_results(responses)
+
+    def _cached_plans(self, references):
+        """Look up the plans of many charms in the cache.
+
+        @param references An iterable of References to charms.
+        @return A list of the (path, plans, None) responses for the cached
+            plans, and an ordered dict mapping the paths of the others to
+            (url, reference) tuples.
+        """
+        responses, missing, paths = [], OrderedDict(), set()
+        for reference in references:
+            path = reference.path()
+            if path in paths:
+                continue
+            paths.add(path)
+            url = self._plans_url(reference)
+            plans = self._cached_result(url)
+            if plans is None:
+                missing[path] = url, reference
+            else:
+                responses.append((path, plans, None))
+        return responses, missing
+
+    def _cache_plans(self, url, plans):
+        """Cache and return the plans retrieved from the given URL.
+
+        @param url The URL of the plans of a charm.
+        @param plans The tuple of plans.
+        """
+        ttl = self.cache_ttl if plans else self.negative_cache_ttl
+        return self._cache_result(url, plans, ttl, size=len(plans) or 1)
+
+    def _plans_url(self, reference):
+        """Return the URL of the plans for a given charm.
+
+        @param the Reference to a charm.
+        """
+        return '{}charm?charm-url={}'.format(self.url,
+                                             'cs:' + reference.path())
+
+
+def _parse_plans(reference, json):
+    """Return the plans included in a JSON decoded response.
+
+    @param reference The Reference to the charm the plans belong to.
+    @param json The JSON decoded response from the plans service.
+    @return a tuple of plans or an empty tuple if no plans.
+    @raise ServerError when the response is not valid.
+    """
+    try:
+        return tuple(map(lambda plan: Plan(
+            url=plan['url'], plan=plan['plan'],
+            created_on=datetime.datetime.strptime(
+                plan['created-on'],
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            description=plan.get('description'),
+            price=plan.get('price')), json))
+    except (KeyError, TypeError, ValueError) as err:
+        log.info(
+            'cannot process plans: invalid JSON response: {!r}'.format(
+                json))
+        raise ServerError(
+            'unable to get list of plans for {}: {}'.format(
+                reference.path(), err))
+    except Exception as exc:
+        log.info(
+            'cannot process plans: invalid JSON response: {!r}'.format(
+                json))
+        raise ServerError(
+            'unable to get list of plans for {}: {}'.format(
+                reference.path(), exc))
@@ -0,0 +1,350 @@
+"""Warm up the cache of a charmstore client with the promulgated catalog.
+
+The promulgated entities are listed, their metadata is retrieved with bulk
+requests and stored in the cache under the URLs used by the entity, charm,
+bundle and config methods, then their icons, bundle diagrams and readmes are
+fetched and stored as fresh responses, which the charm_icon,
+bundle_visualization and entity_readme_content methods return without
+revalidating them. Entries are stored for the listed ids (e.g.
+"cs:trusty/mysql-38") and for the same ids without their "cs:" schema and,
+for the latest listed revisions, without their revision. Requests are sent
+by a bounded pool of workers, optionally rate limited, and progress is
+reported as it goes.
+
+Prefetch into a disk cache shared by the workers of a deployment with:
+
+    python -m theblues.prefetch https://api.jujucharms.com/charmstore/v5 \\
+        --cache-dir /var/cache/theblues --workers 8 --rate 20
+"""
+from __future__ import print_function
+
+import argparse
+import json
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+
+from theblues.cache import (
+    CachedResponse,
+    cache_key,
+    DiskCache,
+)
+from theblues.charmstore import (
+    _entity_includes,
+    _REVISION_RE,
+    CharmStore,
+)
+from theblues.errors import (
+    EntityNotFound,
+    ServerError,
+)
+
+
+DEFAULT_WORKERS = 4
+# The kinds of requests made when prefetching, in the order they are made.
+KINDS = ('list', 'meta', 'icon', 'diagram', 'readme')
+# The names of the CharmStore methods generating the URLs of the files.
+_FILE_URLS = {
+    'diagram': 'bundle_visualization_url',
+    'icon': 'charm_icon_url',
+    'readme': 'entity_readme_url',
+}
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class RateLimiter(object):
+    """Space out calls so that at most rate calls start per second."""
+
+    def __init__(self, rate):
+        """Initializer.
+
+        @param rate The maximum number of calls per second.
+        """
+        self.interval = 1.0 / rate
+        self._next = _now()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed to start."""
+        with self._lock:
+            now = _now()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PrefetchReport(object):
+    """The progress and timings of a prefetch run.
+
+    The phase attribute is the step of the run ('list', 'meta' or 'files'),
+    of whose total requests done have completed. Errors map (kind, entity id)
+    tuples to the exception raised, and durations map each kind to the
+    durations in seconds of its requests.
+    """
+
+    def __init__(self):
+        self.started = _now()
+        self.phase = None
+        self.total = 0
+        self.done = 0
+        self.entities = 0
+        self.errors = {}
+        self.durations = dict((kind, []) for kind in KINDS)
+
+    @property
+    def elapsed(self):
+        """The number of seconds elapsed since the run started."""
+        return _now() - self.started
+
+    def start_phase(self, phase, total):
+        self.phase = phase
+        self.total = total
+        self.done = 0
+
+    def timings(self):
+        """Return a dict mapping request kinds to their timings.
+
+        Timings are dicts with the count, total and max duration in seconds
+        of the requests of a kind.
+        """
+        return dict(
+            (kind, {
+                'count': len(durations),
+                'total': sum(durations),
+                'max': max(durations or [0]),
+            }) for kind, durations in self.durations.items())
+
+
+def prefetch(cs, doc_type=None, workers=DEFAULT_WORKERS, rate=None,
+             progress=None):
+    """Load the promulgated entities of the charmstore into the cache.
+
+    Entity metadata and files are stored for the ids returned by the list
+    endpoint and their aliases (see _entity_aliases), so that entity, charm,
+    bundle, config, charm_icon, bundle_visualization and
+    entity_readme_content calls with those ids make no request. Errors
+    retrieving the metadata, icons, diagrams and readmes are recorded in the
+    report.
+
+    @param cs The theblues.charmstore.CharmStore whose cache is loaded.
+    @param doc_type Optionally only prefetch charms or bundles.
+    @param workers How many requests are sent concurrently.
+    @param rate An optional maximum number of requests sent per second.
+    @param progress An optional callable called with the PrefetchReport
+        whenever a request completes.
+    @return The PrefetchReport of the run.
+    @raise ValueError if the client has no cache.
+    @raise EntityNotFound or ServerError if the entities cannot be listed.
+    """
+    if cs.cache is None:
+        raise ValueError('the charmstore client has no cache to prefetch')
+    report = PrefetchReport()
+    limiter = None if rate is None else RateLimiter(rate)
+
+    def timed(kind, entity_id, func, *args):
+        if limiter is not None:
+            limiter.wait()
+        started = _now()
+        try:
+            return kind, entity_id, func(*args), None
+        except (EntityNotFound, ServerError) as err:
+            return kind, entity_id, None, err
+        finally:
+            report.durations[kind].append(_now() - started)
+
+    def completed(kind, entity_id, error):
+        report.done += 1
+        if error is not None:
+            report.errors[(kind, entity_id)] = error
+        if progress is not None:
+            progress(report)
+
+    report.start_phase('list', 1)
+    _, _, results, error = timed('list', None, lambda: cs.list(
+        doc_type=doc_type, promulgated_only=True))
+    if error is not None:
+        raise error
+    ids = [result['Id'] for result in results]
+    aliases = _entity_aliases(ids)
+    report.entities = len(ids)
+    completed('list', None, None)
+
+    includes = _entity_includes(get_files=True)
+    chunks = [chunk for chunk, _ in cs._bulk_meta_urls(ids, includes)]
+    tasks = []
+    pool = ThreadPool(max(workers, 1))
+    try:
+        report.start_phase('meta', len(chunks))
+        calls = [('meta', chunk, cs.bulk_meta, chunk, includes)
+                 for chunk in chunks]
+        for _, chunk, entities, error in pool.imap_unordered(
+                _call(timed), calls):
+            if entities is None:
+                entities = dict.fromkeys(chunk)
+                errors = dict.fromkeys(chunk, error)
+            else:
+                errors = entities.errors
+            for entity_id, data in entities.items():
+                if data is not None:
+                    names = aliases.get(entity_id, [entity_id])
+                    _store_meta(cs, names, data)
+                    tasks.extend(_file_calls(cs, names, data))
+            for entity_id, err in errors.items():
+                report.errors[('meta', entity_id)] = err
+            completed('meta', None, None)
+        report.start_phase('files', len(tasks))
+        for kind, entity_id, _, error in pool.imap_unordered(
+                _call(timed), tasks):
+            completed(kind, entity_id, error)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def _call(timed):
+    """Return a function calling timed with the arguments of a task."""
+    return lambda task: timed(*task)
+
+
+def _entity_aliases(ids):
+    """Return a dict mapping the listed ids to the ids of their entities.
+
+    An id like "cs:trusty/mysql-38" is also known as "trusty/mysql-38" and,
+    if it is the latest listed revision, as "cs:trusty/mysql" and
+    "trusty/mysql". The listed id comes first.
+    """
+    latest = {}
+    for entity_id in ids:
+        match = _REVISION_RE.search(entity_id)
+        if match is not None:
+            name = entity_id[:match.start()]
+            revision = int(match.group()[1:])
+            if revision > latest.get(name, (-1, None))[0]:
+                latest[name] = (revision, entity_id)
+    aliases = dict((entity_id, [entity_id]) for entity_id in ids)
+    for name, (_, entity_id) in latest.items():
+        aliases[entity_id].append(name)
+    for names in aliases.values():
+        names.extend([
+            name[len('cs:'):] for name in names if name.startswith('cs:')])
+    return aliases
+
+
+def _store_meta(cs, ids, data):
+    """Store the metadata of an entity in the cache of the client.
+
+    The metadata is stored under the URLs requested for each of the given
+    ids of the entity by the entity method, with and without files, and by
+    the config method.
+    """
+    meta = data.get('Meta', {})
+    without_files = json.dumps(dict(data, Meta=dict(
+        (name, value) for name, value in meta.items() if name != 'manifest'
+    ))).encode('utf-8')
+    with_files = json.dumps(data).encode('utf-8')
+    config = json.dumps(meta.get('charm-config')).encode('utf-8')
+    for entity_id in ids:
+        entries = [
+            (cs._meta_url(entity_id, _entity_includes(get_files=True)),
+             with_files),
+            (cs._meta_url(entity_id, _entity_includes()), without_files),
+        ]
+        if 'charm-config' in meta:
+            entries.append((cs._config_url(entity_id), config))
+        ttl = cs._cache_ttl(entity_id)
+        for url, content in entries:
+            cs.cache.set(cache_key(url, cs.macaroons), content, ttl=ttl)
+
+
+def _file_calls(cs, ids, data):
+    """Return the tasks fetching the icon or diagram and readme of an entity.
+    """
+    if 'bundle-metadata' in data.get('Meta', {}):
+        image = 'diagram'
+    else:
+        image = 'icon'
+    return [(kind, ids[0], _store_file, cs, kind, ids)
+            for kind in (image, 'readme')]
+
+
+def _store_file(cs, kind, ids):
+    """Fetch a file of an entity and store it in the cache of the client.
+
+    The response is stored as fresh under the URL requested for each of the
+    given ids of the entity by the method getting the file, which then
+    returns it without revalidating it while it is cached.
+
+    @param cs The theblues.charmstore.CharmStore whose cache is loaded.
+    @param kind The kind of file, one of the _FILE_URLS keys.
+    @param ids The ids of the entity, see _entity_aliases.
+    """
+    file_url = getattr(cs, _FILE_URLS[kind])
+    response = cs._get(file_url(ids[0]), operation=kind)
+    cached = CachedResponse(
+        content=response.content,
+        encoding=response.encoding,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'),
+        fresh=True)
+    for entity_id in ids:
+        cs.cache.set(
+            cache_key(file_url(entity_id), cs.macaroons), cached,
+            ttl=cs._cache_ttl(entity_id), size=len(cached.content))
+
+
+def print_progress(report, output=sys.stderr):
+    """Print a line describing the progress of a prefetch run.
+
+    @param report The PrefetchReport of the run.
+    @param output The file the line is written to.
+    """
+    print('[{:.1f}s] {}: {}/{} ({} entities, {} errors)'.format(
+        report.elapsed, report.phase, report.done, report.total,
+        report.entities, len(report.errors)), file=output)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help='the URL of the charmstore API')
+    parser.add_argument(
+        '--cache-dir', required=True,
+        help='the directory of the theblues.cache.DiskCache to load')
+    parser.add_argument(
+        '--max-bytes', type=int,
+        help='the maximum size of the cache in bytes')
+    parser.add_argument(
+        '--doc-type', choices=('charm', 'bundle'),
+        help='only prefetch charms or bundles (default: both)')
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='concurrent requests (default: %(default)s)')
+    parser.add_argument(
+        '--rate', type=float,
+        help='maximum requests per second (default: unlimited)')
+    parser.add_argument(
+        '--quiet', action='store_true', help='do not report progress')
+    options = parser.parse_args(args)
+    kwargs = {}
+    if options.max_bytes is not None:
+        kwargs['max_bytes'] = options.max_bytes
+    cache = DiskCache(options.cache_dir, **kwargs)
+    with CharmStore(options.url, cache=cache) as cs:
+        report = prefetch(
+            cs, doc_type=options.doc_type, workers=options.workers,
+            rate=options.rate,
+            progress=None if options.quiet else print_progress)
+    print(json.dumps({
+        'entities': report.entities,
+        'errors': len(report.errors),
+        'elapsed': report.elapsed,
+        'timings': report.timings(),
+    }, indent=2, sort_keys=True))
+    return 1 if report.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
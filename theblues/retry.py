@@ -0,0 +1,201 @@
+"""Retry policies for idempotent requests.
+
+A RetryPolicy decides whether a failed request is retried and how long to
+wait before retrying it, using capped exponential backoff with full jitter.
+Policies are shared by all the requests of a client and count the retries
+they allow, so that they can be exported as metrics.
+"""
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+import random
+import threading
+import time
+
+import requests
+
+from theblues.deadline import remaining
+
+
+# Methods which can be safely sent more than once.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT')
+# Response status codes denoting a transient failure.
+DEFAULT_RETRY_STATUSES = (429, 502, 503, 504)
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 0.1
+DEFAULT_BACKOFF_CAP = 5
+DEFAULT_MAX_RETRY_AFTER = 60
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class RetryPolicy(object):
+    """A thread safe policy for retrying idempotent requests.
+
+    Requests failing without a response (e.g. connection resets or timeouts)
+    or with one of the retryable status codes are retried up to max_attempts
+    times overall. Before attempt n + 1, the policy waits for a random delay
+    between 0 and min(backoff_cap, backoff_base * 2 ** (n - 1)) seconds, or
+    for longer if the server asked to with a Retry-After header. No retry is
+    attempted if it would end after the deadline, or if the server asked to
+    wait for more than max_retry_after seconds.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_cap=DEFAULT_BACKOFF_CAP,
+                 retry_statuses=DEFAULT_RETRY_STATUSES,
+                 methods=IDEMPOTENT_METHODS, deadline=None,
+                 respect_retry_after=True,
+                 max_retry_after=DEFAULT_MAX_RETRY_AFTER):
+        """Initializer.
+
+        @param max_attempts The maximum number of attempts for a request,
+            including the first one.
+        @param backoff_base The maximum delay in seconds before the first
+            retry, doubled for each subsequent retry.
+        @param backoff_cap The maximum backoff delay in seconds.
+        @param retry_statuses The response status codes which are retried.
+        @param methods The HTTP methods which are retried.
+        @param deadline The optional overall time budget in seconds for a
+            request, including all its attempts and delays.
+        @param respect_retry_after Whether to wait at least as long as
+            requested by the Retry-After header of the responses.
+        @param max_retry_after The longest delay in seconds requested by a
+            Retry-After header which is waited for. Requests asked to wait
+            longer are not retried. None means no limit.
+        """
+        if max_attempts < 1:
+            raise ValueError('at least one attempt is required')
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_statuses = frozenset(retry_statuses)
+        self.methods = frozenset(methods)
+        self.deadline = deadline
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_retry_after
+        # The number of retries made, and of transient failures which were
+        # not retried because the attempts or the deadline were exhausted.
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return the retry counters as a dict."""
+        with self._lock:
+            return {'retries': self.retries, 'exhausted': self.exhausted}
+
+    def backoff(self, attempt):
+        """Return a random delay in seconds before the next attempt.
+
+        @param attempt The number of attempts made so far.
+        """
+        ceiling = min(self.backoff_cap,
+                      self.backoff_base * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def retry_delay(self, method, attempt, elapsed, status=None,
+                    retry_after=None, remaining=None):
+        """Return how long to wait before retrying a request, or None.
+
+        @param method The HTTP method of the request.
+        @param attempt The number of attempts made so far.
+        @param elapsed The time in seconds since the first attempt started.
+        @param status The response status code, or None if the request
+            failed without a response.
+        @param retry_after The value of the Retry-After response header.
+        @param remaining The time left in seconds before the deadline of the
+            operation, if any.
+        @return The delay in seconds, or None if the request must not be
+            retried.
+        """
+        if method not in self.methods:
+            return None
+        if status is not None and status not in self.retry_statuses:
+            return None
+        delay = self.backoff(attempt)
+        too_long = False
+        if self.respect_retry_after:
+            requested = parse_retry_after(retry_after)
+            if requested is not None:
+                delay = max(delay, requested)
+                too_long = (self.max_retry_after is not None and
+                            requested > self.max_retry_after)
+        with self._lock:
+            if too_long or attempt >= self.max_attempts or (
+                    self.deadline is not None and
+                    elapsed + delay >= self.deadline) or (
+                    remaining is not None and delay >= remaining):
+                self.exhausted += 1
+                return None
+            self.retries += 1
+        return delay
+
+    def send(self, method, send, deadline=None):
+        """Send a request, retrying it as allowed by the policy.
+
+        @param method The HTTP method of the request.
+        @param send A callable sending the request and returning the
+            requests response.
+        @param deadline The optional theblues.deadline.Deadline of the
+            operation, after which no retry is attempted.
+        @return The last response received.
+        @raise The requests exception raised by the last attempt.
+        """
+        started = _now()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                delay = self.retry_delay(
+                    method, attempt, _now() - started,
+                    remaining=remaining(deadline))
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(
+                    method, attempt, _now() - started,
+                    status=response.status_code,
+                    retry_after=response.headers.get('Retry-After'),
+                    remaining=remaining(deadline))
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+
+
+def send_request(retry, method, send, deadline=None):
+    """Send a request, retrying it if a retry policy is provided.
+
+    @param retry The RetryPolicy to follow, or None.
+    @param method The HTTP method of the request.
+    @param send A callable sending the request and returning the response.
+    @param deadline The optional theblues.deadline.Deadline of the operation.
+    """
+    if retry is None:
+        return send()
+    return retry.send(method, send, deadline=deadline)
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds requested by a Retry-After header.
+
+    @param value The header value, either a number of seconds or an HTTP
+        date, or None.
+    @return The delay in seconds, or None if the value is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
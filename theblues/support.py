@@ -1,17 +1,25 @@
 from email.utils import parseaddr
-import requests
 from requests.exceptions import (
     RequestException,
     Timeout,
     )
 
+from theblues.circuit import guard
+from theblues.deadline import request_timeout
 from theblues.errors import (
     log,
     ServerError,
 )
+from theblues.instrumentation import (
+    counted,
+    instrumented,
+)
 from theblues.utils import (
     ensure_trailing_slash,
+    get_session,
     DEFAULT_TIMEOUT,
+    OperationTimeoutsMixin,
+    record_response,
 )
 
 
@@ -29,27 +37,46 @@ class Priority:
     Critical = "Critical"
 
 
-class Support(object):
+class Support(OperationTimeoutsMixin):
+
+    # The operations whose timeout can be overridden.
+    timeout_operations = ('create_case',)
+
+    # The client name reported to instruments.
+    client_name = 'support'
 
     # This represent the field name for business impact in SalesForce.
     BUSINESS_IMPACT = '00ND0000005lqBV'
 
-    def __init__(self, url, orgId, recordType, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, url, orgId, recordType, timeout=DEFAULT_TIMEOUT,
+                 session=None, circuit_breaker=None, timeouts=None,
+                 instrument=None):
         """Initializer.
 
         @param url The url to the Support server.
         @param orgId the organization Id for SalesForce.
         @param recordType the record type.
         @param timeout How long to wait before timing out a request in seconds;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session The requests session used to send requests, defaulting
+            to the pooled session shared by all clients of the same host.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'create_case': (3.05, 30)}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
         """
         self.url = ensure_trailing_slash(url)
         self.orgId = orgId
         self.recordType = recordType
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
+        self.session = session if session is not None else get_session(url)
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
 
     def create_case(self, name, email, subject, description, businessImpact,
-                    priority, phone):
+                    priority, phone, deadline=None):
         """ Send a case creation to SalesForces to create a ticket.
 
         @param name of the person creating the case.
@@ -59,6 +86,8 @@ class Support(object):
         @param businessImpact of the case.
         @param priority of the case.
         @param phone of the person creating the case.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return Nothing if this is ok.
         @raise ServerError when something goes wrong.
         @raise ValueError when data passed in are invalid
@@ -81,7 +110,7 @@ class Support(object):
             raise ValueError('empty phone')
 
         try:
-            r = requests.post(self.url, data={
+            data = {
                 'orgid': self.orgId,
                 'recordType': self.recordType,
                 'name': name,
@@ -92,11 +121,20 @@ class Support(object):
                 'priority': priority,
                 'phone': phone,
                 'external': 1
-                }, timeout=self.timeout)
-            r.raise_for_status()
+                }
+            timeout = request_timeout(
+                self._timeout('create_case'), deadline, self.url)
+            with instrumented(self.instrument, self.client_name, 'POST',
+                              self.url, '/') as record:
+                post = guard(self.circuit_breaker, self.url, counted(
+                    record, lambda: self.session.post(
+                        self.url, data=data, timeout=timeout)))
+                r = post()
+                record_response(record, r)
+                r.raise_for_status()
         except Timeout:
             message = 'Request timed out: {url} timeout: {timeout}'
-            message = message.format(url=self.url, timeout=self.timeout)
+            message = message.format(url=self.url, timeout=timeout)
             log.error(message)
             raise ServerError(message)
         except RequestException as err:
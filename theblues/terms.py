@@ -1,60 +1,199 @@
-from collections import namedtuple
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
 import datetime
 
+from theblues.cache import (
+    DEFAULT_MAX_ENTRIES,
+    ResultCacheMixin,
+)
 from theblues.errors import (
     log,
     ServerError,
 )
 from theblues.utils import (
+    bulk_fetch,
+    bulk_results,
     ensure_trailing_slash,
+    get_session,
     make_request,
     DEFAULT_TIMEOUT,
+    OperationTimeoutsMixin,
+    unique,
 )
 
 Term = namedtuple('Term',
                   ['name', 'title', 'revision', 'created_on', 'content'])
 TERMS_VERSION = 'v1'
+# How long in seconds the latest revision of terms is cached for.
+DEFAULT_CACHE_TTL = 60
+# A given revision of terms never changes, so it is kept until evicted.
+DEFAULT_REVISIONED_CACHE_TTL = None
+# How many terms are requested concurrently by bulk_terms.
+DEFAULT_BULK_WORKERS = 8
+
 
+class Terms(ResultCacheMixin, OperationTimeoutsMixin):
 
-class Terms(object):
+    # The operations whose timeout can be overridden.
+    timeout_operations = ('get_terms',)
 
-    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+    # The client name reported to instruments.
+    client_name = 'terms'
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, session=None, retry=None,
+                 circuit_breaker=None, timeouts=None, instrument=None,
+                 cache_size=DEFAULT_MAX_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL,
+                 revisioned_cache_ttl=DEFAULT_REVISIONED_CACHE_TTL,
+                 bulk_workers=DEFAULT_BULK_WORKERS):
         """Initializer.
 
         @param url The url to the Terms Service API.
         @param timeout How long to wait in seconds before timing out a request;
-            a value of None means no timeout.
+            a (connect, read) tuple of timeouts, or None for no timeout.
+        @param session The requests session used to send requests, defaulting
+            to the pooled session shared by all clients of the same host.
+        @param retry An optional theblues.retry.RetryPolicy used to retry
+            idempotent requests failing with transient errors.
+        @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+            making requests fail fast while the host is unavailable.
+        @param timeouts An optional dict overriding the timeout of some
+            operations, keyed by method name, e.g. {'get_terms': 1}.
+        @param instrument An optional theblues.instrumentation.Instrument
+            notified before and after every request.
+        @param cache_size How many terms are cached, or 0 to disable caching.
+        @param cache_ttl How long in seconds the latest revision of terms is
+            cached.
+        @param revisioned_cache_ttl How long in seconds terms requested at a
+            given revision are cached; a value of None means until evicted.
+        @param bulk_workers How many terms can be requested concurrently by
+            bulk_terms.
         """
         self.url = ensure_trailing_slash(url) + TERMS_VERSION + '/'
-        self.timeout = timeout
+        self._init_timeouts(timeout, timeouts)
+        self.session = session if session is not None else get_session(url)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.instrument = instrument
+        self.cache_ttl = cache_ttl
+        self.revisioned_cache_ttl = revisioned_cache_ttl
+        self.bulk_workers = bulk_workers
+        self._init_result_cache(cache_size)
 
-    def get_terms(self, name, revision=None):
+    def get_terms(self, name, revision=None, deadline=None):
         """ Retrieve a specific term and condition.
 
         @param name of the terms.
         @param revision of the terms,
                if none provided it will return the latest.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the request.
         @return The list of terms.
         @raise ServerError
         """
+        url = self._terms_url(name, revision)
+        term = self._cached_result(url)
+        if term is None:
+            term = self._request_terms(url, name, revision, deadline)
+        return term
+
+    def _request_terms(self, url, name, revision, deadline=None):
+        """Request, cache and return the given terms, see get_terms."""
+        json = make_request(
+            url, timeout=self._timeout('get_terms'), session=self.session,
+            retry=self.retry, circuit_breaker=self.circuit_breaker,
+            deadline=deadline, instrument=self.instrument,
+            client=self.client_name, template='/terms/{name}')
+        return self._cache_term(url, revision, _parse_terms(name, json))
+
+    def bulk_terms(self, terms, deadline=None):
+        """Retrieve many terms and conditions.
+
+        The terms service returns a single term per request, so the terms
+        which are not cached are requested concurrently, up to bulk_workers
+        at a time.
+
+        @param terms An iterable of (name, revision) tuples, the revision
+            being None for the latest.
+        @param deadline An optional theblues.deadline.Deadline limiting the
+            time spent on the requests.
+        @return A BulkResults dict mapping (name, revision) tuples to terms,
+            whose errors attribute maps the tuples which could not be
+            retrieved to the error raised.
+        @raise ServerError if no terms could be retrieved.
+        """
+        responses, missing = self._cached_terms(terms)
+        responses.extend(bulk_fetch(
+            list(missing),
+            lambda key: self._request_terms(missing[key], *key,
+                                            deadline=deadline),
+            self.bulk_workers))
+        return bulk_results(responses)
+
+    def _cached_terms(self, terms):
+        """Look up many terms in the cache.
+
+        @param terms An iterable of (name, revision) tuples.
+        @return A list of the (key, term, None) responses for the cached
+            terms, and an ordered dict mapping the (name, revision) tuples of
+            the others to their URLs.
+        """
+        responses, missing = [], OrderedDict()
+        for name, revision in unique(terms):
+            url = self._terms_url(name, revision)
+            term = self._cached_result(url)
+            if term is None:
+                missing[(name, revision)] = url
+            else:
+                responses.append(((name, revision), term, None))
+        return responses, missing
+
+    def _cache_term(self, url, revision, term):
+        """Cache and return the term retrieved from the given URL.
+
+        @param url The URL of the term.
+        @param revision The requested revision, or None for the latest.
+        @param term The term.
+        """
+        ttl = self.revisioned_cache_ttl if revision else self.cache_ttl
+        return self._cache_result(url, term, ttl, size=len(term.content))
+
+    def _terms_url(self, name, revision=None):
+        """Return the URL of a specific term and condition.
+
+        @param name of the terms.
+        @param revision of the terms,
+               if none provided the URL refers to the latest.
+        """
         url = '{}terms/{}'.format(self.url, name)
         if revision:
             url = '{}?revision={}'.format(url, revision)
-        json = make_request(url, timeout=self.timeout)
-        try:
-            # This is always a list of one element.
-            data = json[0]
-            return Term(name=data['name'],
-                        title=data.get('title'),
-                        revision=data['revision'],
-                        created_on=datetime.datetime.strptime(
-                            data['created-on'],
-                            "%Y-%m-%dT%H:%M:%SZ"
-                            ),
-                        content=data['content'])
-        except (KeyError, TypeError, ValueError, IndexError) as err:
-            log.info(
-                'cannot process terms: invalid JSON response: {!r}'.format(
-                    json))
-            raise ServerError(
-                'unable to get terms for {}: {}'.format(name, err))
+        return url
+
+
+def _parse_terms(name, json):
+    """Return the term included in a JSON decoded response.
+
+    @param name of the terms.
+    @param json The JSON decoded response from the terms service.
+    @return The term.
+    @raise ServerError when the response is not valid.
+    """
+    try:
+        # This is always a list of one element.
+        data = json[0]
+        return Term(name=data['name'],
+                    title=data.get('title'),
+                    revision=data['revision'],
+                    created_on=datetime.datetime.strptime(
+                        data['created-on'],
+                        "%Y-%m-%dT%H:%M:%SZ"
+                        ),
+                    content=data['content'])
+    except (KeyError, TypeError, ValueError, IndexError) as err:
+        log.info(
+            'cannot process terms: invalid JSON response: {!r}'.format(
+                json))
+        raise ServerError(
+            'unable to get terms for {}: {}'.format(name, err))
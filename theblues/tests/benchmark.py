@@ -0,0 +1,397 @@
+"""Benchmarks of the clients against a local stub of the backend services.
+
+A multi-threaded StubServer replays realistic charmstore, IdM, JIMM, plans and
+terms payloads after a configurable latency. Each benchmark calls a client
+method repeatedly from a number of threads, and its throughput and latency
+percentiles are reported as JSON, so that the results of two runs can be
+compared to spot regressions.
+
+Run the benchmarks with:
+
+    python -m theblues.tests.benchmark --concurrency 1,4,16 --output out.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import platform
+import sys
+import threading
+import time
+try:
+    from urlparse import (
+        parse_qs,
+        urlparse,
+    )
+except ImportError:
+    from urllib.parse import (
+        parse_qs,
+        urlparse,
+    )
+
+from jujubundlelib import references
+
+from theblues import __version__
+from theblues.charmstore import CharmStore
+from theblues.identity_manager import IdentityManager
+from theblues.jimm import JIMM
+from theblues.plans import Plans
+from theblues.terms import Terms
+from theblues.tests.helpers import StubServer
+from theblues.utils import make_session
+
+
+DEFAULT_CONCURRENCY = (1, 4, 16)
+DEFAULT_REQUESTS = 200
+# The simulated server latency in seconds.
+DEFAULT_LATENCY = 0.005
+# The number of distinct entities served by the stub charmstore.
+ENTITY_COUNT = 50
+# The number of entities requested by each bulk metadata call.
+BULK_SIZE = 10
+# The number of results of list and search requests.
+RESULT_COUNT = 20
+CREATED_ON = '2017-05-04T12:00:00Z'
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+def _entity_id(index):
+    """Return the id of the entity with the given index."""
+    return 'xenial/charm-{}'.format(index)
+
+
+def entity_payload(index):
+    """Return the metadata of a charm, as returned by the charmstore."""
+    name = 'charm-{}'.format(index)
+    charm_id = 'cs:xenial/{}-{}'.format(name, index % 10)
+    return {
+        'Id': charm_id,
+        'Meta': {
+            'id': {
+                'Id': charm_id, 'Name': name, 'Series': 'xenial',
+                'Revision': index % 10},
+            'owner': {'User': 'charmers'},
+            'promulgated': {'Promulgated': True},
+            'charm-metadata': {
+                'Name': name,
+                'Summary': 'A charm deploying {}.'.format(name),
+                'Description': 'Deploys and manages {}. '.format(name) * 20,
+                'Provides': {
+                    'website': {'Name': 'website', 'Role': 'provider',
+                                'Interface': 'http', 'Scope': 'global'},
+                },
+                'Requires': {
+                    'db': {'Name': 'db', 'Role': 'requirer',
+                           'Interface': 'mysql', 'Scope': 'global'},
+                },
+                'Tags': ['databases', 'applications'],
+                'Series': ['xenial', 'bionic'],
+            },
+            'charm-config': {
+                'Options': dict(
+                    ('option-{}'.format(i), {
+                        'Type': 'string', 'Default': '',
+                        'Description': 'The value of option {}.'.format(i),
+                    }) for i in range(15)),
+            },
+            'common-info': {
+                'bugs-url': 'https://bugs.example.com/{}'.format(name),
+                'homepage': 'https://example.com/{}'.format(name),
+            },
+            'revision-info': {
+                'Revisions': [
+                    'cs:xenial/{}-{}'.format(name, revision)
+                    for revision in range(20, 0, -1)],
+            },
+            'supported-series': {'SupportedSeries': ['xenial', 'bionic']},
+            'stats': {'ArchiveDownloadCount': 1000 + index},
+            'tags': {'Tags': ['databases', 'applications']},
+        },
+    }
+
+
+def manifest_payload():
+    """Return the manifest of a charm archive."""
+    return [
+        {'Name': 'hooks/hook-{}'.format(i), 'Size': 1024 + i,
+         'Hash': '{:064x}'.format(i)}
+        for i in range(20)] + [{'Name': 'README.md', 'Size': 2048}]
+
+
+def _json_route(payload):
+    """Return a route replying with the given JSON encoded payload."""
+    return 200, json.dumps(payload).encode('utf-8')
+
+
+def _bulk_route(handler, body):
+    """Reply to bulk metadata requests for the stub charmstore entities."""
+    query = parse_qs(urlparse(handler.path).query)
+    return _json_route(dict(
+        (entity_id, entity_payload(int(entity_id.rsplit('-', 1)[1])))
+        for entity_id in query.get('id', [])))
+
+
+def make_routes():
+    """Return the StubServer routes of all the stubbed services.
+
+    The charmstore is served under /cs, the IdM under /idm/v1, JIMM under
+    /jimm, the plans service under /plans and the terms service under /terms.
+    """
+    results = {
+        'Results': [entity_payload(index) for index in range(RESULT_COUNT)]}
+    routes = {
+        '/cs/meta/any': _bulk_route,
+        '/cs/search': _json_route(results),
+        '/cs/list': _json_route(results),
+        '/idm/v1/discharger/discharge': _json_route({'Macaroon': {
+            'location': 'https://idm.example.com',
+            'identifier': 'identifier',
+            'caveats': [{'cid': 'declared username who'}],
+            'signature': '{:064x}'.format(42),
+        }}),
+        '/jimm/model': _json_route({'models': [
+            {'uuid': '{:032x}'.format(i), 'name': 'model-{}'.format(i),
+             'owner': 'who@external', 'controller-uuid': '{:032x}'.format(0)}
+            for i in range(10)]}),
+        '/plans/v2/charm': _json_route([
+            {'url': 'canonical/plan-{}'.format(i),
+             'plan': 'metrics:\n  units:\n    type: gauge\n',
+             'created-on': CREATED_ON,
+             'description': 'Plan {}.'.format(i),
+             'price': '$0.0{}/managed machine/hour'.format(i)}
+            for i in range(3)]),
+        '/terms/v1/terms/canonical': _json_route([{
+            'name': 'canonical', 'title': 'Terms of service',
+            'revision': 4, 'created-on': CREATED_ON,
+            'content': 'The terms of the service. ' * 200,
+        }]),
+    }
+    manifest = _json_route(manifest_payload())
+    for index in range(ENTITY_COUNT):
+        path = '/cs/' + _entity_id(index)
+        routes[path + '/meta/any'] = _json_route(entity_payload(index))
+        routes[path + '/meta/manifest'] = manifest
+    return routes
+
+
+class _Macaroon(object):
+    """A macaroon with a single third party caveat, to be discharged."""
+
+    def third_party_caveats(self):
+        return [('https://idm.example.com', 'caveat-id')]
+
+
+class Clients(object):
+    """The clients used by the benchmarks, sized for a concurrency level."""
+
+    def __init__(self, url, concurrency):
+        """Initializer.
+
+        @param url The URL of the StubServer.
+        @param concurrency The number of threads sharing the clients, used
+            as the size of the connection pools.
+        """
+        self.sessions = [
+            make_session(pool_maxsize=concurrency) for _ in range(4)]
+        self.charmstore = CharmStore(
+            url + '/cs', pool_maxsize=concurrency)
+        self.identity = IdentityManager(
+            url + '/idm/v1', 'user', 'password', session=self.sessions[0])
+        self.jimm = JIMM(url + '/jimm', session=self.sessions[1])
+        # Results are not cached, so that every call makes a request.
+        self.plans = Plans(
+            url + '/plans', session=self.sessions[2], cache_size=0)
+        self.terms = Terms(
+            url + '/terms', session=self.sessions[3], cache_size=0)
+
+    def close(self):
+        self.charmstore.close()
+        for session in self.sessions:
+            session.close()
+
+
+_REFERENCE = references.Reference.from_string('cs:xenial/charm-0')
+_MACAROON = _Macaroon()
+
+# The benchmarks, as functions receiving the clients and the index of the
+# call. Calls are spread over the entities, and the search and list queries
+# vary with the index, so that concurrent calls are not coalesced.
+BENCHMARKS = {
+    'charmstore.entity': lambda clients, n: clients.charmstore.entity(
+        _entity_id(n % ENTITY_COUNT)),
+    'charmstore.entities': lambda clients, n: clients.charmstore.entities([
+        _entity_id((n + i) % ENTITY_COUNT) for i in range(BULK_SIZE)]),
+    'charmstore.search': lambda clients, n: clients.charmstore.search(
+        'charm {}'.format(n), limit=RESULT_COUNT),
+    'charmstore.list': lambda clients, n: clients.charmstore.list(
+        owner='user-{}'.format(n)),
+    'charmstore.files': lambda clients, n: clients.charmstore.files(
+        _entity_id(n % ENTITY_COUNT)),
+    'identity.discharge': lambda clients, n: clients.identity.discharge(
+        'who', _MACAROON),
+    'jimm.list_models': lambda clients, n: clients.jimm.list_models(
+        'macaroons'),
+    'plans.get_plans': lambda clients, n: clients.plans.get_plans(
+        _REFERENCE),
+    'terms.get_terms': lambda clients, n: clients.terms.get_terms(
+        'canonical'),
+}
+
+
+def percentile(values, percent):
+    """Return the given percentile of values, using the nearest rank.
+
+    @param values The sorted values.
+    @param percent The percentile, between 0 and 100.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def run_benchmark(func, clients, concurrency, count, warmup=None):
+    """Call func count times from concurrency threads and return the stats.
+
+    @param func The benchmark function, see BENCHMARKS.
+    @param clients The Clients passed to the function.
+    @param concurrency The number of threads calling the function.
+    @param count The total number of calls measured.
+    @param warmup The number of calls made before measuring, so that
+        connections are established; defaults to the concurrency.
+    @return A dict with the number of calls, errors, the throughput in calls
+        per second and the latency percentiles in milliseconds.
+    """
+    if warmup is None:
+        warmup = concurrency
+    for n in range(warmup):
+        try:
+            func(clients, n)
+        except Exception:
+            # Failures are reported by the measured calls.
+            pass
+    latencies = []
+    errors = []
+    calls = iter(range(count))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                n = next(calls, None)
+            if n is None:
+                return
+            started = _now()
+            try:
+                func(clients, n)
+            except Exception as err:
+                with lock:
+                    errors.append(err)
+                continue
+            elapsed = _now() - started
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = _now()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = _now() - started
+    latencies.sort()
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        'concurrency': concurrency,
+        'requests': count,
+        'errors': len(errors),
+        'seconds': round(duration, 3),
+        'throughput': round(len(latencies) / duration, 1) if duration else 0,
+        'latency_ms': {
+            'mean': milliseconds(
+                sum(latencies) / len(latencies) if latencies else None),
+            'p50': milliseconds(percentile(latencies, 50)),
+            'p95': milliseconds(percentile(latencies, 95)),
+            'p99': milliseconds(percentile(latencies, 99)),
+            'max': milliseconds(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def run(names=None, concurrency=DEFAULT_CONCURRENCY, count=DEFAULT_REQUESTS,
+        latency=DEFAULT_LATENCY):
+    """Run the benchmarks against a new StubServer and return the report.
+
+    @param names The names of the benchmarks to run, defaulting to all of
+        them (see BENCHMARKS).
+    @param concurrency The concurrency levels at which each benchmark runs.
+    @param count The number of calls measured per benchmark and level.
+    @param latency The latency in seconds of the StubServer responses.
+    @return The JSON serializable report. Each result also includes the
+        number of TCP connections accepted by the StubServer during the
+        benchmark, warm up included, to check that connections are reused.
+    """
+    names = sorted(BENCHMARKS) if names is None else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('unknown benchmark {!r}, expected one of: '
+                             '{}'.format(name, ', '.join(sorted(BENCHMARKS))))
+    results = []
+    with StubServer(make_routes(), latency=latency) as server:
+        for level in concurrency:
+            clients = Clients(server.url, level)
+            try:
+                for name in names:
+                    connections = server.connections
+                    result = run_benchmark(
+                        BENCHMARKS[name], clients, level, count)
+                    result['benchmark'] = name
+                    result['connections'] = server.connections - connections
+                    results.append(result)
+            finally:
+                clients.close()
+    return {
+        'theblues': __version__,
+        'python': platform.python_version(),
+        'latency': latency,
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--benchmark', action='append', dest='names',
+        choices=sorted(BENCHMARKS),
+        help='the benchmark to run, can be repeated (default: all)')
+    parser.add_argument(
+        '--concurrency', default=','.join(map(str, DEFAULT_CONCURRENCY)),
+        help='comma separated concurrency levels (default: %(default)s)')
+    parser.add_argument(
+        '--requests', type=int, default=DEFAULT_REQUESTS,
+        help='calls measured per benchmark and level (default: %(default)s)')
+    parser.add_argument(
+        '--latency', type=float, default=DEFAULT_LATENCY,
+        help='stub server latency in seconds (default: %(default)s)')
+    parser.add_argument(
+        '--output', help='the file where the JSON report is written '
+        '(default: standard output)')
+    options = parser.parse_args(args)
+    concurrency = [int(level) for level in options.concurrency.split(',')]
+    report = run(
+        names=options.names, concurrency=concurrency,
+        count=options.requests, latency=options.latency)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print(text)
+    else:
+        with open(options.output, 'w') as output:
+            output.write(text + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+# The asyncio clients use the async/await syntax.
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.extend(
+        name for name in os.listdir(os.path.dirname(__file__))
+        if name.startswith('test_aio_'))
@@ -1,10 +1,34 @@
 from contextlib import contextmanager
+import json
+import threading
+import time
+try:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from SocketServer import ThreadingMixIn
+    from urlparse import (
+        parse_qs,
+        urlparse,
+    )
+except ImportError:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (
+        parse_qs,
+        urlparse,
+    )
 
 from httmock import HTTMock
 import mock
 import requests
 
 from theblues.errors import ServerError
+from theblues.instrumentation import Instrument
 
 
 def timeout_response(url, request):
@@ -25,3 +49,194 @@ class TimeoutTestsMixin(object):
             url, timeout)
         self.assertEqual(expected_message, ctx.exception.args[0])
         mock_warn.assert_called_once_with(expected_message)
+
+
+class RecordingInstrument(Instrument):
+    """An instrument keeping the records of the requests."""
+
+    def __init__(self):
+        self.started = []
+        self.records = []
+
+    def before_request(self, record):
+        self.started.append((record.method, record.url, record.status))
+
+    def after_request(self, record):
+        self.records.append(record)
+
+
+def run_async(coro):
+    """Run the given coroutine in a new event loop and return its result."""
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def patch_make_request(test, module, respond):
+    """Patch the make_request function used by a module for a test.
+
+    @param test The TestCase whose cleanup undoes the patch.
+    @param module The name of the module, e.g. "theblues.plans".
+    @param respond A callable called with the URL and options of each
+        request, returning the decoded response or raising an error.
+    @return The mock make_request.
+    """
+    patcher = mock.patch(module + '.make_request', side_effect=respond)
+    test.addCleanup(patcher.stop)
+    return patcher.start()
+
+
+def bulk_meta_route(handler, body):
+    """Reply to bulk metadata requests, failing for "broken" ids."""
+    query = parse_qs(urlparse(handler.path).query)
+    ids = query.get('id', [])
+    if any(entity_id.startswith('broken') for entity_id in ids):
+        return 500, b'boom'
+    data = dict(
+        (entity_id, {'Id': 'cs:' + entity_id}) for entity_id in ids
+        if not entity_id.startswith('missing'))
+    if not data:
+        return 404, b''
+    return 200, json.dumps(data).encode('utf-8')
+
+
+def paged_route(count):
+    """Return a route paging through count entities using limit and skip."""
+    def route(handler, body):
+        query = parse_qs(urlparse(handler.path).query)
+        skip = int(query.get('skip', [0])[0])
+        limit = int(query.get('limit', [count])[0])
+        results = [
+            {'Id': 'cs:charm-{}'.format(i)}
+            for i in range(skip, min(skip + limit, count))]
+        return 200, json.dumps({'Results': results}).encode('utf-8')
+    return route
+
+
+def unpaged_route(count, size=None):
+    """Return a route ignoring limit and skip, as done by some servers.
+
+    The route always replies with the first size entities, all of the count
+    entities by default.
+    """
+    results = [{'Id': 'cs:charm-{}'.format(i)} for i in range(count)]
+    content = json.dumps({'Results': results[:size]}).encode('utf-8')
+
+    def route(handler, body):
+        return 200, content
+    return route
+
+
+def flaky_route(failures, response, failure=(503, b'unavailable')):
+    """Return a route failing the first given number of requests.
+
+    A failure whose status is None drops the connection without responding.
+    """
+    counter = {'calls': 0}
+
+    def route(handler, body):
+        counter['calls'] += 1
+        if counter['calls'] <= failures:
+            return failure
+        return response
+    return route
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Dispatch requests to the routes of the owning StubServer."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: do not delay the body.
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, content, headers = self.server.stub.respond(self, body)
+        if status is None:
+            # Simulate a connection reset.
+            self.close_connection = True
+            return
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_HEAD = do_POST = do_PUT = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def process_request(self, request, client_address):
+        self.stub.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+
+class StubServer(object):
+    """A local multi-threaded HTTP/1.1 server replaying canned responses.
+
+    Routes map a request path (without the query string) to either a
+    (status, content[, headers]) tuple or to a callable receiving the request
+    handler and the request body and returning such a tuple. A None status
+    closes the connection without responding. Accepted TCP
+    connections are counted so that tests can check connection reuse.
+    """
+
+    def __init__(self, routes=None, latency=0):
+        self.routes = routes or {}
+        self.latency = latency
+        self.connections = 0
+        self.requests = []
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def respond(self, handler, body):
+        path = handler.path.split('?', 1)[0]
+        self.requests.append((handler.command, handler.path))
+        if self.latency:
+            time.sleep(self.latency)
+        route = self.routes.get(path)
+        if route is None:
+            return 404, b'not found', {}
+        if callable(route):
+            route = route(handler, body)
+        if len(route) == 2:
+            route = route + ({},)
+        return route
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
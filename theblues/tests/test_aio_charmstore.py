@@ -0,0 +1,497 @@
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from mock import (
+    Mock,
+    patch,
+)
+
+from theblues.cache import MemoryCache
+from theblues.deadline import Deadline
+from theblues.errors import (
+    DeadlineExceeded,
+    EntityNotFound,
+    ServerError,
+)
+from theblues.retry import RetryPolicy
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.charmstore import AsyncCharmStore
+
+
+SAMPLE_CHARM = 'precise/mysql-1'
+META_PATH = '/%s/meta/any' % SAMPLE_CHARM
+MANIFEST_PATH = '/%s/meta/manifest' % SAMPLE_CHARM
+FILE_PATH = '/%s/archive/README.md' % SAMPLE_CHARM
+ICON_PATH = '/%s/icon.svg' % SAMPLE_CHARM
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncCharmStore(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            META_PATH: (200, b'{"Id": "cs:precise/mysql-1", "Meta": {}}'),
+            MANIFEST_PATH: (200, b'[{"Name": "README.md"}]'),
+            FILE_PATH: (200, b'This is a file.'),
+            ICON_PATH: (200, b'<svg/>'),
+            '/search': (200, b'{"Results": [{"Id": "cs:foo/bar-0"}]}'),
+            '/list': (200, b'{"Results": [{"Id": "cs:foo/bar-0"}]}'),
+            '/missing/meta/any': (404, b''),
+            '/broken/meta/any': (500, b'boom'),
+        }).start()
+        self.addCleanup(self.server.stop)
+
+    def call(self, method, *args, **kwargs):
+        """Call the given AsyncCharmStore method and return its result."""
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                return await getattr(cs, method)(*args, **kwargs)
+        return helpers.run_async(call())
+
+    def test_entity(self):
+        data = self.call('entity', SAMPLE_CHARM)
+        self.assertEqual({'Id': 'cs:precise/mysql-1', 'Meta': {}}, data)
+        self.assertIn('include=charm-metadata', self.server.requests[0][1])
+
+    def test_entity_not_found(self):
+        with self.assertRaises(EntityNotFound) as ctx:
+            self.call('entityId', 'missing')
+        self.assertEqual(
+            self.server.url + '/missing/meta/any', ctx.exception.args[0])
+
+    def test_entity_server_error(self):
+        with patch('theblues.aio.charmstore.logging.error'):
+            with self.assertRaises(ServerError) as ctx:
+                self.call('entityId', 'broken')
+        self.assertEqual(500, ctx.exception.args[0])
+        self.assertEqual('boom', ctx.exception.args[1])
+
+    def test_entity_id(self):
+        self.assertEqual('cs:precise/mysql-1',
+                         self.call('entityId', SAMPLE_CHARM))
+
+    def test_files(self):
+        files = self.call('files', SAMPLE_CHARM)
+        self.assertEqual({
+            'README.md': '{}/{}/archive/README.md'.format(
+                self.server.url, SAMPLE_CHARM),
+        }, files)
+
+    def test_files_read_file(self):
+        content = self.call(
+            'files', SAMPLE_CHARM, filename='README.md', read_file=True)
+        self.assertEqual('This is a file.', content)
+
+    def test_files_missing_file(self):
+        with self.assertRaises(EntityNotFound):
+            self.call('files', SAMPLE_CHARM, filename='nope.md')
+
+    def test_charm_icon(self):
+        self.assertEqual(b'<svg/>', self.call('charm_icon', SAMPLE_CHARM))
+
+    def test_search(self):
+        results = self.call('search', 'foo', limit=1)
+        self.assertEqual([{'Id': 'cs:foo/bar-0'}], results)
+        self.assertEqual(('GET', '/search?text=foo&limit=1'),
+                         self.server.requests[0])
+
+    def test_list(self):
+        results = self.call('list', promulgated_only=True)
+        self.assertEqual([{'Id': 'cs:foo/bar-0'}], results)
+
+    def test_timeout(self):
+        self.server.latency = 0.2
+
+        async def call():
+            async with AsyncCharmStore(self.server.url, timeout=0.05) as cs:
+                return await cs.debug()
+        with patch('theblues.aio.charmstore.logging.error'):
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(call())
+        self.assertIn('Request timed out', ctx.exception.args[0])
+
+    def test_many_requests_in_flight(self):
+        self.server.latency = 0.1
+
+        async def call():
+            async with AsyncCharmStore(self.server.url, limit=200) as cs:
+                return await asyncio.gather(
+                    *[cs.entity(SAMPLE_CHARM) for _ in range(200)])
+        start = time.time()
+        results = helpers.run_async(call())
+        self.assertEqual(200, len(results))
+        # Run serially, the requests would take at least 20 seconds.
+        self.assertLess(time.time() - start, 5)
+
+    def test_entities_chunked(self):
+        self.server.routes['/meta/any'] = helpers.bulk_meta_route
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, bulk_max_ids=2) as cs:
+                return await cs.entities(['mysql', 'wp', 'broken'])
+        with patch('theblues.aio.charmstore.logging.error'):
+            results = helpers.run_async(call())
+        self.assertEqual(['mysql', 'wp'], sorted(results))
+        self.assertEqual(['broken'], list(results.errors))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_entities_none_found(self):
+        self.server.routes['/meta/any'] = (200, b'{}')
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                entities = await cs.entities(['foo'])
+                related = await cs.fetch_related([{'Id': 'foo'}])
+                return entities, list(related)
+        entities, related = helpers.run_async(call())
+        self.assertEqual({}, entities)
+        self.assertIsInstance(entities.errors['foo'], EntityNotFound)
+        self.assertEqual([], related)
+
+    def test_cache(self):
+        cache = MemoryCache()
+
+        async def call():
+            async with AsyncCharmStore(self.server.url, cache=cache) as cs:
+                for _ in range(3):
+                    await cs.entity(SAMPLE_CHARM)
+        helpers.run_async(call())
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(2, cache.hits)
+
+    def test_provided_session_left_open(self):
+        async def call():
+            session = aiohttp.ClientSession()
+            cs = AsyncCharmStore(self.server.url, session=session)
+            await cs.close()
+            closed = session.closed
+            await session.close()
+            return closed
+        self.assertFalse(helpers.run_async(call()))
+
+    def test_sync_context_manager(self):
+        with self.assertRaises(TypeError):
+            with AsyncCharmStore(self.server.url):
+                pass
+
+    def test_identical_requests_coalesced(self):
+        self.server.latency = 0.1
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                results = await asyncio.gather(
+                    *[cs.entity(SAMPLE_CHARM) for _ in range(5)])
+                return results, cs.single_flight.shared
+        results, shared = helpers.run_async(call())
+        self.assertEqual([{'Id': 'cs:precise/mysql-1', 'Meta': {}}] * 5,
+                         results)
+        self.assertEqual(4, shared)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_coalesced_errors_shared(self):
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                return await asyncio.gather(
+                    *[cs.entity('missing') for _ in range(3)],
+                    return_exceptions=True)
+        for result in helpers.run_async(call()):
+            self.assertIsInstance(result, EntityNotFound)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_coalescing_disabled(self):
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, coalesce=False) as cs:
+                await asyncio.gather(
+                    *[cs.entity(SAMPLE_CHARM) for _ in range(3)])
+        helpers.run_async(call())
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_iter_list(self):
+        self.server.routes['/list'] = helpers.paged_route(25)
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                ids = []
+                async for entity in cs.iter_list(page_size=10):
+                    ids.append(entity['Id'])
+                return ids
+        self.assertEqual(['cs:charm-{}'.format(i) for i in range(25)],
+                         helpers.run_async(call()))
+        self.assertEqual([
+            '/list?limit=10',
+            '/list?limit=10&skip=10',
+            '/list?limit=10&skip=20',
+        ], [path for _, path in self.server.requests])
+
+    def test_iter_list_server_ignoring_paging(self):
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                ids = []
+                async for entity in cs.iter_list(page_size=10):
+                    ids.append(entity['Id'])
+                return ids
+        self.server.routes['/list'] = helpers.unpaged_route(25)
+        self.assertEqual(25, len(helpers.run_async(call())))
+        self.assertEqual(1, len(self.server.requests))
+        self.server.routes['/list'] = helpers.unpaged_route(25, 10)
+        self.assertEqual(['cs:charm-{}'.format(i) for i in range(10)],
+                         helpers.run_async(call()))
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_iter_search_aclose(self):
+        self.server.routes['/search'] = helpers.paged_route(25)
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                entities = cs.iter_search('foo', page_size=10)
+                first = await entities.__anext__()
+                await entities.aclose()
+                rest = []
+                async for entity in entities:
+                    rest.append(entity)
+                return first, rest
+        first, rest = helpers.run_async(call())
+        self.assertEqual({'Id': 'cs:charm-0'}, first)
+        self.assertEqual([], rest)
+
+    def test_stream_list(self):
+        self.server.routes['/list'] = helpers.paged_route(30)
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                ids = []
+                async for entity in cs.stream_list():
+                    ids.append(entity['Id'])
+                return ids
+        self.assertEqual(['cs:charm-{}'.format(i) for i in range(30)],
+                         helpers.run_async(call()))
+        self.assertEqual([('GET', '/list')], self.server.requests)
+
+    def test_stream_bulk_meta(self):
+        self.server.routes['/meta/any'] = helpers.bulk_meta_route
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, bulk_max_ids=2) as cs:
+                results = []
+                async for item in cs.stream_bulk_meta(
+                        ['mysql', 'missing-1', 'missing-2', 'django'],
+                        ['id']):
+                    results.append(item)
+                return results
+        self.assertEqual([
+            ('mysql', {'Id': 'cs:mysql'}),
+            ('django', {'Id': 'cs:django'}),
+        ], helpers.run_async(call()))
+
+    def test_stream_search_error(self):
+        self.server.routes['/search'] = (500, b'boom')
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                async for _ in cs.stream_search('foo'):
+                    pass
+        with patch('theblues.aio.charmstore.logging.error'):
+            with self.assertRaises(ServerError):
+                helpers.run_async(call())
+
+    def test_retried(self):
+        self.server.routes['/flaky/meta/any'] = helpers.flaky_route(
+            1, (200, b'{"Id": "cs:flaky-1"}'), failure=(502, b''))
+        policy = RetryPolicy(backoff_base=0.001)
+
+        async def call():
+            async with AsyncCharmStore(self.server.url, retry=policy) as cs:
+                return await cs.entity('flaky')
+        self.assertEqual({'Id': 'cs:flaky-1'}, helpers.run_async(call()))
+        self.assertEqual(1, policy.retries)
+
+    def test_deadline_expired(self):
+        with self.assertRaises(DeadlineExceeded):
+            self.call('entity', SAMPLE_CHARM, deadline=Deadline(0))
+        self.assertEqual([], self.server.requests)
+
+    def test_deadline_expired_skips_circuit_breaker(self):
+        breaker = Mock()
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, circuit_breaker=breaker) as cs:
+                return await cs.entity(SAMPLE_CHARM, deadline=Deadline(0))
+        with self.assertRaises(DeadlineExceeded):
+            helpers.run_async(call())
+        self.assertFalse(breaker.before_request.called)
+
+    def test_deadline_shared_by_requests(self):
+        self.server.latency = 0.3
+        started = time.time()
+        with patch('theblues.aio.charmstore.logging.error'):
+            with self.assertRaises(ServerError):
+                self.call('files', SAMPLE_CHARM, filename='README.md',
+                          read_file=True, deadline=Deadline(0.45))
+        self.assertLess(time.time() - started, 0.6)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_instrumented(self):
+        instrument = helpers.RecordingInstrument()
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, instrument=instrument) as cs:
+                await cs.entity(SAMPLE_CHARM)
+                await cs.entity(SAMPLE_CHARM)
+        helpers.run_async(call())
+        first, second = instrument.records
+        self.assertEqual('charmstore', first.client)
+        self.assertEqual('/{id}/meta/any', first.template)
+        self.assertEqual(200, first.status)
+        self.assertEqual(40, first.size)
+        self.assertIsNotNone(first.connect)
+        self.assertIsNotNone(first.ttfb)
+        # The pooled connection is reused by the second request.
+        self.assertIsNone(second.connect)
+        self.assertIsNotNone(second.ttfb)
+
+    def test_stream_instrumented(self):
+        self.server.routes['/meta/any'] = helpers.bulk_meta_route
+        instrument = helpers.RecordingInstrument()
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, bulk_max_ids=1,
+                    instrument=instrument) as cs:
+                results = []
+                async for item in cs.stream_bulk_meta(
+                        ['foo', 'missing-1'], ['id']):
+                    results.append(item)
+                return results
+        self.assertEqual(
+            [('foo', {'Id': 'cs:foo'})], helpers.run_async(call()))
+        found, missing = instrument.records
+        self.assertEqual('/meta/any', found.template)
+        self.assertEqual(200, found.status)
+        self.assertEqual(25, found.size)
+        self.assertIsNone(found.error)
+        self.assertEqual(404, missing.status)
+        self.assertIsInstance(missing.error, EntityNotFound)
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncCharmStoreDownloads(TestCase):
+
+    archive = b'archive-data' * 1000
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/%s/archive' % SAMPLE_CHARM: (200, self.archive),
+            FILE_PATH: (200, b'This is a file.'),
+            '/%s/resource/data/3' % SAMPLE_CHARM: (200, b'resource'),
+        }).start()
+        self.addCleanup(self.server.stop)
+
+    def call(self, method, *args, **kwargs):
+        """Await the given AsyncCharmStore method and return its result."""
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                return await getattr(cs, method)(*args, **kwargs)
+        return helpers.run_async(call())
+
+    def stream(self, method, *args, **kwargs):
+        """Return the chunks streamed by the given AsyncCharmStore method."""
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                chunks = []
+                async for chunk in getattr(cs, method)(*args, **kwargs):
+                    chunks.append(chunk)
+                return chunks
+        return helpers.run_async(call())
+
+    def test_stream_archive(self):
+        chunks = self.stream('stream_archive', SAMPLE_CHARM, chunk_size=1024)
+        self.assertEqual(self.archive, b''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+
+    def test_stream_file(self):
+        chunks = self.stream('stream_file', SAMPLE_CHARM, 'README.md')
+        self.assertEqual(b'This is a file.', b''.join(chunks))
+
+    def test_stream_not_found(self):
+        with self.assertRaises(EntityNotFound):
+            self.stream('stream_archive', 'missing')
+
+    def test_stream_checks_deadline(self):
+        deadline = Deadline(5)
+
+        async def call():
+            async with AsyncCharmStore(self.server.url) as cs:
+                chunks = cs.stream_archive(
+                    SAMPLE_CHARM, chunk_size=1024, deadline=deadline)
+                first = await chunks.__anext__()
+                deadline.expires = 0
+                try:
+                    await chunks.__anext__()
+                finally:
+                    await chunks.aclose()
+                return first
+        with self.assertRaises(DeadlineExceeded):
+            helpers.run_async(call())
+
+    def test_stream_instrumented(self):
+        instrument = helpers.RecordingInstrument()
+
+        async def call():
+            async with AsyncCharmStore(
+                    self.server.url, instrument=instrument) as cs:
+                async for _ in cs.stream_file(SAMPLE_CHARM, 'README.md'):
+                    pass
+        helpers.run_async(call())
+        record, = instrument.records
+        self.assertEqual(200, record.status)
+        self.assertEqual(15, record.size)
+
+    def test_download_archive_file_object(self):
+        out = io.BytesIO()
+        digest = self.call(
+            'download_archive', SAMPLE_CHARM, out, hash_name='sha384')
+        self.assertEqual(self.archive, out.getvalue())
+        self.assertEqual(hashlib.sha384(self.archive).hexdigest(), digest)
+
+    def test_download_resource_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'resource')
+        digest = self.call('download_resource', SAMPLE_CHARM, 'data', 3, path)
+        self.assertIsNone(digest)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'resource', f.read())
+
+    def test_download_file(self):
+        out = io.BytesIO()
+        digest = self.call(
+            'download_file', SAMPLE_CHARM, 'README.md', out, hash_name='md5')
+        self.assertEqual(b'This is a file.', out.getvalue())
+        self.assertEqual(hashlib.md5(b'This is a file.').hexdigest(), digest)
+
+    def test_download_error_removes_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'resource')
+        with self.assertRaises(EntityNotFound):
+            self.call('download_resource', SAMPLE_CHARM, 'data', 4, path)
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,118 @@
+import base64
+import json
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from mock import Mock
+
+from theblues.errors import InvalidMacaroon
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.identity_manager import AsyncIdentityManager
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncIdentityManager(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/v1/u/who': (200, b'{"username": "who"}'),
+            '/v1/u/who/extra-info': self.extra_info,
+            '/v1/discharger/discharge': (200, b'{"Macaroon": "something"}'),
+            '/v1/discharge-token-for-user': (
+                200, b'{"DischargeToken": "something"}'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.bodies = []
+
+    def extra_info(self, handler, body):
+        if handler.command == 'PUT':
+            self.bodies.append(json.loads(body.decode('utf-8')))
+            return 200, b''
+        return 200, b'{"foo": 1}'
+
+    def call(self, method, *args):
+        """Call the given AsyncIdentityManager method and return its result.
+        """
+        async def call():
+            async with AsyncIdentityManager(
+                    self.server.url + '/v1', 'user', 'password') as idm:
+                return await getattr(idm, method)(*args)
+        return helpers.run_async(call())
+
+    def test_get_user(self):
+        self.assertEqual({'username': 'who'}, self.call('get_user', 'who'))
+
+    def test_login(self):
+        self.call('login', 'who', {})
+        self.assertEqual(('PUT', '/v1/u/who'), self.server.requests[0])
+
+    def test_discharge(self):
+        macaroon = Mock()
+        macaroon.third_party_caveats.return_value = [('key', 'identifier')]
+        results = self.call('discharge', 'my.user+name', macaroon)
+        self.assertEqual(base64.urlsafe_b64encode(b'"something"'), results)
+        self.assertEqual(
+            ('POST', '/v1/discharger/discharge'
+             '?discharge-for-user=my.user%2Bname&id=identifier'),
+            self.server.requests[0])
+
+    def test_discharge_invalid_macaroon(self):
+        macaroon = Mock()
+        macaroon.third_party_caveats.return_value = []
+        with self.assertRaises(InvalidMacaroon):
+            self.call('discharge', 'who', macaroon)
+        self.assertEqual([], self.server.requests)
+
+    def test_discharge_token(self):
+        results = self.call('discharge_token', 'who')
+        self.assertEqual(
+            b'["something"]', base64.urlsafe_b64decode(results))
+
+    def test_extra_info(self):
+        self.call('set_extra_info', 'who', {'foo': 1})
+        self.assertEqual([{'foo': 1}], self.bodies)
+        self.assertEqual({'foo': 1}, self.call('get_extra_info', 'who'))
+
+    def test_debug_error(self):
+        self.assertIn('error', self.call('debug'))
+
+    def test_discharge_cached(self):
+        self.server.routes['/v1/discharger/discharge'] = (
+            200, json.dumps({'Macaroon': {'caveats': [
+                {'cid': 'time-before 2100-01-01T00:00:00Z'}]}}))
+        macaroon = Mock()
+        macaroon.third_party_caveats.return_value = [('key', 'identifier')]
+
+        async def call():
+            async with AsyncIdentityManager(
+                    self.server.url + '/v1', 'user', 'password',
+                    cache_discharges=True) as idm:
+                first = await idm.discharge('who', macaroon)
+                second = await idm.discharge('who', macaroon)
+                idm.invalidate_discharges('who')
+                await idm.discharge('who', macaroon)
+                return first, second
+        first, second = helpers.run_async(call())
+        self.assertEqual(first, second)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_user_cache(self):
+        async def call():
+            async with AsyncIdentityManager(
+                    self.server.url + '/v1', 'user', 'password',
+                    user_cache_ttl=60) as idm:
+                await idm.get_extra_info('who')
+                await idm.get_extra_info('who')
+                await idm.set_extra_info('who', {'foo': 2})
+                return await idm.get_extra_info('who')
+        self.assertEqual({'foo': 1}, helpers.run_async(call()))
+        self.assertEqual(
+            ['GET', 'PUT', 'GET'],
+            [method for method, _ in self.server.requests])
@@ -0,0 +1,49 @@
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.jimm import AsyncJIMM
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncJIMM(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer().start()
+        self.addCleanup(self.server.stop)
+
+    def call(self, method, *args):
+        """Call the given AsyncJIMM method and return its result."""
+        async def call():
+            async with AsyncJIMM(self.server.url) as jimm:
+                return await getattr(jimm, method)(*args)
+        return helpers.run_async(call())
+
+    def test_fetch_macaroon(self):
+        self.server.routes['/model'] = (
+            401, b'{"Info": {"Macaroon": {"foo": "bar"}}}')
+        self.assertEqual('{"foo": "bar"}', self.call('fetch_macaroon'))
+
+    def test_fetch_macaroon_invalid_json(self):
+        self.server.routes['/model'] = (401, b'{')
+        self.assertIsNone(self.call('fetch_macaroon'))
+
+    def test_fetch_macaroon_invalid_macaroon(self):
+        self.server.routes['/model'] = (401, b'{"boom": "this fails"}')
+        self.assertIsNone(self.call('fetch_macaroon'))
+
+    def test_list_models(self):
+        def handler(handler, body):
+            self.assertEqual('macaroons!', handler.headers['Macaroons'])
+            return 200, b'{"models": []}'
+        self.server.routes['/model'] = handler
+        models = self.call('list_models', 'macaroons!')
+        self.assertEqual({'models': []}, models)
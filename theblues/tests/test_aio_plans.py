@@ -0,0 +1,84 @@
+import datetime
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from jujubundlelib import references
+
+from theblues.errors import ServerError
+from theblues.plans import Plan
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.plans import AsyncPlans
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncPlans(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.ref = references.Reference.from_string(
+            'cs:trusty/landscape-mock-0')
+
+    def get_plans(self):
+        async def call():
+            async with AsyncPlans(self.server.url) as plans:
+                return await plans.get_plans(self.ref)
+        return helpers.run_async(call())
+
+    def test_get_plans(self):
+        self.server.routes['/v2/charm'] = (
+            200,
+            b'[{"url": "canonical-landscape/free", "plan": "free plan", '
+            b'"created-on": "2016-10-03T12:00:00Z", "price": "Free"}]')
+        self.assertEqual((
+            Plan(url='canonical-landscape/free',
+                 plan='free plan',
+                 created_on=datetime.datetime(2016, 10, 3, 12),
+                 description=None,
+                 price='Free'),
+        ), self.get_plans())
+        self.assertEqual(
+            ('GET', '/v2/charm?charm-url=cs:trusty/landscape-mock-0'),
+            self.server.requests[0])
+
+    def test_get_plans_invalid_data(self):
+        self.server.routes['/v2/charm'] = (200, b'[{"plan": "free plan"}]')
+        with self.assertRaises(ServerError):
+            self.get_plans()
+
+    def test_get_plans_cached(self):
+        self.server.routes['/v2/charm'] = (200, b'[]')
+
+        async def call():
+            async with AsyncPlans(self.server.url) as plans:
+                return [await plans.get_plans(self.ref) for _ in range(2)]
+        self.assertEqual([(), ()], helpers.run_async(call()))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_bulk_plans(self):
+        self.server.routes['/v2/charm'] = (200, b'[]')
+        refs = [references.Reference.from_string(url) for url in (
+            'cs:trusty/mysql-1', 'cs:trusty/wiki-2', 'cs:trusty/mysql-1')]
+
+        async def call():
+            async with AsyncPlans(self.server.url) as plans:
+                return await plans.bulk_plans(refs)
+        results = helpers.run_async(call())
+        self.assertEqual(
+            {'trusty/mysql-1': (), 'trusty/wiki-2': ()}, results)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_bulk_plans_errors(self):
+        async def call():
+            async with AsyncPlans(self.server.url) as plans:
+                return await plans.bulk_plans([self.ref])
+        with self.assertRaises(ServerError) as ctx:
+            helpers.run_async(call())
+        self.assertEqual(404, ctx.exception.args[0])
@@ -0,0 +1,81 @@
+import datetime
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from theblues.errors import ServerError
+from theblues.terms import Term
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.terms import AsyncTerms
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncTerms(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer().start()
+        self.addCleanup(self.server.stop)
+
+    def get_terms(self, name, revision=None):
+        async def call():
+            async with AsyncTerms(self.server.url) as terms:
+                return await terms.get_terms(name, revision)
+        return helpers.run_async(call())
+
+    def test_get_terms(self):
+        self.server.routes['/v1/terms/canonical'] = (
+            200,
+            b'[{"name": "canonical", "title": "some title", "revision": 3, '
+            b'"created-on": "2016-10-03T12:00:00Z", "content": "content"}]')
+        self.assertEqual(
+            Term(name='canonical', title='some title', revision=3,
+                 created_on=datetime.datetime(2016, 10, 3, 12),
+                 content='content'),
+            self.get_terms('canonical', 3))
+        self.assertEqual(('GET', '/v1/terms/canonical?revision=3'),
+                         self.server.requests[0])
+
+    def test_get_terms_not_found(self):
+        with self.assertRaises(ServerError) as ctx:
+            self.get_terms('missing')
+        self.assertEqual(404, ctx.exception.args[0])
+
+    def test_get_terms_cached(self):
+        self.server.routes['/v1/terms/canonical'] = (
+            200,
+            b'[{"name": "canonical", "revision": 3, '
+            b'"created-on": "2016-10-03T12:00:00Z", "content": "content"}]')
+
+        async def call():
+            async with AsyncTerms(self.server.url) as terms:
+                return [await terms.get_terms('canonical', 3)
+                        for _ in range(2)]
+        first, second = helpers.run_async(call())
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_bulk_terms(self):
+        for name in ('canonical', 'other'):
+            self.server.routes['/v1/terms/' + name] = (
+                200,
+                '[{{"name": "{}", "revision": 3, "content": "content", '
+                '"created-on": "2016-10-03T12:00:00Z"}}]'.format(name))
+
+        async def call():
+            async with AsyncTerms(self.server.url, bulk_workers=2) as terms:
+                return await terms.bulk_terms(
+                    [('canonical', 3), ('other', None), ('missing', 1),
+                     ('canonical', 3)])
+        results = helpers.run_async(call())
+        self.assertEqual(
+            set([('canonical', 3), ('other', None)]), set(results))
+        self.assertEqual('other', results[('other', None)].name)
+        self.assertEqual(404, results.errors[('missing', 1)].args[0])
+        self.assertEqual(3, len(self.server.requests))
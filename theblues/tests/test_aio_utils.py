@@ -0,0 +1,272 @@
+import asyncio
+import json
+import time
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+import mock
+
+from theblues.circuit import (
+    CircuitBreaker,
+    HALF_OPEN,
+)
+from theblues.errors import (
+    CircuitOpenError,
+    EntityNotFound,
+    ServerError,
+)
+from theblues.retry import RetryPolicy
+from theblues.tests import helpers
+if aiohttp is not None:
+    from theblues.aio.utils import (
+        bulk_fetch,
+        client_timeout,
+        guard,
+        make_request,
+    )
+
+
+def patch_log_error():
+    """Mock the error method of the error logger."""
+    return mock.patch('theblues.utils.log.error')
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestMakeRequest(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/': (200, b'{"foo":"bar","baz":"bax"}'),
+            '/empty': (200, b''),
+            '/invalid': (200, b'{'),
+            '/not-found': (404, b'not-found'),
+            '/failed': (500, b'server-failed'),
+            '/echo': self.echo,
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.url = self.server.url + '/'
+
+    def echo(self, handler, body):
+        self.request = {
+            'method': handler.command,
+            'body': body,
+            'headers': dict(handler.headers.items()),
+        }
+        return 200, b'{"foo":"bar"}'
+
+    def test_make_request(self):
+        response = helpers.run_async(make_request(
+            self.url, query={'uuid': 'foo'}))
+        self.assertEqual({'foo': 'bar', 'baz': 'bax'}, response)
+        self.assertEqual(('GET', '/?uuid=foo'), self.server.requests[0])
+
+    def check_write_request(self, method):
+        url = self.server.url + '/echo'
+        response = helpers.run_async(make_request(
+            url, method=method, body={'uuid': 'foo'}, auth=('who', 'pw')))
+        self.assertEqual({'foo': 'bar'}, response)
+        self.assertEqual(method, self.request['method'])
+        self.assertEqual({'uuid': 'foo'}, json.loads(
+            self.request['body'].decode('utf-8')))
+        self.assertEqual(
+            'application/json', self.request['headers']['Content-Type'])
+        self.assertEqual(
+            'Basic d2hvOnB3', self.request['headers']['Authorization'])
+
+    def test_make_post_request(self):
+        self.check_write_request('POST')
+
+    def test_make_put_request(self):
+        self.check_write_request('PUT')
+
+    def test_make_request_macaroons(self):
+        helpers.run_async(make_request(
+            self.server.url + '/echo', macaroons='[macaroon]'))
+        headers = self.request['headers']
+        self.assertEqual('1', headers['Bakery-Protocol-Version'])
+        self.assertEqual('[macaroon]', headers['Macaroons'])
+
+    def test_make_request_empty_response(self):
+        response = helpers.run_async(make_request(self.server.url + '/empty'))
+        self.assertEqual({}, response)
+
+    def test_make_request_not_found_error(self):
+        url = self.server.url + '/not-found'
+        with patch_log_error() as mock_log_error:
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(url))
+        expected_error = 'Error during request: {} message: not-found'.format(
+            url)
+        self.assertEqual((404, expected_error), ctx.exception.args)
+        mock_log_error.assert_called_once_with(expected_error)
+
+    def test_make_request_server_error(self):
+        url = self.server.url + '/failed'
+        with patch_log_error():
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(url))
+        self.assertEqual(500, ctx.exception.args[0])
+
+    def test_make_request_invalid_json(self):
+        with patch_log_error():
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(self.server.url + '/invalid'))
+        self.assertIn('Error decoding JSON response', ctx.exception.args[0])
+
+    def test_make_request_timeout(self):
+        self.server.latency = 0.2
+        with mock.patch('theblues.errors.log.warning'):
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(self.url, timeout=0.05))
+        self.assertEqual(
+            'Request timed out: {} timeout: 0.05s'.format(self.url),
+            ctx.exception.args[0])
+
+    def test_make_request_connect_read_timeouts(self):
+        self.server.latency = 0.2
+        with mock.patch('theblues.errors.log.warning'):
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(self.url, timeout=(1, 0.05)))
+        self.assertEqual(
+            'Request timed out: {} timeout: 1s connect, 0.05s read'.format(
+                self.url), ctx.exception.args[0])
+
+    def test_client_timeout(self):
+        timeout = client_timeout((3.05, 60))
+        self.assertEqual(
+            (None, 3.05, 60),
+            (timeout.total, timeout.sock_connect, timeout.sock_read))
+        self.assertEqual(10, client_timeout(10).total)
+
+    def test_make_request_invalid_method(self):
+        with self.assertRaises(ValueError) as ctx:
+            helpers.run_async(make_request(self.url, method='bad'))
+        self.assertEqual('invalid method bad', ctx.exception.args[0])
+
+    def test_concurrent_requests(self):
+        self.server.latency = 0.2
+
+        async def call():
+            async with aiohttp.ClientSession() as session:
+                return await asyncio.gather(*[
+                    make_request(self.url, session=session)
+                    for _ in range(5)])
+        start = time.time()
+        helpers.run_async(call())
+        # The requests are not sent one after the other.
+        self.assertLess(time.time() - start, 0.8)
+
+    def test_make_request_retried(self):
+        self.server.routes['/flaky'] = helpers.flaky_route(
+            2, (200, b'{}'), failure=(503, b'', {'Retry-After': '0'}))
+        policy = RetryPolicy(backoff_base=0.001)
+        response = helpers.run_async(make_request(
+            self.server.url + '/flaky', retry=policy))
+        self.assertEqual({}, response)
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual({'retries': 2, 'exhausted': 0}, policy.stats())
+
+    def test_make_request_connection_reset_retried(self):
+        self.server.routes['/flaky'] = helpers.flaky_route(
+            3, (200, b'{}'), failure=(None, b''))
+        policy = RetryPolicy(max_attempts=5, backoff_base=0.001)
+        response = helpers.run_async(make_request(
+            self.server.url + '/flaky', retry=policy))
+        self.assertEqual({}, response)
+        # Recent aiohttp versions also retry disconnected requests once.
+        self.assertGreaterEqual(policy.retries, 1)
+
+    def test_make_request_retries_exhausted(self):
+        policy = RetryPolicy(backoff_base=0.001, retry_statuses=[500])
+        with patch_log_error():
+            with self.assertRaises(ServerError) as ctx:
+                helpers.run_async(make_request(
+                    self.server.url + '/failed', retry=policy))
+        self.assertEqual(500, ctx.exception.args[0])
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual({'retries': 2, 'exhausted': 1}, policy.stats())
+
+    def test_make_request_circuit_breaker(self):
+        url = self.server.url + '/failed'
+        breaker = CircuitBreaker(failure_threshold=1)
+        with patch_log_error():
+            with self.assertRaises(ServerError):
+                helpers.run_async(make_request(url, circuit_breaker=breaker))
+            with self.assertRaises(CircuitOpenError):
+                helpers.run_async(make_request(url, circuit_breaker=breaker))
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(1, breaker.rejected)
+
+    def test_guard_releases_cancelled_trial(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(HALF_OPEN, breaker.state)
+
+        async def send():
+            raise asyncio.CancelledError()
+        with self.assertRaises(asyncio.CancelledError):
+            helpers.run_async(guard(breaker, 'url', send)())
+        # The trial slot is available again.
+        self.assertTrue(breaker.before_request('url'))
+
+    def test_make_request_instrumented(self):
+        instrument = helpers.RecordingInstrument()
+        helpers.run_async(make_request(
+            self.url, instrument=instrument, client='identity',
+            template='/'))
+        record, = instrument.records
+        self.assertEqual(('identity', 'GET', '/'), (
+            record.client, record.method, record.template))
+        self.assertEqual(200, record.status)
+        self.assertEqual(25, record.size)
+        self.assertEqual(0, record.retries)
+        # A new connection is opened by the session created for the request.
+        self.assertIsNotNone(record.connect)
+        self.assertIsNotNone(record.ttfb)
+        self.assertGreaterEqual(record.total, record.ttfb)
+
+    def test_make_request_instrumented_error(self):
+        instrument = helpers.RecordingInstrument()
+        policy = RetryPolicy(backoff_base=0.001, retry_statuses=[500])
+        with patch_log_error():
+            with self.assertRaises(ServerError):
+                helpers.run_async(make_request(
+                    self.server.url + '/failed', retry=policy,
+                    instrument=instrument))
+        record, = instrument.records
+        self.assertEqual(500, record.status)
+        self.assertEqual(2, record.retries)
+        self.assertIsInstance(record.error, ServerError)
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestBulkFetch(TestCase):
+
+    def test_bulk_fetch(self):
+        running = []
+        peak = []
+
+        async def fetch(key):
+            running.append(key)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(key)
+            if key == 'missing':
+                raise EntityNotFound(key)
+            return key.upper()
+        responses = helpers.run_async(
+            bulk_fetch(['a', 'missing', 'b', 'c'], fetch, 2))
+        self.assertEqual(
+            [('a', 'A'), ('missing', None), ('b', 'B'), ('c', 'C')],
+            [(key, value) for key, value, _ in responses])
+        self.assertIsInstance(responses[1][2], EntityNotFound)
+        self.assertEqual(2, max(peak))
+        peak[:] = []
+        helpers.run_async(bulk_fetch(['a', 'b', 'c'], fetch))
+        self.assertEqual(3, max(peak))
@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from theblues.tests import (
+    benchmark,
+    helpers,
+)
+
+
+class TestBenchmark(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, benchmark.percentile(values, 50))
+        self.assertEqual(95, benchmark.percentile(values, 95))
+        self.assertEqual(100, benchmark.percentile(values, 100))
+        self.assertEqual(1, benchmark.percentile(values, 0))
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_run(self):
+        report = benchmark.run(
+            names=['charmstore.entity', 'plans.get_plans'],
+            concurrency=[1, 2], count=4, latency=0)
+        results = [
+            (result['benchmark'], result['concurrency'], result['errors'])
+            for result in report['results']]
+        self.assertEqual([
+            ('charmstore.entity', 1, 0),
+            ('plans.get_plans', 1, 0),
+            ('charmstore.entity', 2, 0),
+            ('plans.get_plans', 2, 0),
+        ], results)
+        latency = report['results'][0]['latency_ms']
+        self.assertLessEqual(latency['p50'], latency['p99'])
+        self.assertGreater(report['results'][0]['throughput'], 0)
+        # Connections are reused, so each client opens at most one
+        # connection per thread.
+        for result in report['results']:
+            self.assertGreaterEqual(result['connections'], 1)
+            self.assertLessEqual(
+                result['connections'], result['concurrency'])
+
+    def test_queries_vary(self):
+        with helpers.StubServer(benchmark.make_routes()) as server:
+            clients = benchmark.Clients(server.url, 1)
+            self.addCleanup(clients.close)
+            for name in ('charmstore.search', 'charmstore.list'):
+                server.requests = []
+                for n in range(3):
+                    benchmark.BENCHMARKS[name](clients, n)
+                paths = [path for _, path in server.requests]
+                self.assertEqual(3, len(set(paths)), name)
+
+    def test_all_benchmarks_succeed(self):
+        report = benchmark.run(concurrency=[1], count=1, latency=0)
+        self.assertEqual(
+            sorted(benchmark.BENCHMARKS),
+            [result['benchmark'] for result in report['results']])
+        for result in report['results']:
+            self.assertEqual(0, result['errors'], result['benchmark'])
+
+    def test_unknown_benchmark(self):
+        with self.assertRaises(ValueError):
+            benchmark.run(names=['bad-wolf'])
+
+    def test_main_output(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'results.json')
+        benchmark.main([
+            '--benchmark', 'terms.get_terms', '--concurrency', '1',
+            '--requests', '2', '--latency', '0', '--output', path])
+        with open(path) as output:
+            report = json.load(output)
+        self.assertEqual(1, len(report['results']))
+        self.assertEqual(2, report['results'][0]['requests'])
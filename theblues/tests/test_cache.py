@@ -0,0 +1,246 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from theblues.cache import (
+    CachedResponse,
+    cache_key,
+    DiskCache,
+    MemoryCache,
+)
+from theblues.charmstore import CharmStore
+from theblues.tests import helpers
+
+
+class TestMemoryCache(TestCase):
+
+    def setUp(self):
+        self.cache = MemoryCache(max_entries=3, max_bytes=10)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', b'bar')
+        self.assertEqual(b'bar', self.cache.get('foo'))
+        self.assertEqual(
+            {'entries': 1, 'bytes': 3, 'hits': 1, 'misses': 1,
+             'evictions': 0},
+            self.cache.stats())
+
+    def test_expiry(self):
+        with patch('theblues.cache._now', return_value=100):
+            self.cache.set('foo', b'bar', ttl=10)
+            self.cache.set('baz', b'bar')
+        with patch('theblues.cache._now', return_value=109):
+            self.assertEqual(b'bar', self.cache.get('foo'))
+        with patch('theblues.cache._now', return_value=110):
+            self.assertIsNone(self.cache.get('foo'))
+            self.assertEqual(b'bar', self.cache.get('baz'))
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(3, self.cache.size)
+
+    def test_lru_eviction_entries(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, b'1')
+        # Use "a" so that "b" is the least recently used entry.
+        self.cache.get('a')
+        self.cache.set('d', b'1')
+        self.assertIsNone(self.cache.get('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(b'1', self.cache.get(key))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_lru_eviction_bytes(self):
+        self.cache.set('a', b'12345')
+        self.cache.set('b', b'12345')
+        self.cache.set('c', b'1')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(6, self.cache.size)
+
+    def test_too_large(self):
+        self.cache.set('a', b'12345678901')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.size)
+
+    def test_replace(self):
+        self.cache.set('a', b'12345')
+        self.cache.set('a', b'1', size=2)
+        self.assertEqual(b'1', self.cache.get('a'))
+        self.assertEqual(2, self.cache.size)
+
+    def test_delete_and_clear(self):
+        self.cache.set('a', b'1')
+        self.cache.set('b', b'1')
+        self.cache.delete('a')
+        self.cache.delete('missing')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.size)
+
+    def test_delete_prefix(self):
+        self.cache.set('a/1', b'1')
+        self.cache.set('a/2', b'1')
+        self.cache.set('b/1', b'1')
+        self.cache.delete_prefix('a/')
+        self.assertIsNone(self.cache.get('a/1'))
+        self.assertEqual(b'1', self.cache.get('b/1'))
+        self.assertEqual(1, self.cache.size)
+
+
+class TestDiskCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = DiskCache(self.directory, max_bytes=1000)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', b'bar')
+        self.assertEqual(b'bar', self.cache.get('foo'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, len(self.cache))
+
+    def test_cached_response(self):
+        response = CachedResponse(
+            content=b'<svg/>', encoding='utf-8', etag='"abc"',
+            last_modified='Wed, 21 Oct 2015 07:28:00 GMT')
+        self.cache.set('icon', response)
+        self.assertEqual(response, self.cache.get('icon'))
+        self.assertFalse(self.cache.get('icon').fresh)
+        self.cache.set('icon', response._replace(fresh=True))
+        self.assertTrue(self.cache.get('icon').fresh)
+
+    def test_invalid_value(self):
+        with self.assertRaises(TypeError):
+            self.cache.set('foo', {'bar': 1})
+
+    def test_expiry(self):
+        with patch('theblues.cache.time.time', return_value=100):
+            self.cache.set('foo', b'bar', ttl=10)
+            self.cache.set('baz', b'bar')
+        with patch('theblues.cache.time.time', return_value=109):
+            self.assertEqual(b'bar', self.cache.get('foo'))
+        with patch('theblues.cache.time.time', return_value=110):
+            self.assertIsNone(self.cache.get('foo'))
+            self.assertEqual(b'bar', self.cache.get('baz'))
+        self.assertEqual(1, len(self.cache))
+
+    def test_shared(self):
+        self.cache.set('foo', b'bar')
+        other = DiskCache(self.directory)
+        self.assertEqual(b'bar', other.get('foo'))
+        other.delete('foo')
+        self.assertIsNone(self.cache.get('foo'))
+
+    def test_replace(self):
+        self.cache.set('foo', b'bar')
+        self.cache.set('foo', b'baz')
+        self.assertEqual(b'baz', self.cache.get('foo'))
+        self.assertEqual(1, len(self.cache))
+
+    def test_large_value(self):
+        content = os.urandom(500)
+        self.cache.set('blob', content)
+        self.assertEqual(content, self.cache.get('blob'))
+
+    def test_access_time_throttled(self):
+        self.cache.set('foo', b'bar')
+        path = self.cache._path('foo')
+        now = time.time()
+        # Recently used entries are not touched again.
+        os.utime(path, (now - 30, now - 30))
+        self.cache.get('foo')
+        self.assertAlmostEqual(now - 30, os.path.getmtime(path), delta=1)
+        os.utime(path, (now - 90, now - 90))
+        self.cache.get('foo')
+        self.assertAlmostEqual(now, os.path.getmtime(path), delta=5)
+
+    def test_corrupted(self):
+        self.cache.set('foo', b'bar')
+        path = self.cache._path('foo')
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(self.cache.get('foo'))
+        # Truncated files are removed.
+        self.cache.set('foo', b'bar')
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, b'x' * 200)
+        # Make "b" the least recently used entry.
+        now = time.time()
+        for age, key in ((300, 'a'), (200, 'c'), (100, 'b')):
+            path = self.cache._path(key)
+            os.utime(path, (now - age, now - age))
+        self.cache.get('a')
+        self.cache.set('d', b'x' * 400)
+        self.assertIsNone(self.cache.get('c'))
+        for key in ('a', 'b', 'd'):
+            self.assertIsNotNone(self.cache.get(key))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertLessEqual(self.cache.stats()['bytes'], 1000)
+
+    def test_too_large(self):
+        self.cache.set('a', b'x' * 1000)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_stale_temporary_files(self):
+        stale = os.path.join(self.directory, '.tmp-stale')
+        fresh = os.path.join(self.directory, '.tmp-fresh')
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        os.utime(stale, (0, 0))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_clear(self):
+        self.cache.set('a', b'1')
+        self.cache.set('b', b'1')
+        self.cache.delete('missing')
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+
+    def test_charmstore(self):
+        server = helpers.StubServer(routes={
+            '/precise/mysql-1/meta/any': (200, b'{"Id": "precise/mysql-1"}'),
+        }).start()
+        self.addCleanup(server.stop)
+        cs = CharmStore(server.url, cache=self.cache)
+        self.addCleanup(cs.close)
+        cs.entity('precise/mysql-1')
+        # A new client, e.g. in a restarted process, finds the cache warm.
+        cs = CharmStore(server.url, cache=DiskCache(self.directory))
+        self.addCleanup(cs.close)
+        self.assertEqual(
+            {'Id': 'precise/mysql-1'}, cs.entity('precise/mysql-1'))
+        self.assertEqual(1, len(server.requests))
+
+
+class TestCacheKey(TestCase):
+
+    def test_anonymous(self):
+        key = cache_key('http://example.com/')
+        self.assertEqual('http://example.com/', key)
+
+    def test_macaroons(self):
+        key = cache_key('http://example.com/', '[macaroon]')
+        self.assertTrue(key.startswith('http://example.com/ '))
+        self.assertNotEqual(key, cache_key('http://example.com/', '[other]'))
+
+    def test_query_order(self):
+        self.assertEqual(
+            cache_key('http://example.com/meta/any?include=b&include=a'),
+            cache_key('http://example.com/meta/any?include=a&include=b'))
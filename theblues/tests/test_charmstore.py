@@ -1,3 +1,9 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
 from unittest import TestCase
 
 from httmock import (
@@ -5,9 +11,13 @@ from httmock import (
     urlmatch,
     )
 from jujubundlelib import references
-from mock import patch
+from mock import (
+    Mock,
+    patch,
+    )
 from requests.exceptions import Timeout
 
+from theblues.cache import MemoryCache
 from theblues.charmstore import (
     CharmStore,
 
@@ -17,6 +27,7 @@ from theblues.charmstore import (
     EntityNotFound,
     ServerError,
     )
+from theblues.tests import helpers
 
 
 SAMPLE_CHARM = 'precise/mysql-1'
@@ -758,3 +769,587 @@ class TestCharmStore(TestCase):
         url = self.cs.resource_url(entity_id, "myresource", "22")
         self.assertEqual('http://example.com/mongodb/resource/myresource/22',
                          url)
+
+
+class TestCharmStoreSession(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/debug/status': (200, b'{"status": "all clear"}'),
+        }).start()
+        self.addCleanup(self.server.stop)
+
+    def test_connections_reused(self):
+        with CharmStore(self.server.url) as cs:
+            for _ in range(5):
+                self.assertEqual({'status': 'all clear'}, cs.debug())
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, self.server.connections)
+
+    def test_no_keep_alive(self):
+        with CharmStore(self.server.url, keep_alive=False) as cs:
+            for _ in range(5):
+                cs.debug()
+        self.assertEqual(5, self.server.connections)
+
+    def test_pool_configuration(self):
+        cs = CharmStore('http://example.com', pool_maxsize=42)
+        adapter = cs.session.get_adapter('http://example.com')
+        self.assertEqual(42, adapter._pool_maxsize)
+
+    def test_close(self):
+        cs = CharmStore('http://example.com')
+        with patch.object(cs.session, 'close') as mock_close:
+            cs.close()
+        mock_close.assert_called_once_with()
+
+    def test_close_provided_session(self):
+        session = Mock()
+        cs = CharmStore('http://example.com', session=session)
+        self.assertIs(session, cs.session)
+        cs.close()
+        self.assertFalse(session.close.called)
+
+
+class TestCharmStoreTimeouts(TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.session.get.return_value.json.return_value = {
+            'Id': 'cs:foo', 'Results': []}
+        self.session.get.return_value.iter_content.return_value = [b'data']
+        self.cs = CharmStore(
+            'http://example.com', session=self.session, timeout=5,
+            timeouts={'meta': 1, 'archive': (3.05, 60), 'search': (1, 2)})
+
+    def assert_timeout(self, timeout):
+        self.assertEqual(timeout, self.session.get.call_args[1]['timeout'])
+
+    def test_operation_timeouts(self):
+        self.cs.entity('foo')
+        self.assert_timeout(1)
+        self.cs.search('foo')
+        self.assert_timeout((1, 2))
+        list(self.cs.iter_search('foo'))
+        self.assert_timeout((1, 2))
+        self.assertEqual([b'data'], list(self.cs.stream_archive('foo')))
+        self.assert_timeout((3.05, 60))
+
+    def test_default_timeout(self):
+        self.cs.debug()
+        self.assert_timeout(5)
+        self.cs.list()
+        self.assert_timeout(5)
+        list(self.cs.stream_file('foo', 'README.md'))
+        self.assert_timeout(5)
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            CharmStore('http://example.com', timeouts={'download': 60})
+
+
+class TestCharmStoreCache(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/precise/mysql-1/meta/any': (200, b'{"Id": "precise/mysql-1"}'),
+            '/mysql/meta/any': (200, b'{"Id": "precise/mysql-1"}'),
+            CONFIG_PATH: (200, b'{"exists": true}'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cache = MemoryCache()
+        self.cs = CharmStore(self.server.url, cache=self.cache)
+        self.addCleanup(self.cs.close)
+
+    def test_entity_cached(self):
+        for _ in range(3):
+            data = self.cs.entity(SAMPLE_CHARM)
+            self.assertEqual({'Id': 'precise/mysql-1'}, data)
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(2, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_cached_data_not_shared(self):
+        self.cs.entity(SAMPLE_CHARM)['Id'] = 'changed'
+        self.assertEqual('precise/mysql-1', self.cs.entity(SAMPLE_CHARM)['Id'])
+
+    def test_config_and_entity_id_cached(self):
+        self.cs.config(SAMPLE_CHARM)
+        self.cs.config(SAMPLE_CHARM)
+        self.cs.entityId('mysql')
+        self.cs.entityId('mysql')
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_ttl(self):
+        self.cs.cache_ttl = 10
+        with patch('theblues.cache._now', return_value=100):
+            self.cs.entityId('mysql')
+            self.cs.entityId(SAMPLE_CHARM)
+        with patch('theblues.cache._now', return_value=1000):
+            self.cs.entityId('mysql')
+            self.cs.entityId(SAMPLE_CHARM)
+        # Only the unrevisioned id is queried again.
+        self.assertEqual(['/mysql/meta/any', '/precise/mysql-1/meta/any',
+                          '/mysql/meta/any'],
+                         [path for _, path in self.server.requests])
+
+    def test_cache_ttl(self):
+        self.assertIsNone(self.cs._cache_ttl('precise/mysql-1'))
+        self.assertIsNone(self.cs._cache_ttl(
+            references.Reference.from_string('cs:~who/mysql-42')))
+        self.assertEqual(60, self.cs._cache_ttl('mysql'))
+        self.assertEqual(60, self.cs._cache_ttl('precise/mysql'))
+        self.assertEqual(
+            60, self.cs._cache_ttl('precise/mysql-1', channel='edge'))
+
+    def test_macaroons_part_of_key(self):
+        self.cs.entityId('mysql')
+        self.cs.macaroons = '[macaroon]'
+        self.cs.entityId('mysql')
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(EntityNotFound):
+                self.cs.entityId('missing')
+        self.assertEqual(2, len(self.server.requests))
+
+
+class TestCharmStoreConditionalRequests(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            ICON_PATH: self.conditional(b'<svg/>', etag='"v1"'),
+            README_PATH: self.conditional(
+                b'This is the readme', last_modified='Mon, 03 Oct 2016'),
+            MANIFEST_PATH: (200, b'[{"Name": "README.md"}]'),
+            FILE_PATH: self.conditional(b'This is a file.', etag='"f1"'),
+            DIAGRAM_PATH: (200, b'<svg/>'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cache = MemoryCache()
+        self.cs = CharmStore(self.server.url, cache=self.cache)
+        self.addCleanup(self.cs.close)
+        self.statuses = []
+
+    def conditional(self, content, etag=None, last_modified=None):
+        """Return a route replying 304 if the request validators match."""
+        def route(handler, body):
+            headers = {}
+            if etag is not None:
+                headers['ETag'] = etag
+            if last_modified is not None:
+                headers['Last-Modified'] = last_modified
+            if ((etag and handler.headers.get('If-None-Match') == etag) or
+                    (last_modified and handler.headers.get(
+                        'If-Modified-Since') == last_modified)):
+                self.statuses.append(304)
+                return 304, b'', headers
+            self.statuses.append(200)
+            return 200, content, headers
+        return route
+
+    def test_etag(self):
+        for _ in range(3):
+            self.assertEqual(b'<svg/>', self.cs.charm_icon(SAMPLE_CHARM))
+        self.assertEqual([200, 304, 304], self.statuses)
+
+    def test_last_modified(self):
+        for _ in range(2):
+            content = self.cs.entity_readme_content(SAMPLE_CHARM)
+            self.assertEqual('This is the readme', content)
+        self.assertEqual([200, 304], self.statuses)
+
+    def test_read_file(self):
+        for _ in range(2):
+            content = self.cs.files(
+                SAMPLE_CHARM, filename='README.md', read_file=True)
+            self.assertEqual('This is a file.', content)
+        self.assertEqual([200, 304], self.statuses)
+
+    def test_no_validators(self):
+        self.cs.bundle_visualization(SAMPLE_BUNDLE)
+        self.cs.bundle_visualization(SAMPLE_BUNDLE)
+        self.assertEqual(0, len(self.cache))
+
+    def test_no_cache(self):
+        self.cs.cache = None
+        self.cs.charm_icon(SAMPLE_CHARM)
+        self.cs.charm_icon(SAMPLE_CHARM)
+        self.assertEqual([200, 200], self.statuses)
+
+    def test_changed(self):
+        self.cs.charm_icon(SAMPLE_CHARM)
+        self.server.routes[ICON_PATH] = self.conditional(
+            b'<svg>new</svg>', etag='"v2"')
+        self.assertEqual(b'<svg>new</svg>', self.cs.charm_icon(SAMPLE_CHARM))
+        self.assertEqual(b'<svg>new</svg>', self.cs.charm_icon(SAMPLE_CHARM))
+        self.assertEqual([200, 200, 304], self.statuses)
+
+
+class TestCharmStoreDownloads(TestCase):
+
+    archive = b'archive-data' * 1000
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/%s/archive' % SAMPLE_CHARM: (200, self.archive),
+            FILE_PATH: (200, b'This is a file.'),
+            '/%s/resource/data/3' % SAMPLE_CHARM: (200, b'resource'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cs = CharmStore(self.server.url)
+        self.addCleanup(self.cs.close)
+
+    def test_stream_archive(self):
+        chunks = list(self.cs.stream_archive(SAMPLE_CHARM, chunk_size=1024))
+        self.assertEqual(self.archive, b''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+        self.assertEqual(12, len(chunks))
+
+    def test_stream_file(self):
+        chunks = self.cs.stream_file(SAMPLE_CHARM, SAMPLE_FILE)
+        self.assertEqual(b'This is a file.', b''.join(chunks))
+
+    def test_stream_not_found(self):
+        with self.assertRaises(EntityNotFound):
+            list(self.cs.stream_archive('missing'))
+
+    def test_download_archive_file_object(self):
+        out = io.BytesIO()
+        digest = self.cs.download_archive(
+            SAMPLE_CHARM, out, hash_name='sha384')
+        self.assertEqual(self.archive, out.getvalue())
+        self.assertEqual(hashlib.sha384(self.archive).hexdigest(), digest)
+
+    def test_download_resource_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'resource')
+        digest = self.cs.download_resource(SAMPLE_CHARM, 'data', 3, path)
+        self.assertIsNone(digest)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'resource', f.read())
+
+    def test_download_file(self):
+        out = io.BytesIO()
+        digest = self.cs.download_file(
+            SAMPLE_CHARM, SAMPLE_FILE, out, hash_name='md5')
+        self.assertEqual(b'This is a file.', out.getvalue())
+        self.assertEqual(hashlib.md5(b'This is a file.').hexdigest(), digest)
+
+    def test_download_error_removes_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'resource')
+        with self.assertRaises(EntityNotFound):
+            self.cs.download_resource(SAMPLE_CHARM, 'data', 4, path)
+        self.assertFalse(os.path.exists(path))
+
+
+class TestCharmStoreBulk(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/meta/any': helpers.bulk_meta_route,
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cs = CharmStore(self.server.url, bulk_max_ids=10)
+        self.addCleanup(self.cs.close)
+
+    def test_bulk_meta_urls_max_ids(self):
+        ids = ['mysql-{}'.format(i) for i in range(25)]
+        chunks = self.cs._bulk_meta_urls(ids, ['id'])
+        self.assertEqual([10, 10, 5], [len(c[0]) for c in chunks])
+        self.assertEqual(ids, sum([c[0] for c in chunks], []))
+        self.assertEqual(
+            self.server.url + '/meta/any?include=id&id=mysql-20&id=mysql-21'
+            '&id=mysql-22&id=mysql-23&id=mysql-24', chunks[2][1])
+
+    def test_bulk_meta_urls_max_length(self):
+        self.cs.bulk_max_url_length = 100
+        ids = ['~who/trusty/charm-{}'.format(i) for i in range(10)]
+        chunks = self.cs._bulk_meta_urls(ids, ['id', 'stats'])
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(ids, sum([c[0] for c in chunks], []))
+        for _, url in chunks:
+            self.assertLessEqual(len(url), 100)
+
+    def test_entities_chunked(self):
+        ids = ['mysql-{}'.format(i) for i in range(25)]
+        results = self.cs.entities(ids)
+        self.assertEqual(set(ids), set(results))
+        self.assertEqual({'Id': 'cs:mysql-3'}, results['mysql-3'])
+        self.assertEqual({}, results.errors)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_entities_concurrent(self):
+        self.server.latency = 0.2
+        threads = set()
+        get = self.cs._get
+
+        def _get(url, **kwargs):
+            threads.add(threading.current_thread())
+            return get(url, **kwargs)
+        with patch.object(self.cs, '_get', _get):
+            self.cs.entities(['mysql-{}'.format(i) for i in range(40)])
+        self.assertEqual(4, len(threads))
+
+    def test_entities_partial_failure(self):
+        ids = ['broken-{}'.format(i) for i in range(10)] + ['mysql', 'wp']
+        with patch('theblues.charmstore.logging.error'):
+            results = self.cs.entities(ids)
+        self.assertEqual(['mysql', 'wp'], sorted(results))
+        self.assertEqual(set(ids[:10]), set(results.errors))
+        error = results.errors['broken-0']
+        self.assertIsInstance(error, ServerError)
+        self.assertEqual(500, error.args[0])
+
+    def test_entities_partially_found(self):
+        ids = ['mysql', 'missing-1', 'wp', 'missing-2']
+        self.cs.bulk_max_ids = 2
+        results = self.cs.entities(ids)
+        self.assertEqual(['mysql', 'wp'], sorted(results))
+        self.assertEqual(['missing-1', 'missing-2'], sorted(results.errors))
+        error = results.errors['missing-1']
+        self.assertIsInstance(error, EntityNotFound)
+        self.assertEqual('missing-1', error.args[0])
+
+    def test_entities_all_failed(self):
+        with self.assertRaises(EntityNotFound):
+            self.cs.entities(['missing'])
+
+    def test_entities_none_found(self):
+        # The charmstore answers 200 and omits the unknown ids.
+        self.server.routes['/meta/any'] = (200, b'{}')
+        self.cs.bulk_max_ids = 1
+        results = self.cs.entities(['foo', 'bar'])
+        self.assertEqual({}, results)
+        self.assertEqual(['bar', 'foo'], sorted(results.errors))
+        self.assertIsInstance(results.errors['foo'], EntityNotFound)
+        self.assertEqual('foo', results.errors['foo'].args[0])
+
+    def test_entities_empty(self):
+        self.assertEqual({}, self.cs.entities([]))
+        self.assertEqual([], self.server.requests)
+
+    def test_bulk_meta(self):
+        ids = ['mysql-{}'.format(i) for i in range(15)]
+        results = self.cs.bulk_meta(ids, ['charm-metadata', 'stats'])
+        self.assertEqual(set(ids), set(results))
+        self.assertEqual(2, len(self.server.requests))
+        # Chunks are sent concurrently and may be received in any order.
+        paths = sorted(path for _, path in self.server.requests)
+        self.assertTrue(paths[0].startswith(
+            '/meta/any?include=charm-metadata&include=stats&id=mysql-0&'))
+
+    def test_bulk_meta_no_includes(self):
+        with self.assertRaises(ValueError):
+            self.cs.bulk_meta(['mysql'], [])
+
+    def test_fetch_related(self):
+        results = self.cs.fetch_related(
+            ['mysql', references.Reference.from_string('trusty/wp-1')])
+        self.assertEqual(
+            [{'Id': 'cs:mysql'}, {'Id': 'cs:trusty/wp-1'}],
+            sorted(results, key=lambda r: r['Id']))
+        self.assertEqual(
+            '/meta/any?include=bundle-metadata&include=stats'
+            '&include=supported-series&include=extra-info'
+            '&include=bundle-unit-count&include=owner'
+            '&id=mysql&id=trusty/wp-1', self.server.requests[0][1])
+
+    def test_fetch_related_id_dicts(self):
+        results = self.cs.fetch_related([{'Id': 'mysql'}, {'Id': 'wp'}])
+        self.assertEqual(2, len(results))
+
+    def test_fetch_related_empty(self):
+        self.assertEqual([], self.cs.fetch_related([]))
+
+    def test_fetch_related_none_found(self):
+        self.server.routes['/meta/any'] = (200, b'{}')
+        self.assertEqual([], list(self.cs.fetch_related([{'Id': 'foo'}])))
+
+
+class TestCharmStoreCoalescing(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/precise/mysql-1/meta/any': (
+                200, b'{"Id": "cs:precise/mysql-1", "Meta": {}}'),
+            '/missing/meta/any': (404, b''),
+        }, latency=0.2).start()
+        self.addCleanup(self.server.stop)
+
+    def concurrently(self, func, count=5):
+        """Call func from count threads and return results or errors."""
+        results = []
+
+        def run():
+            try:
+                results.append(func())
+            except Exception as err:
+                results.append(err)
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_coalesced(self):
+        with CharmStore(self.server.url) as cs:
+            results = self.concurrently(
+                lambda: cs.entity('precise/mysql-1'))
+        self.assertEqual(
+            [{'Id': 'cs:precise/mysql-1', 'Meta': {}}] * 5, results)
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(4, cs.single_flight.shared)
+
+    def test_errors_shared(self):
+        with CharmStore(self.server.url) as cs:
+            results = self.concurrently(lambda: cs.entity('missing'))
+        self.assertEqual(5, len(results))
+        for result in results:
+            self.assertIsInstance(result, EntityNotFound)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_macaroons_not_coalesced(self):
+        url = self.server.url + '/precise/mysql-1/meta/any'
+        with CharmStore(self.server.url) as cs:
+            other = CharmStore(self.server.url, macaroons='macaroons')
+            self.addCleanup(other.close)
+            other.single_flight = cs.single_flight
+            stores = iter([cs, other])
+            self.concurrently(lambda: next(stores)._get(url), count=2)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_coalescing_disabled(self):
+        with CharmStore(self.server.url, coalesce=False) as cs:
+            self.concurrently(lambda: cs.entity('precise/mysql-1'))
+        self.assertIsNone(cs.single_flight)
+        self.assertEqual(5, len(self.server.requests))
+
+
+class TestCharmStorePaging(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/list': helpers.paged_route(25),
+            '/search': helpers.paged_route(20),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cs = CharmStore(self.server.url)
+        self.addCleanup(self.cs.close)
+
+    def test_iter_list(self):
+        entities = list(self.cs.iter_list(
+            promulgated_only=True, page_size=10))
+        self.assertEqual(
+            ['cs:charm-{}'.format(i) for i in range(25)],
+            [entity['Id'] for entity in entities])
+        paths = [path for _, path in self.server.requests]
+        self.assertEqual([
+            '/list?promulgated=1&limit=10',
+            '/list?promulgated=1&limit=10&skip=10',
+            '/list?promulgated=1&limit=10&skip=20',
+        ], paths)
+
+    def test_iter_search(self):
+        entities = list(self.cs.iter_search('foo', page_size=10))
+        self.assertEqual(20, len(entities))
+        # A full last page requires one more request to find the end.
+        paths = [path for _, path in self.server.requests]
+        self.assertEqual([
+            '/search?text=foo&limit=10',
+            '/search?text=foo&limit=10&skip=10',
+            '/search?text=foo&limit=10&skip=20',
+        ], paths)
+
+    def test_iter_limit_ignored(self):
+        self.server.routes['/list'] = helpers.unpaged_route(25)
+        entities = list(self.cs.iter_list(page_size=10))
+        self.assertEqual(25, len(entities))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_iter_skip_ignored(self):
+        self.server.routes['/list'] = helpers.unpaged_route(25, 10)
+        entities = list(self.cs.iter_list(page_size=10))
+        self.assertEqual(
+            ['cs:charm-{}'.format(i) for i in range(10)],
+            [entity['Id'] for entity in entities])
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_iter_empty_page(self):
+        self.server.routes['/list'] = helpers.unpaged_route(0)
+        self.assertEqual([], list(self.cs.iter_list(page_size=10)))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_iter_lazy(self):
+        entities = self.cs.iter_list(page_size=10)
+        self.assertEqual([], self.server.requests)
+        self.assertEqual('cs:charm-0', next(entities)['Id'])
+        entities.close()
+        self.assertLessEqual(len(self.server.requests), 2)
+
+    def test_iter_error(self):
+        entities = self.cs.iter_list(page_size=10)
+        self.server.routes['/list'] = (500, b'boom')
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(ServerError):
+                next(entities)
+
+    def test_iter_invalid_page_size(self):
+        with self.assertRaises(ValueError):
+            self.cs.iter_search('foo', page_size=0)
+
+
+class TestCharmStoreStreamingJSON(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/list': helpers.paged_route(30),
+            '/search': helpers.paged_route(5),
+            '/meta/any': helpers.bulk_meta_route,
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cs = CharmStore(self.server.url, bulk_max_ids=2)
+        self.addCleanup(self.cs.close)
+
+    def test_stream_list(self):
+        entities = self.cs.stream_list(promulgated_only=True)
+        self.assertEqual([], self.server.requests)
+        self.assertEqual(
+            ['cs:charm-{}'.format(i) for i in range(30)],
+            [entity['Id'] for entity in entities])
+        self.assertEqual(
+            [('GET', '/list?promulgated=1')], self.server.requests)
+
+    def test_stream_search(self):
+        entities = list(self.cs.stream_search('foo', limit=3))
+        self.assertEqual(
+            ['cs:charm-0', 'cs:charm-1', 'cs:charm-2'],
+            [entity['Id'] for entity in entities])
+
+    def test_stream_bulk_meta(self):
+        results = list(self.cs.stream_bulk_meta(
+            ['mysql', 'missing-1', 'missing-2', 'wordpress'], ['id']))
+        self.assertEqual([
+            ('mysql', {'Id': 'cs:mysql'}),
+            ('wordpress', {'Id': 'cs:wordpress'}),
+        ], results)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_stream_bulk_meta_error(self):
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(ServerError):
+                list(self.cs.stream_bulk_meta(['mysql', 'broken'], ['id']))
+
+    def test_stream_bulk_meta_no_includes(self):
+        with self.assertRaises(ValueError):
+            self.cs.stream_bulk_meta(['mysql'], [])
+
+    def test_stream_invalid_json(self):
+        self.server.routes['/list'] = (200, b'{"Results": [{"Id": ')
+        with self.assertRaises(ValueError):
+            list(self.cs.stream_list())
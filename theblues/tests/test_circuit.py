@@ -0,0 +1,176 @@
+from unittest import TestCase
+
+from jujubundlelib import references
+from mock import patch
+import requests
+
+from theblues.charmstore import CharmStore
+from theblues.circuit import (
+    CircuitBreaker,
+    CLOSED,
+    get_circuit_breaker,
+    HALF_OPEN,
+    OPEN,
+)
+from theblues.deadline import Deadline
+from theblues.errors import (
+    CircuitOpenError,
+    DeadlineExceeded,
+    ServerError,
+)
+from theblues.plans import Plans
+from theblues.retry import RetryPolicy
+from theblues.tests import helpers
+from theblues.utils import make_request
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        patcher = patch('theblues.circuit._now', return_value=100)
+        self.now = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('theblues.circuit.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            name='example.com', failure_threshold=2, reset_timeout=10)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.breaker.record_status(503)
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            self.breaker.before_request('http://example.com/path')
+        self.assertEqual(
+            'Circuit open for example.com: request not sent: '
+            'http://example.com/path', ctx.exception.args[0])
+        self.assertIsInstance(ctx.exception, ServerError)
+        self.assertEqual(
+            {'state': OPEN, 'failures': 2, 'opened': 1, 'rejected': 1},
+            self.breaker.stats())
+
+    def test_client_errors_are_successes(self):
+        for _ in range(3):
+            self.breaker.record_status(404)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_half_open_trial_success(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now.return_value = 110
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.breaker.before_request('url')
+        # Only one trial request is let through at a time.
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_request('url')
+        self.breaker.record_success()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.breaker.before_request('url')
+
+    def test_half_open_trial_failure(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now.return_value = 110
+        self.breaker.before_request('url')
+        self.breaker.record_failure()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.opened)
+        self.now.return_value = 119
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_half_open_trial_released_on_other_errors(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now.return_value = 110
+
+        def send():
+            raise requests.exceptions.ChunkedEncodingError('truncated')
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.breaker.send('url', send)
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        # The trial slot is available again.
+        self.breaker.before_request('url')
+
+    def test_reset(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.reset()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_invalid_threshold(self):
+        with self.assertRaises(ValueError):
+            CircuitBreaker(failure_threshold=0)
+
+    def test_get_circuit_breaker(self):
+        breaker = get_circuit_breaker('http://example.com:8080/v1/')
+        self.assertIs(breaker, get_circuit_breaker('http://example.com:8080'))
+        self.assertIsNot(breaker, get_circuit_breaker('http://example.com'))
+        self.assertEqual('example.com:8080', breaker.name)
+
+
+class TestCircuitBreakerRequests(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/v2/charm': (503, b'unavailable'),
+            '/mysql/meta/any': (503, b'unavailable'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2)
+        patcher = patch('theblues.utils.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_make_request_fails_fast(self):
+        url = self.server.url + '/v2/charm'
+        for _ in range(2):
+            with self.assertRaises(ServerError):
+                make_request(url, circuit_breaker=self.breaker)
+        with self.assertRaises(CircuitOpenError):
+            make_request(url, circuit_breaker=self.breaker)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_make_request_deadline_half_open(self):
+        url = self.server.url + '/v2/charm'
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(ServerError):
+            make_request(url, circuit_breaker=breaker)
+        self.assertEqual(HALF_OPEN, breaker.state)
+        with self.assertRaises(DeadlineExceeded):
+            make_request(
+                url, circuit_breaker=breaker, deadline=Deadline(0.0))
+        # The expired request did not keep the trial slot.
+        with self.assertRaises(ServerError):
+            make_request(url, circuit_breaker=breaker)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_retries_stop_when_open(self):
+        retry = RetryPolicy(max_attempts=5, backoff_base=0.001)
+        with self.assertRaises(CircuitOpenError):
+            make_request(self.server.url + '/v2/charm', retry=retry,
+                         circuit_breaker=self.breaker)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_plans(self):
+        plans = Plans(self.server.url, circuit_breaker=self.breaker)
+        reference = references.Reference.from_string('mysql')
+        for _ in range(2):
+            with self.assertRaises(ServerError):
+                plans.get_plans(reference)
+        self.assertEqual(OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError):
+            plans.get_plans(reference)
+
+    def test_charmstore(self):
+        with CharmStore(self.server.url, circuit_breaker=self.breaker) as cs:
+            with patch('theblues.charmstore.logging.error'):
+                for _ in range(2):
+                    with self.assertRaises(ServerError):
+                        cs.entity('mysql')
+            with self.assertRaises(CircuitOpenError):
+                cs.entity('mysql')
+        self.assertEqual(2, len(self.server.requests))
@@ -0,0 +1,155 @@
+import time
+from unittest import TestCase
+
+from mock import (
+    Mock,
+    patch,
+)
+
+from theblues.charmstore import CharmStore
+from theblues.deadline import (
+    Deadline,
+    remaining,
+    request_timeout,
+)
+from theblues.errors import (
+    DeadlineExceeded,
+    ServerError,
+)
+from theblues.retry import RetryPolicy
+from theblues.tests import helpers
+from theblues.utils import make_request
+
+
+SAMPLE_CHARM = 'precise/mysql-1'
+
+
+class TestDeadline(TestCase):
+
+    def test_remaining(self):
+        deadline = Deadline(10)
+        self.assertLessEqual(deadline.remaining(), 10)
+        self.assertGreater(deadline.remaining(), 9)
+        self.assertFalse(deadline.expired)
+
+    def test_expired(self):
+        deadline = Deadline(0)
+        self.assertEqual(0, deadline.remaining())
+        self.assertTrue(deadline.expired)
+        with self.assertRaises(DeadlineExceeded) as ctx:
+            deadline.check('http://example.com')
+        self.assertEqual(
+            'Deadline exceeded: http://example.com budget: 0s',
+            ctx.exception.args[0])
+
+    def test_timeout(self):
+        deadline = Deadline(5)
+        self.assertEqual(1, deadline.timeout(1, 'http://example.com'))
+        self.assertLessEqual(deadline.timeout(10, 'http://example.com'), 5)
+        self.assertLessEqual(deadline.timeout(None, 'http://example.com'), 5)
+
+    def test_connect_read_timeout(self):
+        deadline = Deadline(5)
+        self.assertEqual(
+            (1, 2), deadline.timeout((1, 2), 'http://example.com'))
+        connect, read = deadline.timeout((1, None), 'http://example.com')
+        self.assertEqual(1, connect)
+        self.assertLessEqual(read, 5)
+        connect, read = deadline.timeout((10, 60), 'http://example.com')
+        self.assertLessEqual(connect, 5)
+        self.assertLessEqual(read, 5)
+
+    def test_request_timeout(self):
+        self.assertEqual(10, request_timeout(10, None, 'http://example.com'))
+        self.assertLessEqual(
+            request_timeout(10, Deadline(2), 'http://example.com'), 2)
+        with self.assertRaises(DeadlineExceeded):
+            request_timeout(10, Deadline(0), 'http://example.com')
+
+    def test_remaining_without_deadline(self):
+        self.assertIsNone(remaining(None))
+
+
+class TestDeadlinePropagation(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/%s/meta/any' % SAMPLE_CHARM: (200, b'{"Id": "cs:mysql"}'),
+            '/%s/meta/manifest' % SAMPLE_CHARM: (
+                200, b'[{"Name": "README.md"}]'),
+            '/%s/archive/README.md' % SAMPLE_CHARM: (200, b'Read me.'),
+        }).start()
+        self.addCleanup(self.server.stop)
+
+    def test_make_request_expired(self):
+        with self.assertRaises(DeadlineExceeded):
+            make_request(self.server.url, deadline=Deadline(0))
+        self.assertEqual([], self.server.requests)
+
+    def test_make_request_expired_skips_circuit_breaker(self):
+        breaker = Mock()
+        with self.assertRaises(DeadlineExceeded):
+            make_request(self.server.url, circuit_breaker=breaker,
+                         deadline=Deadline(0))
+        self.assertFalse(breaker.before_request.called)
+
+    def test_make_request_remaining_timeout(self):
+        with patch('theblues.utils.requests.Session.request') as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.json.return_value = {}
+            make_request(
+                self.server.url, timeout=10, deadline=Deadline(2))
+        self.assertLessEqual(mock_request.call_args[1]['timeout'], 2)
+
+    def test_entity(self):
+        cs = CharmStore(self.server.url)
+        data = cs.entity(SAMPLE_CHARM, deadline=Deadline(5))
+        self.assertEqual({'Id': 'cs:mysql'}, data)
+
+    def test_entity_expired(self):
+        cs = CharmStore(self.server.url)
+        with self.assertRaises(DeadlineExceeded):
+            cs.entity(SAMPLE_CHARM, deadline=Deadline(0))
+        self.assertEqual([], self.server.requests)
+
+    def test_entity_expired_skips_circuit_breaker(self):
+        breaker = Mock()
+        cs = CharmStore(self.server.url, circuit_breaker=breaker)
+        with self.assertRaises(DeadlineExceeded):
+            cs.entity(SAMPLE_CHARM, deadline=Deadline(0))
+        self.assertFalse(breaker.before_request.called)
+
+    def test_files_share_budget(self):
+        # The manifest request uses most of the budget, leaving too little
+        # time for the file request.
+        self.server.latency = 0.3
+        cs = CharmStore(self.server.url)
+        started = time.time()
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(ServerError) as ctx:
+                cs.files(SAMPLE_CHARM, filename='README.md', read_file=True,
+                         deadline=Deadline(0.45))
+        self.assertLess(time.time() - started, 0.6)
+        self.assertIn('README.md', ctx.exception.args[0])
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_no_retry_past_deadline(self):
+        self.server.routes['/flaky/meta/any'] = helpers.flaky_route(
+            1, (200, b'{"Id": "cs:flaky-1"}'),
+            failure=(503, b'', {'Retry-After': '2'}))
+        policy = RetryPolicy(backoff_base=0.001)
+        cs = CharmStore(self.server.url, retry=policy)
+        with patch('theblues.charmstore.logging.error'):
+            with self.assertRaises(ServerError):
+                cs.entity('flaky', deadline=Deadline(1))
+        self.assertEqual({'retries': 0, 'exhausted': 1}, policy.stats())
+
+    def test_stream_checks_deadline(self):
+        cs = CharmStore(self.server.url)
+        deadline = Deadline(5)
+        chunks = cs.stream_file(
+            SAMPLE_CHARM, 'README.md', chunk_size=1, deadline=deadline)
+        self.assertEqual(b'R', next(chunks))
+        deadline.expires = 0
+        with self.assertRaises(DeadlineExceeded):
+            next(chunks)
@@ -120,6 +120,13 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
             body='body',
             auth=('user', 'password'),
             timeout=DEFAULT_TIMEOUT,
+            session=self.idm.session,
+            retry=None,
+            circuit_breaker=None,
+            deadline=None,
+            instrument=None,
+            client='identity',
+            template='/u/{username}',
         )
 
     def test_login_error_forbidden(self):
@@ -189,6 +196,13 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
             '?discharge-for-user=my.user%2Bname&id=identifier',
             auth=('user', 'password'),
             timeout=DEFAULT_TIMEOUT,
+            session=self.idm.session,
+            retry=None,
+            circuit_breaker=None,
+            deadline=None,
+            instrument=None,
+            client='identity',
+            template='/discharger/discharge',
             method='POST')
 
     def test_discharge_token_successful(self):
@@ -197,6 +211,201 @@ class TestIdentityManager(TestCase, helpers.TimeoutTestsMixin):
         self.assertEqual(b'["something"]', base64.urlsafe_b64decode(results))
 
 
+def discharged_macaroon(expires, version=1):
+    """Return a JSON decoded macaroon with a time-before caveat."""
+    condition = 'time-before {}'.format(expires)
+    if version == 1:
+        caveats = [{'cid': 'declared username who'}, {'cid': condition}]
+        return {'identifier': 'id', 'signature': 'sig', 'caveats': caveats}
+    encoded = base64.urlsafe_b64encode(condition.encode('utf-8'))
+    caveats = [
+        {'i': 'third party', 'v64': 'vid', 'l': 'http://example.com'},
+        {'i64': encoded.decode('ascii').rstrip('=')},
+    ]
+    return {'i': 'id', 's64': 'sig', 'c': caveats}
+
+
+class TestDischargeCache(TestCase):
+
+    def setUp(self):
+        self.idm = IdentityManager(
+            'http://example.com/v1', 'user', 'password', discharge_refresh=60,
+            cache_discharges=True)
+        patcher = patch('theblues.identity_manager.make_request')
+        self.mock_request = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.macaroon = Mock()
+        self.macaroon.third_party_caveats.return_value = [
+            ('caveat_key', 'identifier')]
+        # 2017-05-04T12:00:00Z
+        self.now = 1493899200
+
+    def discharge(self, username='who', now=None, macaroon=None):
+        with patch('theblues.identity_manager.time.time',
+                   return_value=now or self.now):
+            with patch('theblues.cache._now', return_value=now or self.now):
+                return self.idm.discharge(username, macaroon or self.macaroon)
+
+    def test_cached_until_refresh(self):
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon('2017-05-04T12:10:00Z')}
+        first = self.discharge()
+        self.assertEqual(first, self.discharge(now=self.now + 539))
+        self.assertEqual(1, self.mock_request.call_count)
+        # The macaroon is refreshed a minute before its expiry.
+        self.discharge(now=self.now + 540)
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_keyed_by_user_and_caveat(self):
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon('2017-05-04T13:00:00Z')}
+        other = Mock()
+        other.third_party_caveats.return_value = [('caveat_key', 'other')]
+        self.discharge()
+        self.discharge(username='bob')
+        self.discharge(macaroon=other)
+        self.discharge()
+        self.assertEqual(3, self.mock_request.call_count)
+
+    def test_version_2(self):
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon(
+                '2017-05-04T14:10:00.123456789+02:00', version=2)}
+        self.discharge()
+        self.discharge(now=self.now + 539)
+        self.assertEqual(1, self.mock_request.call_count)
+        self.discharge(now=self.now + 541)
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_not_cached_by_default(self):
+        self.idm = IdentityManager(
+            'http://example.com/v1', 'user', 'password')
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon('2017-05-04T13:00:00Z'),
+            'DischargeToken': discharged_macaroon('2017-05-04T13:00:00Z')}
+        self.discharge()
+        self.discharge()
+        with patch('theblues.identity_manager.time.time',
+                   return_value=self.now):
+            self.idm.discharge_token('who')
+            self.idm.discharge_token('who')
+        self.assertEqual(4, self.mock_request.call_count)
+
+    def test_not_cached_without_time_before(self):
+        self.mock_request.return_value = {'Macaroon': {'caveats': [
+            {'cid': 'declared username who'}]}}
+        self.discharge()
+        self.discharge(now=self.now + 1)
+        self.assertEqual(2, self.mock_request.call_count)
+        self.assertEqual(0, len(self.idm.cache))
+
+    def test_not_cached_without_expiry(self):
+        self.mock_request.return_value = {'Macaroon': {'caveats': [
+            {'cid': 'time-before yesterday'}]}}
+        self.discharge()
+        self.discharge()
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_not_cached_when_expiring(self):
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon('2017-05-04T12:00:30Z')}
+        self.discharge()
+        self.discharge()
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_discharge_token(self):
+        self.mock_request.return_value = {
+            'DischargeToken': discharged_macaroon('2017-05-04T13:00:00Z')}
+        with patch('theblues.identity_manager.time.time',
+                   return_value=self.now):
+            token = self.idm.discharge_token('who')
+            self.assertEqual(token, self.idm.discharge_token('who'))
+            self.idm.discharge_token('bob')
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_invalidate(self):
+        self.mock_request.return_value = {
+            'Macaroon': discharged_macaroon('2017-05-04T13:00:00Z'),
+            'DischargeToken': discharged_macaroon('2017-05-04T13:00:00Z')}
+        with patch('theblues.identity_manager.time.time',
+                   return_value=self.now):
+            self.idm.discharge('who', self.macaroon)
+            self.idm.discharge('bob', self.macaroon)
+            self.idm.discharge_token('who')
+            self.idm.invalidate_discharges('who')
+            self.idm.discharge('who', self.macaroon)
+            self.idm.discharge('bob', self.macaroon)
+            self.idm.discharge_token('who')
+        self.assertEqual(5, self.mock_request.call_count)
+
+    def test_cache_disabled(self):
+        idm = IdentityManager(
+            'http://example.com/v1', 'user', 'password', cache_size=0)
+        idm.invalidate_discharges('who')
+        self.assertIsNone(idm.cache)
+
+
+class TestUserCache(TestCase):
+
+    def setUp(self):
+        self.idm = IdentityManager(
+            'http://example.com/v1', 'user', 'password', user_cache_ttl=60)
+        patcher = patch('theblues.identity_manager.make_request')
+        self.mock_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_user_cached(self):
+        self.mock_request.return_value = {'username': 'who'}
+        self.assertEqual({'username': 'who'}, self.idm.get_user('who'))
+        self.assertEqual({'username': 'who'}, self.idm.get_user('who'))
+        self.idm.get_user('bob')
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_expiry(self):
+        self.mock_request.return_value = {'username': 'who'}
+        with patch('theblues.cache._now', return_value=100):
+            self.idm.get_user('who')
+        with patch('theblues.cache._now', return_value=160):
+            self.idm.get_user('who')
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_cached_data_not_shared(self):
+        self.mock_request.return_value = {'foo': 1}
+        self.idm.get_extra_info('who')['foo'] = 2
+        self.assertEqual({'foo': 1}, self.idm.get_extra_info('who'))
+        self.idm.get_extra_info('who')['foo'] = 2
+        self.assertEqual({'foo': 1}, self.idm.get_extra_info('who'))
+        self.assertEqual(1, self.mock_request.call_count)
+
+    def test_login_invalidates(self):
+        self.mock_request.return_value = {'username': 'who'}
+        self.idm.get_user('who')
+        self.idm.get_extra_info('who')
+        self.idm.login('who', {})
+        self.idm.get_user('who')
+        self.idm.get_extra_info('who')
+        self.assertEqual(5, self.mock_request.call_count)
+
+    def test_set_extra_info_invalidates(self):
+        self.mock_request.return_value = {'foo': 1}
+        self.idm.get_extra_info('who')
+        self.idm.get_extra_info('bob')
+        self.mock_request.side_effect = ServerError()
+        with self.assertRaises(ServerError):
+            self.idm.set_extra_info('who', {'foo': 2})
+        self.mock_request.side_effect = None
+        self.idm.get_extra_info('who')
+        self.idm.get_extra_info('bob')
+        self.assertEqual(4, self.mock_request.call_count)
+
+    def test_disabled_by_default(self):
+        idm = IdentityManager('http://example.com/v1', 'user', 'password')
+        self.mock_request.return_value = {'username': 'who'}
+        idm.get_user('who')
+        idm.get_user('who')
+        self.assertEqual(2, self.mock_request.call_count)
+
+
 class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
 
     def setUp(self):
@@ -211,7 +420,10 @@ class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
     def test_debug(self, mock):
         self.idm.debug()
         mock.assert_called_once_with(
-            'http://example.com:8082/v1/debug/status', timeout=DEFAULT_TIMEOUT)
+            'http://example.com:8082/v1/debug/status', timeout=DEFAULT_TIMEOUT,
+            session=self.idm.session, retry=None,
+            circuit_breaker=None, deadline=None, instrument=None,
+            client='identity', template='/debug/status')
 
     @patch('theblues.identity_manager.make_request')
     def test_debug_fail(self, mock):
@@ -225,9 +437,31 @@ class TestIDMClass(TestCase, helpers.TimeoutTestsMixin):
         make_request_mock.assert_called_once_with(
             'http://example.com:8082/v1/u/jeffspinach',
             auth=('user', 'password'),
-            timeout=DEFAULT_TIMEOUT
+            timeout=DEFAULT_TIMEOUT,
+            session=self.idm.session,
+            retry=None,
+            circuit_breaker=None,
+            deadline=None,
+            instrument=None,
+            client='identity',
+            template='/u/{username}',
         )
 
+    @patch('theblues.identity_manager.make_request')
+    def test_operation_timeouts(self, make_request_mock):
+        idm = IdentityManager(
+            'http://example.com:8082/v1', 'user', 'password', timeout=5,
+            timeouts={'get_user': (1, 2)})
+        idm.get_user('jeffspinach')
+        self.assertEqual((1, 2), make_request_mock.call_args[1]['timeout'])
+        idm.get_extra_info('jeffspinach')
+        self.assertEqual(5, make_request_mock.call_args[1]['timeout'])
+
+    def test_unknown_operation_timeout(self):
+        with self.assertRaises(ValueError):
+            IdentityManager('http://example.com:8082/v1', 'user', 'password',
+                            timeouts={'get_users': 1})
+
     def test_get_extra_info_ok(self):
         with HTTMock(extra):
             info = self.idm.get_extra_info('frobnar')
@@ -0,0 +1,247 @@
+from unittest import TestCase
+
+from mock import patch
+import requests
+
+from theblues.charmstore import CharmStore
+from theblues.errors import (
+    EntityNotFound,
+    ServerError,
+)
+from theblues.identity_manager import IdentityManager
+from theblues.instrumentation import (
+    Histogram,
+    HistogramCollector,
+    Instrument,
+    instrumented,
+    RequestRecord,
+    serve_prometheus,
+    to_prometheus,
+)
+from theblues.retry import RetryPolicy
+from theblues.tests import helpers
+
+
+SAMPLE_CHARM = 'precise/mysql-1'
+
+
+def make_record(status=200, total=0.2, template='/{id}/meta/any', **kwargs):
+    """Return a completed RequestRecord."""
+    record = RequestRecord(
+        'charmstore', 'GET', 'http://example.com', template=template)
+    record.status = status
+    record.total = total
+    for key, value in kwargs.items():
+        setattr(record, key, value)
+    return record
+
+
+class TestRequestRecord(TestCase):
+
+    def test_retries(self):
+        record = RequestRecord('charmstore', 'GET', 'http://example.com')
+        self.assertEqual(0, record.retries)
+        record.attempts = 3
+        self.assertEqual(2, record.retries)
+
+    def test_phases(self):
+        record = RequestRecord('charmstore', 'GET', 'http://example.com')
+        record.end_phase('dns')
+        self.assertIsNone(record.dns)
+        record.start_phase('dns')
+        record.end_phase('dns')
+        self.assertGreaterEqual(record.dns, 0)
+
+
+class TestInstrumented(TestCase):
+
+    def test_no_instrument(self):
+        with instrumented(None, 'charmstore', 'GET', 'http://a') as record:
+            self.assertIsNone(record)
+
+    def test_hooks(self):
+        instrument = helpers.RecordingInstrument()
+        with instrumented(
+                instrument, 'charmstore', 'GET', 'http://a', '/t') as record:
+            self.assertEqual([('GET', 'http://a', None)], instrument.started)
+            record.status = 200
+        self.assertEqual([record], instrument.records)
+        self.assertEqual('/t', record.template)
+        self.assertIsNone(record.error)
+        self.assertGreaterEqual(record.total, 0)
+
+    def test_error(self):
+        instrument = helpers.RecordingInstrument()
+        with self.assertRaises(ValueError):
+            with instrumented(instrument, 'charmstore', 'GET', 'http://a'):
+                raise ValueError('bad wolf')
+        error = instrument.records[0].error
+        self.assertIsInstance(error, ValueError)
+
+    def test_hook_errors_ignored(self):
+        class BrokenInstrument(Instrument):
+            def after_request(self, record):
+                raise ValueError('bad wolf')
+        with patch('theblues.instrumentation.log.exception') as mock_log:
+            with instrumented(
+                    BrokenInstrument(), 'charmstore', 'GET', 'http://a'):
+                pass
+        self.assertTrue(mock_log.called)
+
+
+class TestHistogramCollector(TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(
+            [(0.1, 2), (1, 3), (float('inf'), 4)], histogram.cumulative())
+        self.assertEqual(4, histogram.count)
+        self.assertAlmostEqual(3.65, histogram.sum)
+
+    def test_collect(self):
+        collector = HistogramCollector(buckets=(0.1, 1))
+        collector.after_request(make_record(size=10, ttfb=0.05))
+        collector.after_request(make_record(size=5, total=2, attempts=3))
+        collector.after_request(make_record(status=None, attempts=1))
+        metrics = collector.snapshot()
+        ok = ('charmstore', 'GET', '/{id}/meta/any', '200')
+        error = ('charmstore', 'GET', '/{id}/meta/any', 'error')
+        self.assertEqual(2, metrics['durations'][ok].count)
+        self.assertEqual(1, metrics['durations'][error].count)
+        self.assertEqual({ok: 15, error: 0}, metrics['bytes'])
+        self.assertEqual({ok: 2, error: 0}, metrics['retries'])
+        phase = ('charmstore', 'GET', '/{id}/meta/any', 'ttfb')
+        self.assertEqual([phase], list(metrics['phases']))
+        collector.reset()
+        self.assertEqual({}, collector.snapshot()['durations'])
+
+    def test_to_prometheus(self):
+        collector = HistogramCollector(buckets=(0.1, 1))
+        collector.after_request(make_record(size=10, ttfb=0.05))
+        text = to_prometheus(collector)
+        labels = ('client="charmstore",method="GET",'
+                  'template="/{id}/meta/any",status="200"')
+        self.assertIn(
+            '# TYPE theblues_request_duration_seconds histogram\n', text)
+        self.assertIn(
+            'theblues_request_duration_seconds_bucket{%s,le="0.1"} 0\n'
+            'theblues_request_duration_seconds_bucket{%s,le="1.0"} 1\n'
+            'theblues_request_duration_seconds_bucket{%s,le="+Inf"} 1\n'
+            'theblues_request_duration_seconds_sum{%s} 0.2\n'
+            'theblues_request_duration_seconds_count{%s} 1\n' % (
+                (labels,) * 5), text)
+        self.assertIn(
+            'theblues_request_phase_seconds_count{client="charmstore",'
+            'method="GET",template="/{id}/meta/any",phase="ttfb"} 1\n', text)
+        self.assertIn('theblues_response_bytes_total{%s} 10\n' % labels, text)
+        self.assertIn('theblues_request_retries_total{%s} 0\n' % labels, text)
+
+    def test_to_prometheus_escaping(self):
+        collector = HistogramCollector()
+        collector.after_request(make_record(template='/"a"\\b'))
+        self.assertIn('template="/\\"a\\"\\\\b"', to_prometheus(collector))
+
+    def test_serve_prometheus(self):
+        collector = HistogramCollector()
+        collector.after_request(make_record())
+        server = serve_prometheus(collector)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = requests.get(
+            'http://127.0.0.1:{}/metrics'.format(server.server_port))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(to_prometheus(collector), response.text)
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/plain'))
+
+
+class TestClientInstrumentation(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/%s/meta/any' % SAMPLE_CHARM: (200, b'{"Id": "cs:mysql"}'),
+            '/%s/archive' % SAMPLE_CHARM: (200, b'archive data'),
+            '/meta/any': helpers.bulk_meta_route,
+            '/v1/u/who': (200, b'{"username": "who"}'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.instrument = helpers.RecordingInstrument()
+
+    def test_charmstore(self):
+        cs = CharmStore(self.server.url, instrument=self.instrument)
+        cs.entity(SAMPLE_CHARM)
+        record, = self.instrument.records
+        self.assertEqual('charmstore', record.client)
+        self.assertEqual('GET', record.method)
+        self.assertEqual('/{id}/meta/any', record.template)
+        self.assertEqual(200, record.status)
+        self.assertEqual(18, record.size)
+        self.assertEqual(0, record.retries)
+        self.assertIsNotNone(record.ttfb)
+        self.assertGreaterEqual(record.total, record.ttfb)
+
+    def test_charmstore_bulk_meta(self):
+        cs = CharmStore(self.server.url, instrument=self.instrument)
+        cs.entities(['foo', 'bar'])
+        self.assertEqual('/meta/any', self.instrument.records[0].template)
+
+    def test_charmstore_stream(self):
+        cs = CharmStore(self.server.url, instrument=self.instrument)
+        self.assertEqual(
+            b'archive data', b''.join(cs.stream_archive(SAMPLE_CHARM)))
+        record, = self.instrument.records
+        self.assertEqual('/{id}/archive', record.template)
+        self.assertEqual(12, record.size)
+
+    def test_charmstore_not_found(self):
+        cs = CharmStore(self.server.url, instrument=self.instrument)
+        with self.assertRaises(EntityNotFound):
+            cs.entity('missing')
+        record, = self.instrument.records
+        self.assertEqual(404, record.status)
+        self.assertIsInstance(record.error, EntityNotFound)
+
+    def test_charmstore_retries(self):
+        self.server.routes['/flaky/meta/any'] = helpers.flaky_route(
+            2, (200, b'{"Id": "cs:flaky-1"}'))
+        cs = CharmStore(
+            self.server.url, instrument=self.instrument,
+            retry=RetryPolicy(backoff_base=0.001))
+        cs.entity('flaky')
+        record, = self.instrument.records
+        self.assertEqual(2, record.retries)
+        self.assertEqual(200, record.status)
+
+    def test_charmstore_collector(self):
+        collector = HistogramCollector()
+        cs = CharmStore(self.server.url, instrument=collector)
+        cs.entity(SAMPLE_CHARM)
+        cs.entity(SAMPLE_CHARM)
+        durations = collector.snapshot()['durations']
+        key = ('charmstore', 'GET', '/{id}/meta/any', '200')
+        self.assertEqual(2, durations[key].count)
+
+    def test_make_request(self):
+        idm = IdentityManager(
+            self.server.url + '/v1', 'user', 'password',
+            instrument=self.instrument)
+        self.assertEqual({'username': 'who'}, idm.get_user('who'))
+        record, = self.instrument.records
+        self.assertEqual('identity', record.client)
+        self.assertEqual('/u/{username}', record.template)
+        self.assertEqual(200, record.status)
+        self.assertEqual(19, record.size)
+
+    def test_make_request_error(self):
+        idm = IdentityManager(
+            self.server.url + '/v1', 'user', 'password',
+            instrument=self.instrument)
+        with patch('theblues.utils.log.error'):
+            with self.assertRaises(ServerError):
+                idm.get_extra_info('who')
+        record, = self.instrument.records
+        self.assertEqual('/u/{username}/extra-info', record.template)
+        self.assertEqual(404, record.status)
+        self.assertIsInstance(record.error, ServerError)
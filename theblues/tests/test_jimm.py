@@ -5,6 +5,7 @@ from mock import (
 from unittest import TestCase
 
 from theblues.jimm import JIMM
+from theblues.utils import DEFAULT_TIMEOUT
 
 
 class TestJIMM(TestCase):
@@ -15,7 +16,7 @@ class TestJIMM(TestCase):
     def test_init(self):
         self.assertEqual(self.jimm.url, 'http://example.com/')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_macaroon(self, mocked):
 
         class MockResponse(object):
@@ -31,7 +32,7 @@ class TestJIMM(TestCase):
         resp = self.jimm.fetch_macaroon()
         self.assertEqual('{"foo": "bar"}', resp)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_macaroon_fails_gracefully(self, mocked):
         def boom():
             raise ValueError
@@ -39,7 +40,7 @@ class TestJIMM(TestCase):
         resp = self.jimm.fetch_macaroon()
         self.assertIsNone(resp)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_macaroon_fails_gracefully_json(self, mocked):
         def boom():
             raise ValueError
@@ -50,7 +51,7 @@ class TestJIMM(TestCase):
         resp = self.jimm.fetch_macaroon()
         self.assertIsNone(resp)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_macaroon_fails_gracefully_macaroon(self, mocked):
         mock_response = Mock()
         mock_response.json = Mock()
@@ -66,5 +67,8 @@ class TestJIMM(TestCase):
         mocked.return_value = '42'
         resp = self.jimm.list_models('macaroons!')
         self.assertEqual('42', resp)
-        mocked.called_once_with(
-            'http://example.com/env', macaroons='macaroons!')
+        mocked.assert_called_once_with(
+            'http://example.com/model', macaroons='macaroons!',
+            timeout=DEFAULT_TIMEOUT, session=self.jimm.session,
+            retry=None, circuit_breaker=None, deadline=None, instrument=None,
+            client='jimm', template='/model')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import TestCase
+
+from theblues.jsonstream import (
+    iter_decode,
+    StreamDecoder,
+)
+
+
+DOCUMENT = {
+    'Results': [
+        {'Id': 'cs:mysql-{}'.format(i), 'Size': i * 1.5, 'Tags': [1, None],
+         'Summary': u'Caf\xe9 "quoted" \\ slash'}
+        for i in range(50)],
+    'Other': {'Nested': [1, 2]},
+    'Total': 12345,
+}
+
+
+def chunked(data, size):
+    """Split data into chunks of the given size."""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestStreamDecoder(TestCase):
+
+    def setUp(self):
+        self.data = json.dumps(DOCUMENT).encode('utf-8')
+
+    def test_array_items(self):
+        for size in (1, 7, 100, len(self.data)):
+            self.assertEqual(
+                DOCUMENT['Results'],
+                list(iter_decode(chunked(self.data, size), key='Results')))
+
+    def test_object_members(self):
+        for size in (1, 7, 100, len(self.data)):
+            self.assertEqual(
+                DOCUMENT, dict(iter_decode(chunked(self.data, size))))
+
+    def test_items_returned_as_decoded(self):
+        decoder = StreamDecoder(key='Results')
+        self.assertEqual([], decoder.feed(b'{"Results": [{"Id": '))
+        self.assertEqual([{'Id': 'a'}], decoder.feed(b'"a"}, {"Id"'))
+        self.assertEqual([{'Id': 'b'}], decoder.feed(b': "b"}]'))
+        self.assertEqual([], decoder.feed(b'}'))
+        self.assertEqual([], decoder.close())
+
+    def test_truncated_number(self):
+        decoder = StreamDecoder()
+        self.assertEqual([], decoder.feed(b'{"a": 12'))
+        self.assertEqual([('a', 123)], decoder.feed(b'3, "b": 4'))
+        self.assertEqual([('b', 4)], decoder.feed(b'}'))
+
+    def test_missing_or_null_array(self):
+        self.assertEqual(
+            [], list(iter_decode([b'{"Results": null}'], key='Results')))
+        self.assertEqual([], list(iter_decode([b' {} '], key='Results')))
+
+    def test_incomplete(self):
+        with self.assertRaises(ValueError) as ctx:
+            list(iter_decode([b'{"Results": [1, 2'], key='Results'))
+        self.assertEqual('incomplete JSON document', str(ctx.exception))
+
+    def test_invalid(self):
+        for data in (b'[1, 2]', b'{"a" 1}', b'{"a": 1} trailing'):
+            with self.assertRaises(ValueError):
+                list(iter_decode([data]))
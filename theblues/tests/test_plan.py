@@ -10,6 +10,7 @@ from theblues.plans import (
     Plans,
 )
 from theblues.errors import ServerError
+from theblues.tests import helpers
 from theblues.utils import DEFAULT_TIMEOUT
 
 
@@ -65,7 +66,14 @@ class TestPlans(TestCase):
         ), resp)
         mocked.assert_called_once_with(
             'http://example.com/v2/charm?charm-url=cs:trusty/landscape-mock-0',
-            timeout=DEFAULT_TIMEOUT
+            timeout=DEFAULT_TIMEOUT,
+            session=self.plans.session,
+            retry=None,
+            circuit_breaker=None,
+            deadline=None,
+            instrument=None,
+            client='plans',
+            template='/charm',
         )
 
     @patch('theblues.plans.make_request')
@@ -99,3 +107,102 @@ class TestPlans(TestCase):
             '}]')
         with self.assertRaises(ServerError):
             self.plans.get_plans(self.ref)
+
+    @patch('theblues.plans.make_request')
+    def test_get_plans_cached(self, mocked):
+        mocked.return_value = [{
+            'url': 'canonical-landscape/free', 'plan': 'free plan',
+            'created-on': '2016-10-03T12:00:00Z'}]
+        plans = self.plans.get_plans(self.ref)
+        self.assertEqual(plans, self.plans.get_plans(self.ref))
+        self.assertEqual(1, mocked.call_count)
+        with patch('theblues.cache._now', return_value=10 ** 9):
+            self.plans.get_plans(self.ref)
+        self.assertEqual(2, mocked.call_count)
+
+    @patch('theblues.plans.make_request')
+    def test_get_plans_negative_cache(self, mocked):
+        mocked.return_value = []
+        self.plans.negative_cache_ttl = 10
+        with patch('theblues.cache._now', return_value=100):
+            self.assertEqual((), self.plans.get_plans(self.ref))
+            self.assertEqual((), self.plans.get_plans(self.ref))
+        self.assertEqual(1, mocked.call_count)
+        with patch('theblues.cache._now', return_value=110):
+            self.plans.get_plans(self.ref)
+        self.assertEqual(2, mocked.call_count)
+
+    @patch('theblues.plans.make_request')
+    def test_get_plans_errors_not_cached(self, mocked):
+        mocked.side_effect = [ServerError(), []]
+        with self.assertRaises(ServerError):
+            self.plans.get_plans(self.ref)
+        self.assertEqual((), self.plans.get_plans(self.ref))
+
+    @patch('theblues.plans.make_request')
+    def test_get_plans_cache_disabled(self, mocked):
+        mocked.return_value = []
+        plans = Plans('http://example.com', cache_size=0)
+        plans.get_plans(self.ref)
+        plans.get_plans(self.ref)
+        self.assertEqual(2, mocked.call_count)
+        self.assertIsNone(plans.cache)
+
+    def test_cache_bounded(self):
+        plans = Plans('http://example.com', cache_size=2)
+        with patch('theblues.plans.make_request', return_value=[]):
+            for name in ('a', 'b', 'c'):
+                plans.get_plans(references.Reference.from_string(
+                    'cs:trusty/{}-1'.format(name)))
+        self.assertEqual(2, len(plans.cache))
+
+
+def plans_response(url, **kwargs):
+    """Return the plans service response for the given URL."""
+    charm_url = url.split('charm-url=')[1]
+    if 'missing' in charm_url:
+        raise ServerError(404, 'not found')
+    if 'free' in charm_url:
+        return []
+    return [{'url': charm_url + '/plan', 'plan': 'plan',
+             'created-on': '2016-10-03T12:00:00Z'}]
+
+
+class TestBulkPlans(TestCase):
+
+    def setUp(self):
+        self.plans = Plans('http://example.com', bulk_workers=2)
+        self.mock_request = helpers.patch_make_request(
+            self, 'theblues.plans', plans_response)
+        self.refs = [
+            references.Reference.from_string(url) for url in (
+                'cs:trusty/mysql-1', 'cs:trusty/free-2',
+                'cs:trusty/missing-3', 'cs:trusty/mysql-1')]
+
+    def test_bulk_plans(self):
+        results = self.plans.bulk_plans(self.refs)
+        self.assertEqual(
+            set(['trusty/mysql-1', 'trusty/free-2']), set(results))
+        plan, = results['trusty/mysql-1']
+        self.assertEqual('cs:trusty/mysql-1/plan', plan.url)
+        self.assertEqual((), results['trusty/free-2'])
+        self.assertEqual(
+            ['trusty/missing-3'], list(results.errors))
+        self.assertEqual(3, self.mock_request.call_count)
+
+    def test_cached(self):
+        self.plans.get_plans(self.refs[0])
+        self.plans.bulk_plans(self.refs)
+        self.assertEqual(3, self.mock_request.call_count)
+        self.plans.bulk_plans(self.refs[:2])
+        self.assertEqual(3, self.mock_request.call_count)
+
+    def test_all_errors(self):
+        with self.assertRaises(ServerError) as ctx:
+            self.plans.bulk_plans([self.refs[2]])
+        self.assertEqual(404, ctx.exception.args[0])
+
+    def test_sequential(self):
+        self.plans.bulk_workers = 1
+        results = self.plans.bulk_plans(iter(self.refs))
+        self.assertEqual(2, len(results))
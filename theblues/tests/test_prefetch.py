@@ -0,0 +1,190 @@
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from theblues.cache import (
+    DiskCache,
+    MemoryCache,
+)
+from theblues.charmstore import CharmStore
+from theblues.errors import EntityNotFound
+from theblues.prefetch import (
+    _entity_aliases,
+    main,
+    prefetch,
+    RateLimiter,
+)
+from theblues.tests import helpers
+try:
+    from urlparse import (
+        parse_qs,
+        urlparse,
+    )
+except ImportError:
+    from urllib.parse import (
+        parse_qs,
+        urlparse,
+    )
+
+
+ENTITIES = {
+    'cs:mysql-1': {
+        'Id': 'cs:mysql-1',
+        'Meta': {
+            'charm-metadata': {'Name': 'mysql'},
+            'charm-config': {'Options': {}},
+            'manifest': [{'Name': 'README.md'}],
+        },
+    },
+    'cs:bundle/wiki-2': {
+        'Id': 'cs:bundle/wiki-2',
+        'Meta': {'bundle-metadata': {'Services': {}}},
+    },
+}
+
+
+def list_route(handler, body):
+    results = [{'Id': entity_id} for entity_id in sorted(ENTITIES)]
+    return 200, json.dumps({'Results': results}).encode('utf-8')
+
+
+def meta_route(handler, body):
+    query = parse_qs(urlparse(handler.path).query)
+    data = dict(
+        (entity_id, ENTITIES[entity_id]) for entity_id in query['id']
+        if entity_id in ENTITIES)
+    return 200, json.dumps(data).encode('utf-8')
+
+
+class TestPrefetch(TestCase):
+
+    def setUp(self):
+        self.server = helpers.StubServer(routes={
+            '/list': list_route,
+            '/meta/any': meta_route,
+            '/cs:mysql-1/icon.svg': (200, b'<svg/>'),
+            '/cs:mysql-1/readme': (200, b'Read me.'),
+            '/cs:bundle/wiki-2/diagram.svg': (200, b'<svg/>'),
+        }).start()
+        self.addCleanup(self.server.stop)
+        self.cs = CharmStore(self.server.url, cache=MemoryCache())
+        self.addCleanup(self.cs.close)
+
+    def test_prefetch(self):
+        report = prefetch(self.cs, workers=2)
+        self.assertEqual(2, report.entities)
+        self.assertEqual('files', report.phase)
+        self.assertEqual(4, report.done)
+        # The bundle has no readme.
+        self.assertEqual([('readme', 'cs:bundle/wiki-2')], list(report.errors))
+        timings = report.timings()
+        self.assertEqual(1, timings['list']['count'])
+        self.assertEqual(1, timings['meta']['count'])
+        self.assertEqual(1, timings['icon']['count'])
+        self.assertEqual(1, timings['diagram']['count'])
+        self.assertEqual(2, timings['readme']['count'])
+
+    def test_served_from_cache(self):
+        prefetch(self.cs)
+        requests = len(self.server.requests)
+        self.assertEqual(
+            ENTITIES['cs:mysql-1'], self.cs.charm('cs:mysql-1'))
+        data = self.cs.entity('cs:mysql-1')
+        self.assertNotIn('manifest', data['Meta'])
+        self.assertEqual({'Options': {}}, self.cs.config('cs:mysql-1'))
+        self.assertEqual(
+            ENTITIES['cs:bundle/wiki-2'], self.cs.bundle('cs:bundle/wiki-2'))
+        # Files are not revalidated, even without validators.
+        self.assertEqual(b'<svg/>', self.cs.charm_icon('cs:mysql-1'))
+        self.assertEqual(
+            'Read me.', self.cs.entity_readme_content('cs:mysql-1'))
+        self.assertEqual(
+            b'<svg/>', self.cs.bundle_visualization('cs:bundle/wiki-2'))
+        self.assertEqual(requests, len(self.server.requests))
+
+    def test_served_from_cache_by_alias(self):
+        prefetch(self.cs)
+        requests = len(self.server.requests)
+        for entity_id in ('mysql-1', 'cs:mysql', 'mysql'):
+            self.assertEqual(
+                ENTITIES['cs:mysql-1'], self.cs.charm(entity_id))
+            self.assertEqual({'Options': {}}, self.cs.config(entity_id))
+            self.assertEqual(b'<svg/>', self.cs.charm_icon(entity_id))
+            self.assertEqual(
+                'Read me.', self.cs.entity_readme_content(entity_id))
+        self.assertEqual(
+            b'<svg/>', self.cs.bundle_visualization('bundle/wiki'))
+        self.assertEqual(requests, len(self.server.requests))
+
+    def test_entity_aliases(self):
+        aliases = _entity_aliases(
+            ['cs:trusty/mysql-38', 'cs:trusty/mysql-37', '~who/wiki-2'])
+        self.assertEqual({
+            'cs:trusty/mysql-38': [
+                'cs:trusty/mysql-38', 'cs:trusty/mysql', 'trusty/mysql-38',
+                'trusty/mysql'],
+            'cs:trusty/mysql-37': ['cs:trusty/mysql-37', 'trusty/mysql-37'],
+            '~who/wiki-2': ['~who/wiki-2', '~who/wiki'],
+        }, aliases)
+
+    def test_doc_type(self):
+        prefetch(self.cs, doc_type='bundle')
+        method, path = self.server.requests[0]
+        self.assertIn('type=bundle', path)
+        self.assertIn('promulgated=1', path)
+
+    def test_progress(self):
+        phases = []
+        prefetch(self.cs, progress=lambda report: phases.append(
+            (report.phase, report.done, report.total)))
+        self.assertEqual(('list', 1, 1), phases[0])
+        self.assertEqual(('meta', 1, 1), phases[1])
+        self.assertEqual(('files', 4, 4), phases[-1])
+
+    def test_meta_errors(self):
+        self.server.routes['/meta/any'] = (500, b'boom')
+        with patch('theblues.charmstore.logging.error'):
+            report = prefetch(self.cs)
+        self.assertEqual(
+            set([('meta', 'cs:mysql-1'), ('meta', 'cs:bundle/wiki-2')]),
+            set(report.errors))
+
+    def test_list_error(self):
+        del self.server.routes['/list']
+        with self.assertRaises(EntityNotFound):
+            prefetch(self.cs)
+
+    def test_no_cache(self):
+        with self.assertRaises(ValueError):
+            prefetch(CharmStore(self.server.url))
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(10)
+        with patch('theblues.prefetch.time.sleep') as mock_sleep:
+            with patch('theblues.prefetch._now', return_value=100):
+                limiter._next = 100
+                limiter.wait()
+                limiter.wait()
+        delay, = mock_sleep.call_args[0]
+        self.assertAlmostEqual(0.1, delay)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    def test_main(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with patch('theblues.prefetch.print') as mock_print:
+            status = main([
+                self.server.url, '--cache-dir', directory, '--quiet'])
+        self.assertEqual(1, status)
+        summary = json.loads(mock_print.call_args[0][0])
+        self.assertEqual(2, summary['entities'])
+        self.assertEqual(1, summary['errors'])
+        cs = CharmStore(self.server.url, cache=DiskCache(directory))
+        self.addCleanup(cs.close)
+        requests = len(self.server.requests)
+        cs.charm('cs:mysql-1')
+        self.assertEqual(b'<svg/>', cs.charm_icon('mysql'))
+        self.assertEqual(requests, len(self.server.requests))
@@ -0,0 +1,144 @@
+from unittest import TestCase
+
+from mock import patch
+
+from theblues.charmstore import CharmStore
+from theblues.errors import ServerError
+from theblues.retry import (
+    parse_retry_after,
+    RetryPolicy,
+)
+from theblues.tests import helpers
+from theblues.utils import make_request
+
+
+def fast_policy(**kwargs):
+    """Return a retry policy with negligible backoff delays."""
+    kwargs.setdefault('backoff_base', 0.001)
+    return RetryPolicy(**kwargs)
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_backoff_full_jitter(self):
+        policy = RetryPolicy(backoff_base=1, backoff_cap=5)
+        with patch('theblues.retry.random.uniform') as mock_uniform:
+            mock_uniform.side_effect = lambda low, high: high
+            self.assertEqual(
+                [1, 2, 4, 5, 5], [policy.backoff(n) for n in range(1, 6)])
+        mock_uniform.assert_called_with(0, 5)
+
+    def test_retry_delay(self):
+        policy = fast_policy(max_attempts=3)
+        self.assertIsNotNone(policy.retry_delay('GET', 1, 0, status=503))
+        self.assertIsNotNone(policy.retry_delay('GET', 2, 0))
+        self.assertIsNone(policy.retry_delay('GET', 3, 0, status=503))
+        self.assertEqual({'retries': 2, 'exhausted': 1}, policy.stats())
+
+    def test_not_retryable(self):
+        policy = fast_policy()
+        self.assertIsNone(policy.retry_delay('GET', 1, 0, status=200))
+        self.assertIsNone(policy.retry_delay('GET', 1, 0, status=500))
+        self.assertIsNone(policy.retry_delay('POST', 1, 0, status=503))
+        self.assertEqual({'retries': 0, 'exhausted': 0}, policy.stats())
+
+    def test_retry_after(self):
+        policy = fast_policy()
+        self.assertEqual(
+            2, policy.retry_delay('GET', 1, 0, status=503, retry_after='2'))
+        policy.respect_retry_after = False
+        self.assertLess(
+            policy.retry_delay('GET', 1, 0, status=503, retry_after='2'), 1)
+
+    def test_max_retry_after(self):
+        policy = fast_policy(max_retry_after=10)
+        self.assertEqual(
+            10, policy.retry_delay('GET', 1, 0, status=503, retry_after='10'))
+        self.assertIsNone(
+            policy.retry_delay('GET', 1, 0, status=429, retry_after='3600'))
+        self.assertEqual({'retries': 1, 'exhausted': 1}, policy.stats())
+        policy.max_retry_after = None
+        self.assertEqual(
+            3600,
+            policy.retry_delay('GET', 1, 0, status=429, retry_after='3600'))
+
+    def test_deadline(self):
+        policy = fast_policy(deadline=1)
+        self.assertIsNotNone(policy.retry_delay('GET', 1, 0.5))
+        self.assertIsNone(policy.retry_delay('GET', 1, 1))
+        self.assertIsNone(
+            policy.retry_delay('GET', 1, 0, status=503, retry_after='2'))
+
+    def test_invalid_max_attempts(self):
+        with self.assertRaises(ValueError):
+            RetryPolicy(max_attempts=0)
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(3, parse_retry_after('3'))
+        self.assertEqual(0, parse_retry_after('-3'))
+        self.assertEqual(
+            0, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        with patch('theblues.retry.time.time', return_value=1445412470):
+            self.assertEqual(
+                10, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+
+
+class TestRetries(TestCase):
+
+    def serve(self, route):
+        server = helpers.StubServer(routes={'/path': route}).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_make_request_retried(self):
+        server = self.serve(helpers.flaky_route(2, (200, b'{"ok": true}')))
+        policy = fast_policy()
+        response = make_request(server.url + '/path', retry=policy)
+        self.assertEqual({'ok': True}, response)
+        self.assertEqual(3, len(server.requests))
+        self.assertEqual(2, policy.retries)
+
+    def test_make_request_connection_reset(self):
+        server = self.serve(helpers.flaky_route(
+            1, (200, b'{}'), failure=(None, b'')))
+        policy = fast_policy()
+        self.assertEqual({}, make_request(server.url + '/path', retry=policy))
+        self.assertEqual(1, policy.retries)
+
+    def test_make_request_exhausted(self):
+        server = self.serve((503, b'unavailable'))
+        policy = fast_policy(max_attempts=2)
+        with patch('theblues.utils.log.error'):
+            with self.assertRaises(ServerError) as ctx:
+                make_request(server.url + '/path', retry=policy)
+        self.assertEqual(503, ctx.exception.args[0])
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual({'retries': 1, 'exhausted': 1}, policy.stats())
+
+    def test_make_request_post_not_retried(self):
+        server = self.serve(helpers.flaky_route(1, (200, b'{}')))
+        with patch('theblues.utils.log.error'):
+            with self.assertRaises(ServerError):
+                make_request(server.url + '/path', method='POST',
+                             retry=fast_policy())
+        self.assertEqual(1, len(server.requests))
+
+    def test_make_request_retry_after(self):
+        server = self.serve(helpers.flaky_route(
+            1, (200, b'{}'), failure=(503, b'', {'Retry-After': '1'})))
+        with patch('theblues.retry.time.sleep') as mock_sleep:
+            make_request(server.url + '/path', retry=fast_policy())
+        mock_sleep.assert_called_once_with(1)
+
+    def test_charmstore_retried(self):
+        server = helpers.StubServer(routes={
+            '/mysql/meta/any': helpers.flaky_route(
+                2, (200, b'{"Id": "cs:mysql-1"}'), failure=(502, b'')),
+        }).start()
+        self.addCleanup(server.stop)
+        policy = fast_policy()
+        with CharmStore(server.url, retry=policy) as cs:
+            self.assertEqual({'Id': 'cs:mysql-1'}, cs.entity('mysql'))
+        self.assertEqual(2, policy.retries)
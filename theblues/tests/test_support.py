@@ -2,6 +2,8 @@ from unittest import TestCase
 
 from httmock import HTTMock
 
+from theblues.circuit import CircuitBreaker
+from theblues.errors import CircuitOpenError
 from theblues.support import (
     Priority,
     Support,
@@ -61,3 +63,13 @@ class TestSupport(TestCase):
                                      '4325345345234')
         self.assertEqual('invalid email: someoneatmaildotcom',
                          ctx.exception.args[0])
+
+    def test_create_case_circuit_open(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        support = Support('http://example.com', 'someorgid',
+                          'somerecordtype', circuit_breaker=breaker)
+        with self.assertRaises(CircuitOpenError):
+            support.create_case('someone', 'someone@email.com', 'My subject',
+                                'my description', 'some businessImpact',
+                                Priority.L1, '4325345345234')
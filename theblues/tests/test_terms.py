@@ -4,10 +4,12 @@ from mock import patch
 from unittest import TestCase
 
 from theblues.terms import (
+    DEFAULT_CACHE_TTL,
     Term,
     Terms,
 )
 from theblues.errors import ServerError
+from theblues.tests import helpers
 from theblues.utils import DEFAULT_TIMEOUT
 
 
@@ -35,7 +37,9 @@ class TestTerms(TestCase):
                               revision=4), resp)
         mocked.assert_called_once_with(
             'http://example.com/v1/terms/name_of_terms?revision=3',
-            timeout=DEFAULT_TIMEOUT)
+            timeout=DEFAULT_TIMEOUT, session=self.terms.session,
+            retry=None, circuit_breaker=None, deadline=None, instrument=None,
+            client='terms', template='/terms/{name}')
 
     @patch('theblues.terms.make_request')
     def test_get_terms_exception(self, mocked):
@@ -61,3 +65,99 @@ class TestTerms(TestCase):
             '"created-on": "2019-03-12", "content":"some content"}]')
         with self.assertRaises(ServerError):
             self.terms.get_terms('name_of_terms', 3)
+
+    @patch('theblues.terms.make_request')
+    def test_get_terms_revision_cached(self, mocked):
+        mocked.return_value = [{
+            'name': 'canonical', 'revision': 3, 'content': 'content',
+            'created-on': '2016-10-03T12:00:00Z'}]
+        term = self.terms.get_terms('canonical', 3)
+        with patch('theblues.cache._now', return_value=10 ** 9):
+            self.assertEqual(term, self.terms.get_terms('canonical', 3))
+        self.assertEqual(1, mocked.call_count)
+        # The latest revision is cached separately.
+        self.terms.get_terms('canonical')
+        self.assertEqual(2, mocked.call_count)
+
+    @patch('theblues.terms.make_request')
+    def test_get_terms_latest_cached(self, mocked):
+        mocked.return_value = [{
+            'name': 'canonical', 'revision': 3, 'content': 'content',
+            'created-on': '2016-10-03T12:00:00Z'}]
+        with patch('theblues.cache._now', return_value=100):
+            self.terms.get_terms('canonical')
+            self.terms.get_terms('canonical')
+        self.assertEqual(1, mocked.call_count)
+        with patch('theblues.cache._now',
+                   return_value=100 + DEFAULT_CACHE_TTL):
+            self.terms.get_terms('canonical')
+        self.assertEqual(2, mocked.call_count)
+
+    @patch('theblues.terms.make_request')
+    def test_get_terms_errors_not_cached(self, mocked):
+        mocked.side_effect = ServerError()
+        for _ in range(2):
+            with self.assertRaises(ServerError):
+                self.terms.get_terms('canonical', 3)
+        self.assertEqual(2, mocked.call_count)
+
+    def test_cache_disabled(self):
+        terms = Terms('http://example.com', cache_size=0)
+        self.assertIsNone(terms.cache)
+
+
+def terms_response(url, **kwargs):
+    """Return the terms service response for the given URL."""
+    name = url.split('/')[-1].split('?')[0]
+    if name == 'missing':
+        raise ServerError(404, 'not found')
+    revision = int(url.split('revision=')[1]) if '?' in url else 42
+    return [{'name': name, 'revision': revision, 'content': 'content',
+             'created-on': '2016-10-03T12:00:00Z'}]
+
+
+class TestBulkTerms(TestCase):
+
+    def setUp(self):
+        self.terms = Terms('http://example.com', bulk_workers=2)
+        self.mock_request = helpers.patch_make_request(
+            self, 'theblues.terms', terms_response)
+
+    def test_bulk_terms(self):
+        results = self.terms.bulk_terms(
+            [('canonical', 3), ('canonical', None), ('other', 1),
+             ('canonical', 3)])
+        self.assertEqual(
+            set([('canonical', 3), ('canonical', None), ('other', 1)]),
+            set(results))
+        self.assertEqual(3, results[('canonical', 3)].revision)
+        self.assertEqual(42, results[('canonical', None)].revision)
+        self.assertEqual('other', results[('other', 1)].name)
+        self.assertEqual({}, results.errors)
+        self.assertEqual(3, self.mock_request.call_count)
+
+    def test_cached(self):
+        self.terms.get_terms('canonical', 3)
+        self.terms.bulk_terms([('canonical', 3), ('other', 1)])
+        self.assertEqual(2, self.mock_request.call_count)
+        results = self.terms.bulk_terms([('canonical', 3), ('other', 1)])
+        self.assertEqual(2, len(results))
+        self.assertEqual(2, self.mock_request.call_count)
+
+    def test_errors(self):
+        results = self.terms.bulk_terms([('canonical', 3), ('missing', 1)])
+        self.assertEqual([('canonical', 3)], list(results))
+        self.assertEqual(
+            404, results.errors[('missing', 1)].args[0])
+
+    def test_all_errors(self):
+        with self.assertRaises(ServerError):
+            self.terms.bulk_terms([('missing', 1), ('missing', 2)])
+
+    def test_empty(self):
+        self.assertEqual({}, self.terms.bulk_terms([]))
+
+    def test_sequential(self):
+        self.terms.bulk_workers = 1
+        results = self.terms.bulk_terms([('canonical', 3), ('other', 1)])
+        self.assertEqual(2, len(results))
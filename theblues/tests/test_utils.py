@@ -1,10 +1,23 @@
+import threading
 from unittest import TestCase
 
 from httmock import HTTMock
 import mock
+import requests
 
-from theblues.errors import ServerError
-from theblues.utils import make_request
+from theblues.errors import (
+    EntityNotFound,
+    ServerError,
+)
+from theblues.utils import (
+    bulk_fetch,
+    bulk_results,
+    check_timeout,
+    get_session,
+    make_request,
+    OperationTimeoutsMixin,
+    SingleFlight,
+)
 from theblues.tests import helpers
 
 URL = 'http://example.com/'
@@ -107,7 +120,7 @@ class TestUtils(TestCase, helpers.TimeoutTestsMixin):
         mock_log_error.assert_called_once_with(expected_error)
 
     def test_make_request_unexpected_error(self):
-        with mock.patch('theblues.utils.requests.get') as mock_get:
+        with mock.patch('requests.Session.request') as mock_get:
             mock_get.side_effect = ValueError('bad wolf')
             with patch_log_error() as mock_log_error:
                 with self.assertRaises(ServerError) as ctx:
@@ -132,3 +145,180 @@ class TestUtils(TestCase, helpers.TimeoutTestsMixin):
         with self.assertRaises(ValueError) as ctx:
             make_request('http://1.2.3.4', method='bad')
         self.assertEqual('invalid method bad', ctx.exception.args[0])
+
+
+class TestSessions(TestCase):
+
+    def test_get_session_same_host(self):
+        session = get_session('http://example.com/v1/')
+        self.assertIs(session, get_session('http://example.com/v2/u/who'))
+
+    def test_get_session_different_hosts(self):
+        session = get_session('http://example.com/')
+        self.assertIsNot(session, get_session('https://example.com/'))
+        self.assertIsNot(session, get_session('http://example.com:8082/'))
+
+    def test_make_request_provided_session(self):
+        session = mock.Mock()
+        session.request.return_value.content = b'{"foo": "bar"}'
+        session.request.return_value.json.return_value = {'foo': 'bar'}
+        response = make_request(URL, session=session)
+        self.assertEqual({'foo': 'bar'}, response)
+        session.request.assert_called_once_with(
+            'GET', URL, auth=None, timeout=10, headers={})
+
+    def test_make_request_connect_read_timeouts(self):
+        session = mock.Mock()
+        session.request.return_value.content = b''
+        make_request(URL, session=session, timeout=(3.05, 30))
+        session.request.assert_called_once_with(
+            'GET', URL, auth=None, timeout=(3.05, 30), headers={})
+
+    def test_make_request_connect_read_timeouts_error(self):
+        session = mock.Mock()
+        session.request.side_effect = requests.exceptions.ReadTimeout
+        with mock.patch('theblues.errors.log.warning'):
+            with self.assertRaises(ServerError) as ctx:
+                make_request(URL, session=session, timeout=(3.05, 30))
+        self.assertEqual(
+            'Request timed out: http://example.com/ timeout: 3.05s connect, '
+            '30s read', ctx.exception.args[0])
+
+    def test_make_request_connections_reused(self):
+        routes = {'/': (200, b'{"foo": "bar"}')}
+        with helpers.StubServer(routes=routes) as server:
+            for _ in range(3):
+                make_request(server.url + '/')
+        self.assertEqual(1, server.connections)
+
+
+class Client(OperationTimeoutsMixin):
+
+    timeout_operations = ('fast', 'slow')
+
+    def __init__(self, timeout=10, timeouts=None):
+        self._init_timeouts(timeout, timeouts)
+
+
+class TestOperationTimeouts(TestCase):
+
+    def test_default_timeout(self):
+        client = Client(timeouts={'slow': (3.05, 60)})
+        self.assertEqual(10, client._timeout('fast'))
+        self.assertEqual(10, client._timeout(None))
+
+    def test_operation_timeout(self):
+        client = Client(timeouts={'fast': 1, 'slow': (3.05, 60)})
+        self.assertEqual(1, client._timeout('fast'))
+        self.assertEqual((3.05, 60), client._timeout('slow'))
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError) as ctx:
+            Client(timeouts={'fats': 1})
+        self.assertEqual(
+            "unknown operation 'fats', expected one of: fast, slow",
+            ctx.exception.args[0])
+
+    def test_check_timeout(self):
+        for timeout in (None, 1, 0.5, (1, 2), (None, 2)):
+            check_timeout(timeout)
+        for timeout in (0, -1, (1, 2, 3), (1, 0)):
+            with self.assertRaises(ValueError):
+                check_timeout(timeout)
+
+    def test_invalid_timeout(self):
+        with self.assertRaises(ValueError):
+            Client(timeout=(1,))
+        with self.assertRaises(ValueError):
+            Client(timeouts={'slow': -1})
+
+
+class TestSingleFlight(TestCase):
+
+    def test_result_returned(self):
+        flight = SingleFlight()
+        self.assertEqual(42, flight.do('key', lambda: 42))
+        self.assertEqual(0, flight.shared)
+
+    def test_concurrent_calls_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('key', func)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('key', func)))
+            for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while flight.shared < 3:
+            release.wait(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(['result'] * 4, results)
+        self.assertEqual(1, len(calls))
+
+    def test_error_raised(self):
+        flight = SingleFlight()
+
+        def func():
+            raise ValueError('bad wolf')
+        with self.assertRaises(ValueError):
+            flight.do('key', func)
+        # A failed call is not remembered.
+        self.assertEqual('ok', flight.do('key', lambda: 'ok'))
+
+
+class TestBulkFetch(TestCase):
+
+    def fetch(self, key):
+        self.threads.add(threading.current_thread())
+        if key == 'missing':
+            raise EntityNotFound(key)
+        return key.upper()
+
+    def setUp(self):
+        self.threads = set()
+
+    def test_bulk_fetch(self):
+        responses = bulk_fetch(['a', 'missing', 'b'], self.fetch, 2)
+        self.assertEqual(
+            [('a', 'A'), ('missing', None), ('b', 'B')],
+            [(key, value) for key, value, _ in responses])
+        self.assertIsInstance(responses[1][2], EntityNotFound)
+        self.assertNotIn(threading.current_thread(), self.threads)
+
+    def test_sequential(self):
+        bulk_fetch(['a', 'b'], self.fetch, 1)
+        self.assertEqual(set([threading.current_thread()]), self.threads)
+
+    def test_unexpected_errors_raised(self):
+        def fetch(key):
+            raise ValueError(key)
+        with self.assertRaises(ValueError):
+            bulk_fetch(['a'], fetch, 2)
+
+    def test_bulk_results(self):
+        error = ServerError(500, 'boom')
+        results = bulk_results([('a', 'A', None), ('b', None, error)])
+        self.assertEqual({'a': 'A'}, results)
+        self.assertEqual({'b': error}, results.errors)
+
+    def test_bulk_results_all_errors(self):
+        error = ServerError(500, 'boom')
+        with self.assertRaises(ServerError):
+            bulk_results([('a', None, error), ('b', None, error)])
+        self.assertEqual({}, bulk_results([]))
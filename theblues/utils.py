@@ -1,22 +1,47 @@
-import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import json
+from multiprocessing.pool import ThreadPool
+import threading
 try:
     from urllib import urlencode
+    from urlparse import urlparse
 except ImportError:
-    from urllib.parse import urlencode
+    from urllib.parse import (
+        urlencode,
+        urlparse,
+    )
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
+from theblues.circuit import guard
+from theblues.deadline import request_timeout
 from theblues.errors import (
+    CircuitOpenError,
+    DeadlineExceeded,
+    EntityNotFound,
     log,
     ServerError,
     timeout_error,
 )
+from theblues.instrumentation import (
+    counted,
+    instrumented,
+)
+from theblues.retry import send_request
 
 
 DEFAULT_TIMEOUT = 3.05
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
 _error_message = 'Error during request: {url} message: {message}'
+# Pooled sessions shared by all clients, keyed by (scheme, host).
+_sessions = {}
+_sessions_lock = threading.Lock()
 
 
 def _server_error_message(url, message):
@@ -26,9 +51,100 @@ def _server_error_message(url, message):
     return msg
 
 
+def make_session(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True):
+    """Return a requests session backed by a pool of persistent connections.
+
+    @param pool_connections The number of per-host connection pools to keep.
+    @param pool_maxsize The maximum number of connections kept open to a
+        single host.
+    @param keep_alive Whether connections are reused across requests; when
+        False every request asks the server to close the connection.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(url):
+    """Return the pooled session shared by all requests to the url's host.
+
+    @param url The url, or base url, of the service being queried.
+    """
+    parts = urlparse(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = make_session()
+    return session
+
+
+def check_timeout(timeout):
+    """Raise a ValueError if the given request timeout is not valid.
+
+    @param timeout The timeout in seconds, a (connect, read) tuple of
+        timeouts in seconds, or None for no timeout.
+    """
+    values = timeout if isinstance(timeout, tuple) else (timeout,)
+    if isinstance(timeout, tuple) and len(timeout) != 2:
+        raise ValueError(
+            'invalid timeout {!r}: expected (connect, read)'.format(timeout))
+    for value in values:
+        if value is not None and value <= 0:
+            raise ValueError(
+                'invalid timeout {!r}: must be positive'.format(timeout))
+
+
+class OperationTimeoutsMixin(object):
+    """Resolve the timeout of the requests made by the operations of a client.
+
+    Clients have a default timeout, which can be overridden for some of their
+    operations (e.g. shorter for metadata lookups and longer for downloads).
+    Timeouts are either a number of seconds, or a (connect, read) tuple.
+    Classes using this mixin list their operation names in
+    timeout_operations, and call _init_timeouts from their initializer.
+    """
+
+    # The names of the operations whose timeout can be overridden.
+    timeout_operations = ()
+
+    def _init_timeouts(self, timeout, timeouts=None):
+        """Set up the timeouts.
+
+        @param timeout The default timeout of the requests.
+        @param timeouts An optional dict mapping operation names to their
+            timeouts.
+        @raise ValueError if a timeout or an operation name is not valid.
+        """
+        timeouts = dict(timeouts or {})
+        for operation, value in timeouts.items():
+            if operation not in self.timeout_operations:
+                raise ValueError(
+                    'unknown operation {!r}, expected one of: {}'.format(
+                        operation, ', '.join(self.timeout_operations)))
+            check_timeout(value)
+        check_timeout(timeout)
+        self.timeout = timeout
+        self.timeouts = timeouts
+
+    def _timeout(self, operation):
+        """Return the timeout of the requests made by the given operation.
+
+        @param operation The operation name.
+        """
+        return self.timeouts.get(operation, self.timeout)
+
+
 def make_request(
         url, method='GET', query=None, body=None, auth=None, macaroons=None,
-        timeout=10):
+        timeout=10, session=None, retry=None, circuit_breaker=None,
+        deadline=None, instrument=None, client=None, template=None):
     """Make a request with the provided data.
 
     @param url The url to make the request to.
@@ -36,17 +152,34 @@ def make_request(
     @param query A dict of the query key and values.
     @param body The optional body as a string or as a JSON decoded dict.
     @param auth The optional username and password as a tuple.
-    @param timeout The request timeout in seconds, defaulting to 10 seconds.
+    @param timeout The request timeout in seconds, or a (connect, read)
+        tuple of timeouts, defaulting to 10 seconds.
+    @param session The requests session used to send the request, defaulting
+        to the pooled session shared by all requests to the url's host.
+    @param retry An optional theblues.retry.RetryPolicy used to retry the
+        request if it is idempotent and fails with a transient error.
+    @param circuit_breaker An optional theblues.circuit.CircuitBreaker
+        rejecting the request while the host is unavailable.
+    @param deadline An optional theblues.deadline.Deadline limiting the
+        overall time spent on the request, including retries.
+    @param instrument An optional theblues.instrumentation.Instrument
+        notified before and after the request.
+    @param client The name of the client making the request, reported to
+        the instrument.
+    @param template The URL template of the request, reported to the
+        instrument.
 
     POST/PUT request bodies are assumed to be in JSON format.
     Return the response content as a JSON decoded object, or an empty dict.
-    Raise a ServerError if a problem occurs in the request/response process.
+    Raise a ServerError if a problem occurs in the request/response process,
+    a CircuitOpenError if the request was rejected by the circuit breaker, or
+    a DeadlineExceeded if the deadline passed before the request was sent.
     Raise a ValueError if invalid parameters are provided.
     """
     kwargs = {'auth': auth, 'timeout': timeout, 'headers': {}}
     # Handle the request body.
     if body is not None:
-        if isinstance(body, collections.Mapping):
+        if isinstance(body, Mapping):
             body = json.dumps(body)
         kwargs['data'] = body
     # Handle request methods.
@@ -58,17 +191,39 @@ def make_request(
     else:
         raise ValueError('invalid method {}'.format(method))
     if macaroons is not None:
-        kwargs['headers']['Bakery-Protocol-Version'] = 1
+        kwargs['headers']['Bakery-Protocol-Version'] = '1'
         kwargs['headers']['Macaroons'] = macaroons
-    api_method = getattr(requests, method.lower())
+    if session is None:
+        session = get_session(url)
+
+    with instrumented(instrument, client, method, url, template) as record:
+        request = guard(circuit_breaker, url, counted(
+            record, lambda: session.request(method, url, **kwargs)))
+
+        def send():
+            # Every attempt only gets the time left before the deadline, and
+            # an expired deadline is raised before reaching the breaker.
+            kwargs['timeout'] = request_timeout(timeout, deadline, url)
+            return request()
+        return _send(url, method, send, kwargs, record, retry, deadline)
+
+
+def _send(url, method, send, kwargs, record, retry, deadline):
+    """Send the request and return the JSON decoded response.
+
+    See make_request for the errors raised.
+    """
     # Perform the request.
     try:
-        response = api_method(url, **kwargs)
+        response = send_request(retry, method, send, deadline=deadline)
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
     except requests.exceptions.Timeout:
-        raise timeout_error(url, timeout)
+        raise timeout_error(url, kwargs['timeout'])
     except Exception as err:
         msg = _server_error_message(url, err)
         raise ServerError(msg)
+    record_response(record, response)
     # Handle error responses.
     try:
         response.raise_for_status()
@@ -90,6 +245,155 @@ def make_request(
         raise ServerError(msg)
 
 
+def record_response(record, response, stream=False):
+    """Store the status, size and time to first byte of a response.
+
+    @param record The theblues.instrumentation.RequestRecord of the request,
+        or None if the request is not instrumented.
+    @param response The requests response.
+    @param stream Whether the response body is streamed, in which case its
+        size is taken from the Content-Length header, if any.
+    """
+    if record is None:
+        return
+    record.status = response.status_code
+    # The time elapsed between sending the request and parsing the headers.
+    record.ttfb = response.elapsed.total_seconds()
+    if not stream:
+        record.size = len(response.content)
+        return
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        record.size = int(length)
+
+
+class BulkResults(dict):
+    """The results of a bulk request, e.g. keyed by entity id.
+
+    Keys which could not be retrieved are missing from the results, and the
+    errors attribute maps them to the exception raised when querying them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BulkResults, self).__init__(*args, **kwargs)
+        self.errors = {}
+
+
+def bulk_results(responses):
+    """Return the BulkResults of the responses to the requests of a batch.
+
+    @param responses An iterable of (key, value, error) tuples, where error
+        is the exception raised when retrieving the value of the key, or
+        None if the value was retrieved.
+    @return A BulkResults instance.
+    @raise The first error if no value could be retrieved.
+    """
+    results = BulkResults()
+    first_error = None
+    for key, value, error in responses:
+        if error is None:
+            results[key] = value
+            continue
+        first_error = first_error or error
+        results.errors[key] = error
+    if first_error is not None and not results:
+        raise first_error
+    return results
+
+
+def bulk_fetch(keys, fetch, workers):
+    """Retrieve the values of many keys, calling fetch from a thread pool.
+
+    @param keys A list of the keys to retrieve.
+    @param fetch A callable returning the value of a key, and raising
+        EntityNotFound or ServerError if it cannot be retrieved.
+    @param workers The maximum number of concurrent calls to fetch.
+    @return A list of (key, value, error) tuples, see bulk_results.
+    """
+    def call(key):
+        try:
+            return key, fetch(key), None
+        except (EntityNotFound, ServerError) as err:
+            return key, None, err
+
+    if len(keys) > 1 and workers > 1:
+        pool = ThreadPool(min(workers, len(keys)))
+        try:
+            return pool.map(call, keys)
+        finally:
+            pool.close()
+            pool.join()
+    return [call(key) for key in keys]
+
+
+def unique(items):
+    """Return a list of the given items without duplicates, in order.
+
+    @param items An iterable of hashable items.
+    """
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls sharing the same key.
+
+    While a call for a key is in flight, other threads calling with the same
+    key wait for it to complete and get its result, or its exception, instead
+    of making the call themselves.
+    """
+
+    def __init__(self):
+        # The number of calls served by another call in flight.
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func with the given arguments unless a call is in flight.
+
+        @param key The hashable key identifying identical calls.
+        @param func The callable to call.
+        @return The result of the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    """A call in flight, see SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
 def ensure_trailing_slash(url):
     """Returns a url with a trailing slash
 